@@ -0,0 +1,338 @@
+"""
+Maintenance commands for the user stores. Run `python3 src/admin.py --help`
+from the project root for the list of commands.
+"""
+import argparse
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from sharded_store import ShardedUserStore
+
+
+def rebuild_passwd_index_cmd(args: argparse.Namespace) -> None:
+    from sharded_store import ShardedUserStore
+    from user_store import FlatFileUserStore, get_user_store
+
+    store = get_user_store()
+    if not isinstance(store, (FlatFileUserStore, ShardedUserStore)):
+        raise SystemExit('Only the flat file user stores have a password index')
+    num_unames = store.rebuild_passwd_index()
+    print(f'Indexed {num_unames} username(s)')
+
+
+def rebuild_uname_filter_cmd(args: argparse.Namespace) -> None:
+    from sharded_store import ShardedUserStore
+    from user_store import FlatFileUserStore, get_user_store
+
+    store = get_user_store()
+    if not isinstance(store, (FlatFileUserStore, ShardedUserStore)):
+        raise SystemExit('Only the flat file user stores have a username filter')
+    if args.fp_rate is not None:
+        for shard in store.shards().values() if isinstance(store, ShardedUserStore) else [store]:
+            shard.uname_filter.fp_rate = args.fp_rate
+    num_unames = store.rebuild_uname_filter()
+    print(f'Added {num_unames} username(s) to the filter')
+
+
+def rebuild_role_index_cmd(args: argparse.Namespace) -> None:
+    from sharded_store import ShardedUserStore
+    from user_store import FlatFileUserStore, get_user_store
+
+    store = get_user_store()
+    if not isinstance(store, (FlatFileUserStore, ShardedUserStore)):
+        raise SystemExit('Only the flat file user stores have a role index')
+    num_users = store.rebuild_role_index()
+    print(f'Indexed {num_users} user(s)')
+
+
+def users_with_cmd(args: argparse.Namespace) -> None:
+    from problem1c import Operation
+    from role_index import RoleIndex, UserSet
+    from sharded_store import ShardedUserStore
+    from user_store import FlatFileUserStore, get_user_store
+
+    store = get_user_store()
+    if not isinstance(store, (FlatFileUserStore, ShardedUserStore)):
+        raise SystemExit('Only the flat file user stores have a role index')
+    try:
+        operations = [Operation[operation.upper().replace('-', '_')] for operation in args.operations]
+    except KeyError as e:
+        raise SystemExit(f'Unknown operation: {e}')
+
+    def query(index: RoleIndex) -> UserSet:
+        sets = ([index.users_with_role(role) for role in args.roles]
+                + [index.users_with_operation(operation) for operation in operations])
+        if not sets:
+            users = index.all_users()
+        else:
+            users = sets[0]
+            for other in sets[1:]:
+                users = users | other if args.any else users & other
+        for role in args.without_roles:
+            users -= index.users_with_role(role)
+        return users
+
+    # Shards number their users separately, so each is queried on its own
+    # and the results are put together
+    shards = store.shards().values() if isinstance(store, ShardedUserStore) else [store]
+    try:
+        shard_users = [query(shard.role_index) for shard in shards]
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    if args.count:
+        print(sum(len(users) for users in shard_users))
+    else:
+        for users in shard_users:
+            for uname in users:
+                print(uname)
+
+
+def import_passwd_cmd(args: argparse.Namespace) -> None:
+    """
+    Adds the records of a plain text password file that aren't already in the
+    user store. The first record of a username in the file wins.
+    """
+    from user_store import PASSWD_FILE_RECORD_DELIMITER, NewUser, get_user_store
+
+    users = []
+    with open(args.src, 'r', encoding='utf-8') as src_file:
+        for line in src_file:
+            uname, sep, hash_str = line.rstrip('\n').partition(
+                PASSWD_FILE_RECORD_DELIMITER)
+            if sep:
+                users.append(NewUser(uname, hash_str, None))  # No roles record
+    taken = get_user_store().add_users(users)
+    print(f'Imported {len(users) - len(taken)} record(s)')
+
+
+def export_passwd_cmd(args: argparse.Namespace) -> None:
+    from user_store import PASSWD_FILE_RECORD_DELIMITER, get_user_store
+
+    num_exported = 0
+    with open(args.dest, 'w', encoding='utf-8') as dest_file:
+        for record in get_user_store().iter_passwd_records():
+            dest_file.write(PASSWD_FILE_RECORD_DELIMITER.join(record) + '\n')
+            num_exported += 1
+    print(f'Exported {num_exported} record(s) to {args.dest}')
+
+
+def migrate_store_cmd(args: argparse.Namespace) -> None:
+    from user_store import migrate_user_store, open_user_store
+
+    src = open_user_store(args.src)
+    dest = open_user_store(args.dest)
+    num_passwd_records, num_roles_records = migrate_user_store(src, dest)
+    src.close()
+    dest.close()
+    print(
+        f'Copied {num_passwd_records} password record(s) and {num_roles_records} roles record(s)')
+
+
+def build_weak_passwd_db_cmd(args: argparse.Namespace) -> None:
+    from problem3ab import WEAK_PASSWD_FILE, WEAK_PASSWD_DB_FILE, WEAK_PASSWD_BLOOM_FILE
+    from weak_passwd_db import build_weak_passwd_db
+
+    num_passwds = build_weak_passwd_db(
+        WEAK_PASSWD_FILE, WEAK_PASSWD_DB_FILE, WEAK_PASSWD_BLOOM_FILE, args.fp_rate)
+    print(f'Compiled {num_passwds} weak password(s)')
+
+
+def bulk_enrol_cmd(args: argparse.Namespace) -> None:
+    from bulk_enrol import bulk_enrol
+
+    report = bulk_enrol(args.src, args.workers)
+    for failure in report.failures:
+        print(f'Line {failure.line_num} ({failure.uname}): {failure.reason}')
+    print(
+        f'Enrolled {len(report.enrolled)} user(s), {len(report.failures)} row(s) failed')
+
+
+def calibrate_cmd(args: argparse.Namespace) -> None:
+    from calibrate import calibrate, save_calibration
+    from problem2c import ARGON2_PARAMS_FILE
+
+    calibration = calibrate(args.target_ms, args.memory_cost,
+                            args.parallelism, args.min_throughput)
+    print(f'time_cost={calibration.time_cost} memory_cost_kib={calibration.memory_cost_kib} '
+          f'parallelism={calibration.parallelism}: {calibration.verify_ms:.1f}ms per verify, '
+          f'~{calibration.verifies_per_sec:.0f} verifies/sec')
+    if args.write:
+        save_calibration(calibration)
+        print(f'Saved to {ARGON2_PARAMS_FILE}')
+
+
+def compact_store_cmd(args: argparse.Namespace) -> None:
+    from user_store import get_user_store
+
+    store = get_user_store()
+    if args.if_needed and not store.needs_compaction():
+        print('Compaction not needed')
+        return
+    store.compact()
+    print('Compacted the user store')
+
+
+def get_sharded_store() -> 'ShardedUserStore':
+    from sharded_store import ShardedUserStore
+    from user_store import get_user_store
+
+    store = get_user_store()
+    if not isinstance(store, ShardedUserStore):
+        raise SystemExit('The user store is not sharded, set USER_STORE_BACKEND=sharded')
+    return store
+
+
+def shards_cmd(args: argparse.Namespace) -> None:
+    for stats in get_sharded_store().shard_stats():
+        print(f'{stats["shard"]:<16} depth {stats["depth"]:<3} {stats["users"]:>12} user(s) '
+              f'{stats["bytes"]:>14} bytes')
+
+
+def split_shards_cmd(args: argparse.Namespace) -> None:
+    store = get_sharded_store()
+    names = args.shards
+    if not names:
+        names = [stats['shard'] for stats in store.shard_stats()
+                 if args.max_users is None or stats['users'] > args.max_users]
+    for name in names:
+        try:
+            low, high = store.split_shard(name)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print(f'Split {name} into {low} and {high}')
+    if not names:
+        print('No shards to split')
+
+
+def set_roles_cmd(args: argparse.Namespace) -> None:
+    from problem3ab import set_user_roles_record
+
+    try:
+        updated = set_user_roles_record(args.uname, args.roles)
+    except ValueError as e:  # Unknown role
+        raise SystemExit(str(e))
+    if not updated:
+        raise SystemExit(f'No such user: {args.uname}')
+    print(f'Set the roles of {args.uname}')
+
+
+def delete_user_cmd(args: argparse.Namespace) -> None:
+    from problem3ab import delete_user
+
+    if not delete_user(args.uname):
+        raise SystemExit(f'No such user: {args.uname}')
+    print(f'Deleted {args.uname}')
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(required=True)
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild-passwd-index', help='rebuild the password file index')
+    rebuild_parser.set_defaults(func=rebuild_passwd_index_cmd)
+
+    filter_parser = subparsers.add_parser(
+        'rebuild-uname-filter', help='rebuild the Bloom filter of enrolled usernames')
+    filter_parser.add_argument('--fp-rate', type=float,
+                               help='false positive rate (default: $UNAME_FILTER_FP_RATE or 0.01)')
+    filter_parser.set_defaults(func=rebuild_uname_filter_cmd)
+
+    role_index_parser = subparsers.add_parser(
+        'rebuild-role-index', help='rebuild the index of users by role')
+    role_index_parser.set_defaults(func=rebuild_role_index_cmd)
+
+    users_with_parser = subparsers.add_parser(
+        'users-with', help='list the users holding every given role and operation')
+    users_with_parser.add_argument('--role', dest='roles', action='append', default=[],
+                                   help='e.g. "Premium Client", may be repeated')
+    users_with_parser.add_argument('--without-role', dest='without_roles', action='append', default=[],
+                                   help='leave out holders of a role, may be repeated')
+    users_with_parser.add_argument('--operation', dest='operations', action='append', default=[],
+                                   help='e.g. MODIFY_ANY_INVESTMENT_PORTFOLIO, may be repeated')
+    users_with_parser.add_argument('--any', action='store_true',
+                                   help='users holding any of the roles and operations, not all of them')
+    users_with_parser.add_argument('--count', action='store_true', help='only print how many')
+    users_with_parser.set_defaults(func=users_with_cmd)
+
+    import_parser = subparsers.add_parser(
+        'import-passwd', help='import records from a plain text password file')
+    import_parser.add_argument('src', type=Path)
+    import_parser.set_defaults(func=import_passwd_cmd)
+
+    export_parser = subparsers.add_parser(
+        'export-passwd', help='export password records to a plain text password file')
+    export_parser.add_argument('dest', type=Path)
+    export_parser.set_defaults(func=export_passwd_cmd)
+
+    migrate_parser = subparsers.add_parser(
+        'migrate-store', help='copy every user record from one user store backend to another')
+    migrate_parser.add_argument('src', choices=['flat', 'sqlite', 'sharded'])
+    migrate_parser.add_argument('dest', choices=['flat', 'sqlite', 'sharded'])
+    migrate_parser.set_defaults(func=migrate_store_cmd)
+
+    weak_parser = subparsers.add_parser(
+        'build-weak-passwd-db', help='compile the weak password file for fast lookups')
+    weak_parser.add_argument('--fp-rate', type=float, default=0.001,
+                             help='Bloom filter false positive rate (default: %(default)s)')
+    weak_parser.set_defaults(func=build_weak_passwd_db_cmd)
+
+    bulk_parser = subparsers.add_parser(
+        'bulk-enrol', help='enrol users from a CSV (username,password,roles) or JSONL file')
+    bulk_parser.add_argument('src', type=Path)
+    bulk_parser.add_argument('--workers', type=int,
+                             help='hashing processes (default: number of cores)')
+    bulk_parser.set_defaults(func=bulk_enrol_cmd)
+
+    calibrate_parser = subparsers.add_parser(
+        'calibrate', help='pick Argon2 parameters for a target login latency on this machine')
+    calibrate_parser.add_argument('--target-ms', type=float, default=50,
+                                  help='maximum verify latency (default: %(default)s)')
+    calibrate_parser.add_argument('--min-throughput', type=float,
+                                  help='minimum verifies/sec across all cores')
+    calibrate_parser.add_argument('--memory-cost', type=int, default=19456,
+                                  help='memory cost in KiB (default: %(default)s)')
+    calibrate_parser.add_argument('--parallelism', type=int, default=1,
+                                  help='lanes (default: %(default)s)')
+    calibrate_parser.add_argument('--write', action='store_true',
+                                  help='save the parameters for this host')
+    calibrate_parser.set_defaults(func=calibrate_cmd)
+
+    compact_parser = subparsers.add_parser(
+        'compact', help='reclaim the space taken by updated and deleted records')
+    compact_parser.add_argument('--if-needed', action='store_true',
+                                help='only compact if enough of the records are garbage')
+    compact_parser.set_defaults(func=compact_store_cmd)
+
+    shards_parser = subparsers.add_parser(
+        'shards', help='list the shards of the sharded user store')
+    shards_parser.set_defaults(func=shards_cmd)
+
+    split_parser = subparsers.add_parser(
+        'split-shards', help='split shards of the sharded user store in two, while it is in use')
+    split_parser.add_argument('shards', nargs='*', metavar='shard',
+                              help='shards to split (default: every shard)')
+    split_parser.add_argument('--max-users', type=int,
+                              help='only split the shards holding more users than this')
+    split_parser.set_defaults(func=split_shards_cmd)
+
+    set_roles_parser = subparsers.add_parser(
+        'set-roles', help="replace a user's roles")
+    set_roles_parser.add_argument('uname')
+    set_roles_parser.add_argument('roles', nargs='*', metavar='role',
+                                  help='e.g. "Client" "Premium Client" (none revokes every role)')
+    set_roles_parser.set_defaults(func=set_roles_cmd)
+
+    delete_parser = subparsers.add_parser(
+        'delete-user', help="delete a user's password and roles records")
+    delete_parser.add_argument('uname')
+    delete_parser.set_defaults(func=delete_user_cmd)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
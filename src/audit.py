@@ -0,0 +1,296 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+import metrics
+from file_lock import locked
+from user_store import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+AUDIT_LOG_FILE = Path(os.environ.get('AUDIT_LOG_FILE', DATA_DIR / 'audit.jsonl'))
+
+AUDIT_BUFFER_SIZE = 10_000  # Events held in memory for the writer
+AUDIT_BATCH_SIZE = 1000  # Events written (and fsynced) at once
+AUDIT_FLUSH_INTERVAL = 1.0  # Longest an event waits to be written, in seconds
+
+# The log is rotated (renamed and gzipped) once it reaches this size or its
+# first event is this old
+AUDIT_ROTATE_BYTES = 64 * 1024 * 1024
+AUDIT_ROTATE_INTERVAL = 24 * 60 * 60  # Seconds
+
+# What to do with events logged while the buffer is full: 'drop' them (and
+# count them), or 'block' the caller until the writer catches up
+DROP = 'drop'
+BLOCK = 'block'
+AUDIT_OVERFLOW_POLICY = os.environ.get('AUDIT_OVERFLOW_POLICY', DROP)
+
+EVENTS = metrics.counter(
+    'auth_audit_events_total', 'Audit events by result (written or dropped)')
+
+
+class AuditLog:
+    """
+    Append-only JSONL audit trail, written off the caller's path: log() only
+    puts the event in an in-memory ring buffer, and a background thread
+    drains it in batches of up to `batch_size`, each one appended with a
+    single write() and fsync() under the log's file lock, so several
+    processes can share a log. Events are written at most `flush_interval`
+    seconds after they're logged.
+
+    The log is rotated once it reaches `rotate_bytes` or its first event is
+    `rotate_interval` seconds old: it's renamed with a timestamp and gzipped
+    by the writer thread.
+
+    When the buffer is full, the `overflow` policy either drops new events,
+    counting them, or blocks callers until there is room.
+    """
+
+    def __init__(self, path: Path = AUDIT_LOG_FILE, buffer_size: int = AUDIT_BUFFER_SIZE,
+                 batch_size: int = AUDIT_BATCH_SIZE, flush_interval: float = AUDIT_FLUSH_INTERVAL,
+                 rotate_bytes: int = AUDIT_ROTATE_BYTES, rotate_interval: float = AUDIT_ROTATE_INTERVAL,
+                 overflow: str = AUDIT_OVERFLOW_POLICY, fsync: bool = True):
+        if overflow not in (DROP, BLOCK):
+            raise ValueError(f'Unknown audit overflow policy: {overflow}')
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.overflow = overflow
+        self.fsync = fsync
+
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+
+        # Ring buffer of (time, event, fields), `_count` of them from `_head`
+        self._buffer: list[tuple | None] = [None] * buffer_size
+        self._head = 0
+        self._count = 0
+        self._logged = 0  # Events put in the buffer so far
+        self._done = 0  # ... and taken out of it, written or not
+        self._flush_to = 0  # Events flush() is waiting on
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pid = None  # A forked child has to start its own thread
+        self._closed = False
+        self._first_event_time: tuple[int, float] | None = None  # (inode, time) of the log
+
+    def log(self, event: str, **fields) -> bool:
+        """
+        Records an event, e.g. log('login', uname='hubert', outcome='success').
+
+        Returns:
+            False if the event was dropped because the buffer was full.
+            True otherwise.
+        """
+        now = time.time()
+        with self._cond:
+            if self._thread is None or self._pid != os.getpid():
+                self._start()
+            if self._count == self.buffer_size:
+                if self.overflow == DROP or self._closed:
+                    self.dropped += 1
+                    if metrics.ENABLED:
+                        EVENTS.inc(result='dropped')
+                    return False
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._count < self.buffer_size)
+
+            self._buffer[(self._head + self._count) % self.buffer_size] = (now, event, fields)
+            self._count += 1
+            self._logged += 1
+            if self._count >= self.batch_size:
+                self._cond.notify_all()
+            return True
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Waits until every event logged so far is written.
+
+        Returns:
+            True if they were, False if it timed out.
+        """
+        with self._cond:
+            target = self._logged
+            self._flush_to = max(self._flush_to, target)
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._done >= target, timeout)
+
+    def close(self) -> None:
+        """
+        Writes out the buffered events and stops the writer thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join()
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {'buffered': self._count, 'written': self.written, 'dropped': self.dropped,
+                    'batches': self.batches, 'rotations': self.rotations, 'errors': self.errors}
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: (self._count >= self.batch_size or self._closed
+                                             or self._flush_to > self._done),
+                                    timeout=self.flush_interval)
+                if not self._count and self._closed:
+                    return
+                num_events = min(self._count, self.batch_size)
+                batch = []
+                for _ in range(num_events):
+                    batch.append(self._buffer[self._head])
+                    self._buffer[self._head] = None
+                    self._head = (self._head + 1) % self.buffer_size
+                self._count -= num_events
+                self._cond.notify_all()  # Room for blocked callers
+
+            if batch:
+                self._write(batch)
+            with self._cond:
+                self._done += len(batch)
+                self._cond.notify_all()
+
+    def _write(self, batch: list[tuple]) -> None:
+        data = ''.join(json.dumps({'time': datetime.datetime.fromtimestamp(event_time, datetime.timezone.utc)
+                                   .isoformat(timespec='microseconds'), 'event': event, **fields},
+                                  default=str) + '\n'
+                       for event_time, event, fields in batch).encode('utf-8')
+        rotated_path = None
+        try:
+            with locked(self.path, exclusive=True):
+                rotated_path = self._rotate_if_needed()
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                try:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except OSError:
+            logger.exception('Failed to write %d audit events to %s', len(batch), self.path)
+            with self._cond:
+                self.errors += 1
+                self.dropped += len(batch)
+            if metrics.ENABLED:
+                EVENTS.inc(len(batch), result='dropped')
+            return
+
+        with self._cond:
+            self.written += len(batch)
+            self.batches += 1
+        if metrics.ENABLED:
+            EVENTS.inc(len(batch), result='written')
+
+        if rotated_path is not None:
+            # Outside the lock, other writers carry on with the new log
+            try:
+                self._compress(rotated_path)
+            except OSError:
+                logger.exception('Failed to compress rotated audit log %s', rotated_path)
+
+    def _rotate_if_needed(self) -> Path | None:
+        """
+        Renames the log aside if it's due for rotation.
+
+        Returns:
+            The rotated log's new path if it was rotated.
+            None otherwise.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size == 0:
+            return None
+        if (stat.st_size < self.rotate_bytes
+                and time.time() - self._first_event(stat.st_ino) < self.rotate_interval):
+            return None
+
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        rotated_path = self.path.with_name(f'{self.path.stem}-{timestamp}{self.path.suffix}')
+        os.replace(self.path, rotated_path)
+        with self._cond:
+            self.rotations += 1
+        return rotated_path
+
+    def _first_event(self, inode: int) -> float:
+        """
+        Gets the time of the first event in the log, whichever process wrote it.
+        """
+        if self._first_event_time is None or self._first_event_time[0] != inode:
+            try:
+                with open(self.path, 'rb') as log_file:
+                    first_event_time = datetime.datetime.fromisoformat(
+                        json.loads(log_file.readline())['time']).timestamp()
+            except (ValueError, KeyError, TypeError):
+                first_event_time = time.time()  # Unreadable, so give it a full interval
+            self._first_event_time = (inode, first_event_time)
+        return self._first_event_time[1]
+
+    def _compress(self, path: Path) -> None:
+        import gzip
+        import shutil
+        compressed_path = path.with_name(path.name + '.gz')
+        with open(path, 'rb') as src, gzip.open(compressed_path, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+        os.remove(path)
+
+
+_audit_log: AuditLog | None = None
+_audit_log_lock = threading.Lock()
+
+
+def get_audit_log() -> AuditLog:
+    """
+    Gets the process-wide audit log, creating it on first use. Its buffered
+    events are written out when the process exits.
+    """
+    global _audit_log
+    with _audit_log_lock:
+        if _audit_log is None:
+            _audit_log = AuditLog()
+            atexit.register(_audit_log.close)
+        return _audit_log
+
+
+def set_audit_log(audit_log: AuditLog) -> None:
+    global _audit_log
+    with _audit_log_lock:
+        _audit_log = audit_log
+
+
+def audit_login(uname: str, outcome: str, source: str | None = None, **fields) -> None:
+    """
+    Records a login attempt's outcome (success, unknown_user, wrong_passwd,
+    throttled or overloaded).
+    """
+    get_audit_log().log('login', uname=uname, outcome=outcome, source=source, **fields)
+
+
+def audit_authorization(uname: str, operation, authorized: bool, source: str | None = None) -> None:
+    """
+    Records whether a user was authorized to perform an operation.
+    """
+    get_audit_log().log('authorization', uname=uname, operation=operation.name,
+                        authorized=authorized, source=source)
@@ -0,0 +1,284 @@
+"""
+Micro-benchmarks for the authentication and authorization hot paths, run
+against synthetic user stores and weak password lists of different sizes.
+Results can be saved as JSON and compared between runs, e.g.
+
+    python3 src/benchmarks.py --sizes 1000 100000 --output before.json
+    python3 src/benchmarks.py --sizes 1000 100000 --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import string
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+import problem3ab
+from problem1c import Role, get_authorized_operations
+from problem2c import ph, get_user_passwd_record
+from problem3ab import get_user_roles_record, is_weak, validate_passwd, validate_passwds, validate_uname
+from user_store import (PASSWD_FILE_RECORD_DELIMITER, ROLES_FILE_RECORD_DELIMITER, FlatFileUserStore,
+                        get_user_store, set_user_store)
+from weak_passwd_db import WeakPasswdDB, build_weak_passwd_db
+
+DEFAULT_USER_COUNTS = [1_000, 100_000]
+DEFAULT_WEAK_PASSWD_COUNTS = [1_000, 1_000_000]
+
+DEFAULT_DURATION = 1.0  # Seconds spent timing each benchmark
+HASH_ITERATIONS = 5  # Argon2 is slow, so it's timed a fixed number of times
+
+HIT_RATIO = 0.9  # Share of lookups for users that exist
+
+BATCH_SIZE = 1000  # Passwords per validate_passwds call
+
+GENERATOR_SEED = 4810
+WRITE_CHUNK_SIZE = 100_000  # Records per write when generating stores
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    size: int
+    calls: int
+    ops_per_sec: float
+    p50_us: float
+    p90_us: float
+    p99_us: float
+    max_us: float
+
+
+def synthetic_uname(i: int) -> str:
+    return f'user{i:08d}'  # 12 characters, a valid username
+
+
+def generate_user_store(directory: Path, num_users: int, seed: int = GENERATOR_SEED) -> FlatFileUserStore:
+    """
+    Writes a flat file user store with `num_users` synthetic users straight to
+    disk. Every user shares one real Argon2 hash, since hashing millions of
+    passwords would take hours and lookups don't care what the hash is.
+    """
+    rng = random.Random(seed)
+    hash_str = ph.hash('asdfQWE123!')
+    roles = [role.value for role in Role]
+    passwd_file = directory / 'passwd.txt'
+    roles_file = directory / 'roles.txt'
+
+    with open(passwd_file, 'w', encoding='utf-8') as passwd_out, \
+            open(roles_file, 'w', encoding='utf-8') as roles_out:
+        for start in range(0, num_users, WRITE_CHUNK_SIZE):
+            unames = [synthetic_uname(i) for i in range(
+                start, min(start + WRITE_CHUNK_SIZE, num_users))]
+            passwd_out.write(''.join(PASSWD_FILE_RECORD_DELIMITER.join([uname, hash_str]) + '\n'
+                                     for uname in unames))
+            roles_out.write(''.join(ROLES_FILE_RECORD_DELIMITER.join(
+                [uname, ','.join(rng.sample(roles, rng.randint(0, 2)))]) + '\n' for uname in unames))
+
+    return FlatFileUserStore(passwd_file, roles_file, directory / 'passwd.idx')
+
+
+def generate_weak_passwd_list(path: Path, num_passwds: int, seed: int = GENERATOR_SEED) -> list[str]:
+    """
+    Writes a weak password list of random 6-12 character passwords.
+
+    Returns:
+        A sample of the passwords in the list, to look up.
+    """
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits
+    sample = []
+    with open(path, 'w', encoding='utf-8') as weak_passwd_file:
+        for start in range(0, num_passwds, WRITE_CHUNK_SIZE):
+            passwds = [''.join(rng.choices(alphabet, k=rng.randint(6, 12)))
+                       for _ in range(min(WRITE_CHUNK_SIZE, num_passwds - start))]
+            weak_passwd_file.write('\n'.join(passwds) + '\n')
+            sample.extend(passwds[::max(1, len(passwds) // 100)])
+    return sample
+
+
+def lookup_unames(num_users: int, seed: int = GENERATOR_SEED) -> Iterator[str]:
+    """
+    Endless stream of usernames to look up, HIT_RATIO of which exist.
+    """
+    rng = random.Random(seed)
+    while True:
+        if rng.random() < HIT_RATIO:
+            yield synthetic_uname(rng.randrange(num_users))
+        else:
+            yield f'nobody{rng.randrange(1_000_000):06d}'
+
+
+def time_calls(name: str, size: int, fn: Callable, args: Iterator[tuple],
+               duration: float = DEFAULT_DURATION, max_calls: int | None = None) -> BenchmarkResult:
+    """
+    Calls `fn` with successive arguments until `duration` seconds (or
+    `max_calls` calls) have passed, timing each call.
+    """
+    timings = []
+    deadline = time.perf_counter() + duration
+    for call_args in args:
+        start = time.perf_counter_ns()
+        fn(*call_args)
+        timings.append(time.perf_counter_ns() - start)
+        if time.perf_counter() >= deadline or (max_calls and len(timings) >= max_calls):
+            break
+
+    timings.sort()
+    total_s = sum(timings) / 1e9
+
+    def percentile(p: float) -> float:
+        return timings[min(len(timings) - 1, int(len(timings) * p))] / 1000
+
+    return BenchmarkResult(name, size, len(timings), len(timings) / total_s if total_s else 0.0,
+                           percentile(0.5), percentile(0.9), percentile(0.99), timings[-1] / 1000)
+
+
+def repeat(*args) -> Iterator[tuple]:
+    while True:
+        yield args
+
+
+def bench_user_store(num_users: int, duration: float) -> list[BenchmarkResult]:
+    results = []
+    previous_store = get_user_store()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = generate_user_store(Path(tmp_dir), num_users)
+        set_user_store(store)
+        try:
+            for name, fn in [('get_user_passwd_record', get_user_passwd_record),
+                             ('get_user_roles_record', get_user_roles_record),
+                             ('validate_uname', validate_uname)]:
+                unames = ((uname,) for uname in lookup_unames(num_users))
+                results.append(time_calls(
+                    name, num_users, fn, unames, duration))
+        finally:
+            set_user_store(previous_store)
+            store.close()
+    return results
+
+
+def bench_weak_passwds(num_passwds: int, duration: float) -> list[BenchmarkResult]:
+    results = []
+    previous = (problem3ab.WEAK_PASSWD_FILE, problem3ab.weak_passwd_db)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = Path(tmp_dir) / 'weak_passwd.txt'
+        sample = generate_weak_passwd_list(src_path, num_passwds)
+        candidates = sample + ['asdfQWE123!', 'zxcvASD456@']
+        db = WeakPasswdDB(src_path, Path(tmp_dir) /
+                          'weak_passwd.db', Path(tmp_dir) / 'weak_passwd.bloom')
+        problem3ab.WEAK_PASSWD_FILE, problem3ab.weak_passwd_db = src_path, db
+        try:
+            def passwds():
+                rng = random.Random(GENERATOR_SEED)
+                while True:
+                    yield (rng.choice(candidates),)
+
+            # Scanning the text list is slow, so it's only timed briefly
+            results.append(time_calls('is_weak (scan)', num_passwds,
+                           is_weak, passwds(), duration, max_calls=20))
+            batch = [(passwd, 'user00000001')
+                     for (passwd,), _ in zip(passwds(), range(BATCH_SIZE))]
+            results.append(time_calls(f'validate_passwds (scan, {BATCH_SIZE} per call)', num_passwds,
+                           validate_passwds, repeat(batch), duration, max_calls=20))
+            build_weak_passwd_db(src_path, db.db_path, db.bloom_path)
+            results.append(time_calls('is_weak (compiled)',
+                           num_passwds, is_weak, passwds(), duration))
+            results.append(time_calls('validate_passwd', num_passwds, validate_passwd,
+                                      ((passwd, 'user00000001') for (passwd,) in passwds()), duration))
+        finally:
+            problem3ab.WEAK_PASSWD_FILE, problem3ab.weak_passwd_db = previous
+            db.close()
+    return results
+
+
+def bench_authorization(duration: float) -> list[BenchmarkResult]:
+    rng = random.Random(GENERATOR_SEED)
+    roles = list(Role)
+
+    def role_sets():
+        while True:
+            yield (set(rng.sample(roles, rng.randint(1, 3))),)
+    return [time_calls('get_authorized_operations', len(Role), get_authorized_operations, role_sets(), duration)]
+
+
+def bench_argon2() -> list[BenchmarkResult]:
+    hash_str = ph.hash('asdfQWE123!')
+    return [
+        time_calls('ph.hash', 1, ph.hash, repeat('asdfQWE123!'),
+                   duration=float('inf'), max_calls=HASH_ITERATIONS),
+        time_calls('ph.verify', 1, ph.verify, repeat(hash_str, 'asdfQWE123!'),
+                   duration=float('inf'), max_calls=HASH_ITERATIONS),
+    ]
+
+
+def run_benchmarks(user_counts: list[int], weak_passwd_counts: list[int],
+                   duration: float = DEFAULT_DURATION) -> list[BenchmarkResult]:
+    results = []
+    for num_users in user_counts:
+        results.extend(bench_user_store(num_users, duration))
+    for num_passwds in weak_passwd_counts:
+        results.extend(bench_weak_passwds(num_passwds, duration))
+    results.extend(bench_authorization(duration))
+    results.extend(bench_argon2())
+    return results
+
+
+def print_results(results: list[BenchmarkResult], baseline: dict[tuple[str, int], dict] | None = None) -> None:
+    header = f'{"benchmark":<28}{"size":>12}{"ops/sec":>14}{"p50 us":>12}{"p99 us":>12}'
+    if baseline is not None:
+        header += f'{"vs baseline":>14}'
+    print(header)
+    for result in results:
+        line = (f'{result.name:<28}{result.size:>12}{result.ops_per_sec:>14.0f}'
+                f'{result.p50_us:>12.1f}{result.p99_us:>12.1f}')
+        if baseline is not None:
+            previous = baseline.get((result.name, result.size))
+            if previous and previous['ops_per_sec']:
+                line += f'{result.ops_per_sec / previous["ops_per_sec"]:>13.2f}x'
+            else:
+                line += f'{"-":>14}'
+        print(line)
+
+
+def save_results(results: list[BenchmarkResult], path: Path) -> None:
+    with open(path, 'w', encoding='utf-8') as results_file:
+        json.dump({
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'results': [result._asdict() for result in results],
+        }, results_file, indent=4)
+        results_file.write('\n')
+
+
+def load_baseline(path: Path) -> dict[tuple[str, int], dict]:
+    with open(path, 'r', encoding='utf-8') as results_file:
+        results = json.load(results_file)['results']
+    return {(result['name'], result['size']): result for result in results}
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_USER_COUNTS,
+                        help='numbers of users to benchmark lookups with (default: %(default)s)')
+    parser.add_argument('--weak-sizes', type=int, nargs='+', default=DEFAULT_WEAK_PASSWD_COUNTS,
+                        help='weak password list sizes (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION,
+                        help='seconds to time each benchmark for (default: %(default)s)')
+    parser.add_argument('--output', type=Path, help='save results as JSON')
+    parser.add_argument('--compare', type=Path,
+                        help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.weak_sizes, args.duration)
+    print_results(results, load_baseline(
+        args.compare) if args.compare else None)
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
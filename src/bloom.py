@@ -0,0 +1,113 @@
+import hashlib
+import math
+import mmap
+import struct
+from pathlib import Path
+from file_lock import replacing
+
+BLOOM_MAGIC = b'BLOOM002'
+
+# Header: magic, number of bits, number of hash functions, number of items
+# added, and the size, inode and checksum of the source file the items were
+# read from (for filters kept in step with a file, 0 otherwise)
+BLOOM_HEADER = struct.Struct('<8sQQQQQQ')
+
+
+def optimal_params(capacity: int, fp_rate: float) -> tuple[int, int]:
+    """
+    Sizes a Bloom filter for `capacity` items at a target false positive rate.
+
+    Returns:
+        The number of bits and the number of hash functions.
+    """
+    capacity = max(capacity, 1)
+    num_bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+    num_bits = max(num_bits, 64)
+    num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+    return num_bits, num_hashes
+
+
+class BloomFilter:
+    """
+    Bloom filter whose bit array lives in a memory-mapped file, so it can be
+    shared between processes and consulted without reading it into memory.
+    Answers "definitely not added" or "probably added".
+    """
+
+    def __init__(self, path: Path, writable: bool = False):
+        self.path = Path(path)
+        self.writable = writable
+        self._file = open(self.path, 'r+b' if writable else 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        magic, self.num_bits, self.num_hashes, _, _, _, _ = BLOOM_HEADER.unpack_from(
+            self._map, 0)
+        if magic != BLOOM_MAGIC or len(self._map) != BLOOM_HEADER.size + (self.num_bits + 7) // 8:
+            self.close()
+            raise ValueError(f'{self.path} is not a Bloom filter file')
+
+    @classmethod
+    def create(cls, path: Path, capacity: int, fp_rate: float) -> 'BloomFilter':
+        """
+        Creates an empty, writable filter file sized for `capacity` items,
+        replacing any existing one.
+        """
+        path = Path(path)
+        num_bits, num_hashes = optimal_params(capacity, fp_rate)
+        with replacing(path) as tmp_file:
+            tmp_file.write(BLOOM_HEADER.pack(
+                BLOOM_MAGIC, num_bits, num_hashes, 0, 0, 0, 0))
+            tmp_file.truncate(BLOOM_HEADER.size + (num_bits + 7) // 8)
+        return cls(path, writable=True)
+
+    @property
+    def count(self) -> int:
+        return BLOOM_HEADER.unpack_from(self._map, 0)[3]
+
+    @property
+    def source(self) -> tuple[int, int, int]:
+        """
+        Size, inode and checksum of the source file, as of the last
+        set_source().
+        """
+        return BLOOM_HEADER.unpack_from(self._map, 0)[4:]
+
+    def set_source(self, size: int, inode: int, checksum: int = 0) -> None:
+        """
+        Records how much of which source file has been added.
+        """
+        BLOOM_HEADER.pack_into(self._map, 0, BLOOM_MAGIC, self.num_bits,
+                               self.num_hashes, self.count, size, inode, checksum)
+
+    def add(self, item: bytes) -> None:
+        for bit in self._bits(item):
+            byte = BLOOM_HEADER.size + (bit >> 3)
+            self._map[byte] |= 1 << (bit & 7)
+        BLOOM_HEADER.pack_into(self._map, 0, BLOOM_MAGIC, self.num_bits,
+                               self.num_hashes, self.count + 1, *self.source)
+
+    def __contains__(self, item: bytes) -> bool:
+        for bit in self._bits(item):
+            if not self._map[BLOOM_HEADER.size + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        if self._map is not None:
+            if self.writable:
+                self._map.flush()
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _bits(self, item: bytes):
+        # Double hashing: k bit positions from two independent 64-bit hashes
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
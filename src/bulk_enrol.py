@@ -0,0 +1,149 @@
+import csv
+import json
+from collections import deque
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+from hash_pool import HashService
+from problem1c import Role
+from problem2c import get_all_unames
+from problem3ab import UNAME_TAKEN_MESSAGE, validate_uname, validate_passwds
+from user_store import NewUser, get_user_store
+
+
+class EnrolmentRow(NamedTuple):
+    line_num: int
+    uname: str
+    plaintext_passwd: str
+    roles: list[str]
+
+
+class EnrolmentFailure(NamedTuple):
+    line_num: int
+    uname: str
+    reason: str
+
+
+class EnrolmentReport(NamedTuple):
+    enrolled: list[str]
+    failures: list[EnrolmentFailure]
+
+
+def read_enrolment_rows(path: Path) -> Iterator[EnrolmentRow | EnrolmentFailure]:
+    """
+    Reads users to enrol from a CSV file (with a `username,password,roles`
+    header, roles comma-separated) or a JSONL file (one
+    `{"username": ..., "password": ..., "roles": [...]}` object per line),
+    depending on the file extension. Rows that can't be parsed are yielded as
+    failures.
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if Path(path).suffix == '.jsonl':
+            for line_num, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                    uname, plaintext_passwd, roles = row['username'], row['password'], row.get('roles', [])
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    yield EnrolmentFailure(line_num, '', f'Malformed row: {e}')
+                    continue
+                if not isinstance(uname, str) or not isinstance(plaintext_passwd, str):
+                    yield EnrolmentFailure(line_num, str(uname),
+                                           'Malformed row: username and password must be strings')
+                elif not isinstance(roles, list) or not all(isinstance(role, str) for role in roles):
+                    yield EnrolmentFailure(line_num, uname, 'Malformed row: roles must be a list of strings')
+                else:
+                    yield EnrolmentRow(line_num, uname, plaintext_passwd, roles)
+        else:
+            reader = csv.DictReader(file)
+            for row in reader:
+                line_num = reader.line_num
+                if row.get('username') is None or row.get('password') is None:
+                    yield EnrolmentFailure(line_num, '', 'Malformed row: missing username or password')
+                    continue
+                # Like in JSONL, roles are optional
+                roles_str = row.get('roles') or ''
+                roles = [role.strip()
+                         for role in roles_str.split(',') if role.strip()]
+                yield EnrolmentRow(line_num, row['username'], row['password'], roles)
+
+
+def hash_passwds(hash_service: HashService, plaintext_passwds: Iterable[str]) -> list[str]:
+    """
+    Hashes passwords on the hash service, in order. Only as many as its queue
+    holds are submitted at a time, so none are rejected as busy.
+    """
+    hash_strs: list[str] = []
+    pending: deque[Future] = deque()
+    for plaintext_passwd in plaintext_passwds:
+        if len(pending) >= hash_service.max_queue:
+            hash_strs.append(pending.popleft().result())
+        pending.append(hash_service.submit_hash(plaintext_passwd))
+    hash_strs += [future.result() for future in pending]
+    return hash_strs
+
+
+def bulk_enrol(path: Path, max_workers: int | None = None) -> EnrolmentReport:
+    """
+    Enrols every valid user in an enrolment file. Usernames are checked
+    against a set of existing usernames read in one pass (rather than a lookup
+    per row), passwords are hashed by a HashService on worker processes, and
+    all records are added to the user store in one batch (a single write per
+    flat file).
+    Usernames enrolled elsewhere while the passwords were hashed fail too, as
+    the store only adds users whose username is still free.
+
+    Returns:
+        The enrolled usernames and the rows that failed validation.
+    """
+    taken_unames = get_all_unames()
+    valid_roles = {role.value for role in Role}
+    rows: list[EnrolmentRow] = []
+    failures: list[EnrolmentFailure] = []
+
+    parsed = list(read_enrolment_rows(path))
+    # Passwords are validated together, so the weak password list is only
+    # gone through once
+    passwd_results = iter(validate_passwds((row.plaintext_passwd, row.uname) for row in parsed
+                                           if isinstance(row, EnrolmentRow)))
+
+    for row in parsed:
+        if isinstance(row, EnrolmentFailure):
+            failures.append(row)
+            continue
+
+        passwd_result = next(passwd_results)
+        result = validate_uname(row.uname, taken_unames)
+        if result is True:
+            result = passwd_result
+        if result is True:
+            invalid_roles = [
+                role for role in row.roles if role not in valid_roles]
+            if invalid_roles:
+                result = 'Unknown role(s): ' + ', '.join(invalid_roles)
+        if result is not True:
+            failures.append(EnrolmentFailure(row.line_num, row.uname, result))
+            continue
+
+        taken_unames.add(row.uname)  # Later duplicates in the file fail
+        rows.append(row)
+
+    if not rows:
+        return EnrolmentReport([], failures)
+
+    # Hashed on worker processes, within the same memory budget as logins
+    hash_service = HashService(max_workers, use_processes=True)
+    try:
+        hash_strs = hash_passwds(hash_service, (row.plaintext_passwd for row in rows))
+    finally:
+        hash_service.shutdown()
+
+    taken = set(get_user_store().add_users(NewUser(row.uname, hash_str, row.roles)
+                                           for row, hash_str in zip(rows, hash_strs)))
+    failures += [EnrolmentFailure(row.line_num, row.uname, UNAME_TAKEN_MESSAGE)
+                 for row in rows if row.uname in taken]
+    failures.sort(key=lambda failure: failure.line_num)
+
+    return EnrolmentReport([row.uname for row in rows if row.uname not in taken], failures)
+
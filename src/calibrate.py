@@ -0,0 +1,80 @@
+import json
+import os
+import statistics
+import time
+from pathlib import Path
+from typing import NamedTuple
+from argon2 import PasswordHasher
+from argon2 import Type as ArgonType
+from file_lock import replacing
+from problem2c import ARGON2_PARAMS_FILE, HASH_LENGTH, SALT_LENGTH
+
+CALIBRATION_PASSWD = 'asdfQWE123!'
+CALIBRATION_ROUNDS = 5  # Verifications timed per candidate, the median is used
+MAX_TIME_COST = 32
+
+
+class Calibration(NamedTuple):
+    time_cost: int
+    memory_cost_kib: int
+    parallelism: int
+    verify_ms: float
+    verifies_per_sec: float  # With every core verifying at once
+
+
+def time_verify(time_cost: int, memory_cost_kib: int, parallelism: int,
+                rounds: int = CALIBRATION_ROUNDS) -> float:
+    """
+    Times PasswordHasher.verify with the given parameters on this machine.
+
+    Returns:
+        The median verification latency in milliseconds.
+    """
+    hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost_kib, parallelism=parallelism,
+                            hash_len=HASH_LENGTH, salt_len=SALT_LENGTH, type=ArgonType.ID)
+    hash_str = hasher.hash(CALIBRATION_PASSWD)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.verify(hash_str, CALIBRATION_PASSWD)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate(target_ms: float, memory_cost_kib: int, parallelism: int,
+              min_verifies_per_sec: float | None = None) -> Calibration:
+    """
+    Picks the highest time cost at the given memory cost whose verification
+    latency stays within `target_ms`, and within the latency that still
+    sustains `min_verifies_per_sec` across every core, if given. Time cost
+    never drops below 1, so check the returned latency if the target was
+    unreachable.
+    """
+    num_cores = os.cpu_count() or 1
+    if min_verifies_per_sec:
+        target_ms = min(target_ms, num_cores * 1000 / min_verifies_per_sec)
+
+    best = None
+    for time_cost in range(1, MAX_TIME_COST + 1):
+        verify_ms = time_verify(time_cost, memory_cost_kib, parallelism)
+        if best is not None and verify_ms > target_ms:
+            break
+        best = Calibration(time_cost, memory_cost_kib, parallelism,
+                           verify_ms, num_cores * 1000 / verify_ms)
+        if verify_ms > target_ms:
+            break  # Even a single iteration is over the target
+    return best
+
+
+def save_calibration(calibration: Calibration, path: Path = ARGON2_PARAMS_FILE) -> None:
+    """
+    Saves the calibrated parameters where problem2c loads them from. Stored
+    hashes are migrated to them as users log in.
+    """
+    with replacing(path, 'w', encoding='utf-8') as params_file:
+        json.dump({
+            'time_cost': calibration.time_cost,
+            'memory_cost_kib': calibration.memory_cost_kib,
+            'parallelism': calibration.parallelism,
+        }, params_file, indent=4)
+        params_file.write('\n')
@@ -0,0 +1,81 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator
+
+# Lock paths this thread holds, with how many times and whether exclusively
+_held = threading.local()
+
+
+def lock_path(path: Path) -> Path:
+    """
+    Sidecar file that locks on `path` are taken on. Locking the data file
+    itself wouldn't survive it being rewritten and renamed into place.
+    """
+    path = Path(path)
+    return path.with_name(path.name + '.lock')
+
+
+@contextmanager
+def locked(path: Path, exclusive: bool = False) -> Iterator[None]:
+    """
+    Holds an fcntl (flock) lock on `path` across processes: shared for readers
+    of the file, exclusive for writers. Every acquisition opens its own file
+    description, so threads of one process exclude each other too. A thread
+    that already holds a lock on `path` just keeps it, e.g. a writer reading
+    the file under its exclusive lock, as long as it isn't a weaker one.
+
+    Raises:
+        RuntimeError: If the thread holds a shared lock on `path` and asks for
+        an exclusive one. flock can't upgrade atomically, so the lock would
+        have to be released first and others could get in between.
+    """
+    key = lock_path(path)
+    held = _held.__dict__.setdefault('locks', {})
+    if key in held:
+        count, held_exclusive = held[key]
+        if exclusive and not held_exclusive:
+            raise RuntimeError(f'Cannot upgrade a shared lock on {path} to an exclusive one')
+        held[key] = count + 1, held_exclusive
+        try:
+            yield
+        finally:
+            count, _ = held[key]
+            held[key] = count - 1, held_exclusive
+        return
+
+    fd = os.open(key, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        held[key] = 1, exclusive
+        try:
+            yield
+        finally:
+            del held[key]
+    finally:
+        os.close(fd)  # Releases the lock
+
+
+@contextmanager
+def replacing(path: Path, mode: str = 'wb', **open_args) -> Iterator[IO]:
+    """
+    Writes a new version of `path`: yields a temporary file beside it, and
+    renames that over `path` once the block exits without an exception, so
+    readers never see a partially written file. Every call gets its own
+    temporary file, so processes replacing `path` at once can't truncate each
+    other's.
+    """
+    import tempfile  # Not needed by most callers of locked()
+
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name + '.', suffix='.tmp', dir=path.parent)
+    try:
+        os.fchmod(fd, 0o644)
+        with open(fd, mode, **open_args) as tmp_file:
+            yield tmp_file
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,179 @@
+import os
+import threading
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Callable, Iterable
+from file_lock import locked
+
+# Longest a record waits for others to share its write and fsync with
+GROUP_COMMIT_MAX_DELAY = 0.002  # Seconds
+GROUP_COMMIT_MAX_RECORDS = 1000  # Commit right away once this many are pending
+
+
+class _Write:
+    def __init__(self, data: dict[Path, bytes] | None,
+                 prepare: Callable[[], dict[Path, bytes]] | None = None,
+                 keys: Iterable[str] | None = None):
+        self.data = data
+        self.prepare = prepare
+        self.keys = set(keys) if keys is not None else None  # None: could be any
+        self.error: Exception | None = None
+
+
+class _Group:
+    def __init__(self):
+        self.writes: list[_Write] = []
+        self.paths: set[Path] = set()
+        self.done = threading.Event()
+        self.error: Exception | None = None
+
+    @property
+    def num_writes(self) -> int:
+        return len(self.writes)
+
+
+class GroupCommitWriter:
+    """
+    Appends records to a fixed set of files with group commit: writes from
+    many threads are gathered for up to `max_delay` seconds, then each file
+    gets one write() and one fsync() for the whole group, under an exclusive
+    fcntl lock so other processes can't interleave with it. Callers block
+    until their records are durable.
+
+    Files are always written in the order given, holding every lock for the
+    whole group, so records written together (e.g. a user's roles and password
+    records) become visible to lock-taking readers together, and a crash can
+    only ever lose the later files' records.
+
+    write_if() lets a caller check the files' contents and append in one step,
+    while the locks are held, so nothing can be written in between.
+    """
+
+    def __init__(self, paths: list[Path], max_delay: float = GROUP_COMMIT_MAX_DELAY,
+                 max_records: int = GROUP_COMMIT_MAX_RECORDS, fsync: bool = True):
+        self.paths = [Path(path) for path in paths]
+        self.max_delay = max_delay
+        self.max_records = max_records
+        self.fsync = fsync
+
+        self.commits = 0
+        self.writes = 0
+
+        self._cond = threading.Condition()
+        self._group = _Group()
+        self._thread: threading.Thread | None = None
+        self._pid = None  # A forked child has to start its own thread
+
+    def write(self, data: dict[Path, bytes]) -> None:
+        """
+        Appends data to some of the files, returning once it is on disk.
+        """
+        data = self._check_paths(data)
+        if data:
+            self._submit(_Write(data))
+
+    def write_if(self, prepare: Callable[[], dict[Path, bytes]], keys: Iterable[str]) -> None:
+        """
+        Appends the data `prepare` returns, returning once it is on disk.
+        `prepare` is called on the writer's thread while it holds the exclusive
+        locks on every file, so it can read the files' current contents to
+        decide what to write, e.g. only the records for usernames not taken
+        yet. Records of earlier writes in the same group for any of `keys` are
+        appended before it's called.
+
+        Raises:
+            Whatever `prepare` raises.
+        """
+        write = _Write(None, prepare, keys)
+        self._submit(write)
+        if write.error is not None:
+            raise write.error
+
+    def stats(self) -> dict[str, int]:
+        return {'commits': self.commits, 'writes': self.writes}
+
+    def _check_paths(self, data: dict[Path, bytes]) -> dict[Path, bytes]:
+        data = {Path(path): chunk for path, chunk in data.items() if chunk}
+        for path in data:
+            if path not in self.paths:
+                raise ValueError(f'{path} is not written by this writer')
+        return data
+
+    def _submit(self, write: _Write) -> None:
+        with self._cond:
+            group = self._group
+            group.writes.append(write)
+            group.paths.update(write.data if write.data is not None else self.paths)
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+            self._cond.notify_all()
+
+        group.done.wait()
+        if group.error is not None:
+            raise group.error
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._group.num_writes)
+                # Give other writers a moment to join the group
+                self._cond.wait_for(lambda: self._group.num_writes >= self.max_records,
+                                    timeout=self.max_delay)
+                group, self._group = self._group, _Group()
+
+            try:
+                self._commit(group)
+            except Exception as e:
+                group.error = e
+            self.commits += 1
+            self.writes += group.num_writes
+            group.done.set()
+
+    def _commit(self, group: _Group) -> None:
+        paths = [path for path in self.paths if path in group.paths]
+        with ExitStack() as stack:
+            # Always taken in the same order, so writers can't deadlock
+            for path in paths:
+                stack.enter_context(locked(path, exclusive=True))
+
+            pending: dict[Path, list[bytes]] = {}
+            pending_keys: set[str] | None = set()  # None: could be any
+            for write in group.writes:
+                data = write.data
+                if write.prepare is not None:
+                    if pending and (pending_keys is None or pending_keys & write.keys):
+                        # Let prepare() see the records it may depend on
+                        self._append_pending(pending)
+                        pending, pending_keys = {}, set()
+                    try:
+                        data = self._check_paths(write.prepare())
+                    except Exception as e:
+                        write.error = e
+                        continue
+                if pending_keys is not None and write.keys is not None:
+                    pending_keys |= write.keys
+                else:
+                    pending_keys = None
+                for path, chunk in data.items():
+                    pending.setdefault(path, []).append(chunk)
+            self._append_pending(pending)
+
+    def _append_pending(self, pending: dict[Path, list[bytes]]) -> None:
+        for path in self.paths:
+            if path in pending:
+                self._append(path, b''.join(pending[path]))
+
+    def _append(self, path: Path, data: bytes) -> None:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import queue
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from problem2c import get_argon2_params, get_password_hasher
+
+# Share of physical memory Argon2 may use when no budget is given
+DEFAULT_MEMORY_BUDGET_SHARE = 0.25
+
+# Requests allowed to wait for a worker, per worker, before new ones are rejected
+DEFAULT_QUEUE_DEPTH_PER_WORKER = 8
+
+
+class HashServiceBusy(Exception):
+    """
+    Raised when the hash service's queue is full, so callers can shed load
+    (e.g. answer "try again later") instead of piling up behind it.
+    """
+
+
+def _hash(plaintext_passwd: str) -> str:
+    return get_password_hasher().hash(plaintext_passwd)
+
+
+def _verify(hash_str: str, plaintext_passwd: str) -> bool:
+    # raises VerifyMismatchError if verification fails
+    return get_password_hasher().verify(hash_str, plaintext_passwd)
+
+
+def _physical_memory_kib() -> int | None:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class HashService:
+    """
+    Runs Argon2 hashing and verification on a pool of worker threads (the
+    argon2-cffi bindings release the GIL) or processes, off the caller's
+    thread. Every hash allocates the Argon2 memory cost, so the number of hashes in
+    flight at once is capped by a memory budget; requests beyond that wait in
+    a bounded queue, and once the queue is full they're rejected with
+    HashServiceBusy.
+    """
+
+    def __init__(self, max_workers: int | None = None, memory_budget_kib: int | None = None,
+                 max_queue: int | None = None, use_processes: bool = False):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        memory_cost_kib = get_argon2_params().memory_cost_kib
+
+        if memory_budget_kib is None:
+            physical_memory_kib = _physical_memory_kib()
+            if physical_memory_kib is None:
+                memory_budget_kib = self.max_workers * memory_cost_kib
+            else:
+                memory_budget_kib = int(
+                    physical_memory_kib * DEFAULT_MEMORY_BUDGET_SHARE)
+        self.memory_budget_kib = memory_budget_kib
+        self.max_in_flight = max(
+            1, min(self.max_workers, memory_budget_kib // memory_cost_kib))
+        self.max_queue = max_queue or self.max_workers * DEFAULT_QUEUE_DEPTH_PER_WORKER
+
+        if use_processes:
+            self._executor: Executor = ProcessPoolExecutor(self.max_workers)
+        else:
+            self._executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix='argon2')
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self._queue: queue.Queue = queue.Queue(self.max_queue)
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.peak_queue_depth = 0
+
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name='argon2-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, fn, *args) -> Future:
+        """
+        Queues `fn(*args)` to run on the pool without blocking.
+
+        Raises:
+            HashServiceBusy if the queue is full.
+        """
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((future, fn, args))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise HashServiceBusy(
+                f'{self.max_queue} hash requests already queued') from None
+
+        with self._lock:
+            self.submitted += 1
+            self.peak_queue_depth = max(
+                self.peak_queue_depth, self._queue.qsize())
+        return future
+
+    def submit_hash(self, plaintext_passwd: str) -> Future:
+        return self.submit(_hash, plaintext_passwd)
+
+    def hash(self, plaintext_passwd: str) -> str:
+        return self.submit_hash(plaintext_passwd).result()
+
+    def verify(self, hash_str: str, plaintext_passwd: str) -> bool:
+        """
+        Same as PasswordHasher.verify, raises VerifyMismatchError if
+        verification fails.
+        """
+        return self.submit(_verify, hash_str, plaintext_passwd).result()
+
+    async def ahash(self, plaintext_passwd: str) -> str:
+        return await asyncio.wrap_future(self.submit_hash(plaintext_passwd))
+
+    async def averify(self, hash_str: str, plaintext_passwd: str) -> bool:
+        return await asyncio.wrap_future(self.submit(_verify, hash_str, plaintext_passwd))
+
+    def is_saturated(self) -> bool:
+        return self._queue.full()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'peak_queue_depth': self.peak_queue_depth,
+                'max_queue': self.max_queue,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self) -> None:
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown()
+
+    def _dispatch(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            # Wait for room in the memory budget before handing it to a worker
+            self._in_flight.acquire()
+            with self._lock:
+                self.in_flight += 1
+            try:
+                work = self._executor.submit(fn, *args)
+            except Exception as e:
+                self._done(None)
+                future.set_exception(e)
+                continue
+            work.add_done_callback(
+                lambda work, future=future: self._done(work, future))
+
+    def _done(self, work: Future | None, future: Future | None = None) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self._in_flight.release()
+
+        if work is not None:
+            exception = work.exception()
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(work.result())
+
+
+_hash_service: HashService | None = None
+_hash_service_lock = threading.Lock()
+
+
+def get_hash_service() -> HashService:
+    """
+    Gets the process-wide hash service, creating it on first use.
+    """
+    global _hash_service
+    with _hash_service_lock:
+        if _hash_service is None:
+            _hash_service = HashService()
+        return _hash_service
+
+
+def set_hash_service(service: HashService) -> None:
+    global _hash_service
+    with _hash_service_lock:
+        _hash_service = service
@@ -0,0 +1,258 @@
+"""
+Login storm load test: enrols a synthetic population, then logs users in
+through the headless login path from concurrent workers, mixing correct
+passwords, wrong passwords and unknown users, and reports throughput, latency
+percentiles, peak RSS and CPU use. Save a run and compare against it after a
+change, e.g.
+
+    python3 src/loadtest.py --users 100000 --workers 16 --output before.json
+    python3 src/loadtest.py --users 100000 --workers 16 --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+from audit import AuditLog, set_audit_log
+from benchmarks import GENERATOR_SEED, generate_user_store, synthetic_uname
+from hash_pool import HashService, HashServiceBusy, set_hash_service
+from problem4c import INVALID_CREDENTIALS_MESSAGE, login_user
+from throttle import LoginThrottle, LoginThrottled, set_login_throttle
+from user_store import set_user_store
+
+DEFAULT_USERS = 10_000
+DEFAULT_WORKERS = 8
+DEFAULT_DURATION = 10.0  # Seconds
+
+# Share of attempts with the right password, a wrong one, and an unknown username
+DEFAULT_MIX = (0.8, 0.15, 0.05)
+
+PASSWD = 'asdfQWE123!'  # Every synthetic user's password, see generate_user_store()
+WRONG_PASSWD = 'qwerASD456@'
+
+OUTCOMES = ('success', 'wrong_passwd', 'unknown_user', 'throttled', 'overloaded')
+
+
+class LoadTestResult(NamedTuple):
+    users: int
+    workers: int
+    duration_s: float
+    attempts: int
+    logins_per_sec: float
+    outcomes: dict[str, int]
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    peak_rss_mib: float
+    cpu_s: float
+    cpu_utilization: float  # Share of all cores kept busy
+
+
+def _percentile(timings: list[int], p: float) -> float:
+    if not timings:
+        return 0.0
+    return timings[min(len(timings) - 1, int(len(timings) * p))] / 1e6
+
+
+def _attempts(num_users: int, mix: tuple[float, float, float], seed: int):
+    """
+    Endless stream of (username, password) login attempts in the given mix.
+    """
+    rng = random.Random(seed)
+    correct, wrong, _ = mix
+    while True:
+        kind = rng.random() * sum(mix)
+        if kind < correct:
+            yield synthetic_uname(rng.randrange(num_users)), PASSWD
+        elif kind < correct + wrong:
+            yield synthetic_uname(rng.randrange(num_users)), WRONG_PASSWD
+        else:
+            yield f'nobody{rng.randrange(1_000_000):06d}', PASSWD
+
+
+def _worker(worker_id: int, num_users: int, mix: tuple[float, float, float], deadline: float,
+            max_attempts: int | None, timings: list[int], outcomes: dict[str, int]) -> None:
+    attempts = _attempts(num_users, mix, GENERATOR_SEED + worker_id)
+    source = f'loadtest-{worker_id}'
+    while time.perf_counter() < deadline and (max_attempts is None or len(timings) < max_attempts):
+        uname, passwd = next(attempts)
+        start = time.perf_counter_ns()
+        try:
+            result = login_user(uname, passwd, source)
+        except LoginThrottled:
+            outcome = 'throttled'
+        except HashServiceBusy:
+            outcome = 'overloaded'
+        else:
+            if not isinstance(result, str):
+                outcome = 'success'
+            elif result == INVALID_CREDENTIALS_MESSAGE:
+                outcome = 'unknown_user'
+            else:
+                outcome = 'wrong_passwd'
+        timings.append(time.perf_counter_ns() - start)
+        outcomes[outcome] += 1
+
+
+def _cpu_seconds() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)  # Hash worker processes
+    return (self_usage.ru_utime + self_usage.ru_stime
+            + children_usage.ru_utime + children_usage.ru_stime)
+
+
+def _peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux (bytes on macOS). Worker processes are
+    # only counted once they've exited, and the biggest one is reported.
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+
+
+def run_load_test(num_users: int = DEFAULT_USERS, num_workers: int = DEFAULT_WORKERS,
+                  duration: float = DEFAULT_DURATION, mix: tuple[float, float, float] = DEFAULT_MIX,
+                  max_attempts: int | None = None, hash_workers: int | None = None,
+                  use_processes: bool = False, throttle: bool = False) -> LoadTestResult:
+    """
+    Logs users in from `num_workers` threads for `duration` seconds, or until
+    each worker made `max_attempts` attempts.
+
+    The user store, hash service, login throttle and audit log are swapped for
+    throwaway ones, in a temporary directory. Unless `throttle` is set, the
+    login throttle only sheds load when the hash service is saturated, so
+    the run measures what one host can verify rather than the rate limits.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        store = generate_user_store(directory, num_users)
+        hash_service = HashService(hash_workers, use_processes=use_processes)
+        audit_log = AuditLog(directory / 'audit.jsonl')
+        set_user_store(store)
+        set_hash_service(hash_service)
+        set_audit_log(audit_log)
+        if throttle:
+            set_login_throttle(LoginThrottle(is_saturated=hash_service.is_saturated))
+        else:
+            unlimited = 1 << 62
+            set_login_throttle(LoginThrottle(
+                uname_burst=unlimited, source_burst=unlimited, lockout_threshold=unlimited,
+                is_saturated=hash_service.is_saturated))
+
+        try:
+            # Warm up the index and the hash workers outside the timings
+            login_user(synthetic_uname(0), PASSWD)
+
+            timings = [[] for _ in range(num_workers)]
+            outcomes = [dict.fromkeys(OUTCOMES, 0) for _ in range(num_workers)]
+            cpu_start = _cpu_seconds()
+            start = time.perf_counter()
+            workers = [threading.Thread(target=_worker, name=f'loadtest-{i}',
+                                        args=(i, num_users, mix, start + duration, max_attempts,
+                                              timings[i], outcomes[i]))
+                       for i in range(num_workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            hash_service.shutdown()  # So worker processes count towards the usage
+            cpu_s = _cpu_seconds() - cpu_start
+        finally:
+            audit_log.close()
+            store.close()
+
+    all_timings = sorted(timing for worker_timings in timings for timing in worker_timings)
+    total_outcomes = {outcome: sum(counts[outcome] for counts in outcomes) for outcome in OUTCOMES}
+    return LoadTestResult(
+        num_users, num_workers, elapsed, len(all_timings),
+        len(all_timings) / elapsed if elapsed else 0.0, total_outcomes,
+        _percentile(all_timings, 0.5), _percentile(all_timings, 0.95),
+        _percentile(all_timings, 0.99), all_timings[-1] / 1e6 if all_timings else 0.0,
+        _peak_rss_mib(), cpu_s, cpu_s / elapsed / (os.cpu_count() or 1) if elapsed else 0.0)
+
+
+def print_result(result: LoadTestResult, baseline: dict | None = None) -> None:
+    rows = [
+        ('logins/sec', f'{result.logins_per_sec:.1f}', 'logins_per_sec'),
+        ('p50 ms', f'{result.p50_ms:.1f}', 'p50_ms'),
+        ('p95 ms', f'{result.p95_ms:.1f}', 'p95_ms'),
+        ('p99 ms', f'{result.p99_ms:.1f}', 'p99_ms'),
+        ('max ms', f'{result.max_ms:.1f}', 'max_ms'),
+        ('peak RSS MiB', f'{result.peak_rss_mib:.1f}', 'peak_rss_mib'),
+        ('CPU s', f'{result.cpu_s:.1f}', 'cpu_s'),
+        ('CPU utilization', f'{result.cpu_utilization:.0%}', 'cpu_utilization'),
+    ]
+    print(f'{result.attempts} login attempts by {result.workers} worker(s) against '
+          f'{result.users} user(s) in {result.duration_s:.1f}s')
+    print('  '.join(f'{outcome}={count}' for outcome, count in result.outcomes.items()))
+    for label, value, field in rows:
+        line = f'{label:<18}{value:>12}'
+        if baseline is not None and baseline.get(field):
+            line += f'{getattr(result, field) / baseline[field]:>13.2f}x'
+        print(line)
+
+
+def save_result(result: LoadTestResult, path: Path) -> None:
+    with open(path, 'w', encoding='utf-8') as result_file:
+        json.dump({
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'result': result._asdict(),
+        }, result_file, indent=4)
+        result_file.write('\n')
+
+
+def load_baseline(path: Path) -> dict:
+    with open(path, 'r', encoding='utf-8') as result_file:
+        return json.load(result_file)['result']
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                        help='synthetic users to enrol (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='concurrent login workers (default: %(default)s)')
+    parser.add_argument('--duration', type=float,
+                        help=f'seconds to run for (default: {DEFAULT_DURATION:g}, or until '
+                             f'--attempts are made)')
+    parser.add_argument('--attempts', type=int,
+                        help='stop each worker after this many attempts instead')
+    parser.add_argument('--mix', type=float, nargs=3, default=DEFAULT_MIX,
+                        metavar=('CORRECT', 'WRONG', 'UNKNOWN'),
+                        help='relative shares of correct passwords, wrong passwords and '
+                             'unknown users (default: %(default)s)')
+    parser.add_argument('--hash-workers', type=int,
+                        help='Argon2 workers (default: one per CPU)')
+    parser.add_argument('--processes', action='store_true',
+                        help='hash on worker processes instead of threads')
+    parser.add_argument('--throttle', action='store_true',
+                        help='apply the default login rate limits and lockouts')
+    parser.add_argument('--output', type=Path, help='save the result as JSON')
+    parser.add_argument('--compare', type=Path, help='JSON result of a previous run to compare with')
+    args = parser.parse_args(argv)
+    if any(share < 0 for share in args.mix) or not sum(args.mix):
+        parser.error('--mix shares must be non-negative and not all zero')
+
+    duration = args.duration
+    if duration is None:
+        duration = float('inf') if args.attempts else DEFAULT_DURATION
+    result = run_load_test(args.users, args.workers, duration, tuple(args.mix),
+                           args.attempts, args.hash_workers, args.processes, args.throttle)
+    print_result(result, load_baseline(args.compare) if args.compare else None)
+    if args.output:
+        save_result(result, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,134 @@
-from problem3ab import enrol_user_cli
+"""
+Interactive enrolment and login menu, or, given a subcommand, the same without
+any prompts for scripts. Run `python3 src/main.py --help` from the project root
+for the subcommands.
 
+Modules are imported by the commands that need them, so e.g. `check-authz`
+never imports argon2 or questionary.
+"""
+import argparse
+import sys
+from pathlib import Path
 
-if __name__ == '__main__':
+# Budget for the imports of `check-authz`, checked by the unit tests
+CHECK_AUTHZ_IMPORT_BUDGET_MS = 150
+
+# Exit statuses
+EXIT_OK = 0
+EXIT_FAILED = 1  # Invalid input, failed login, unauthorized, or problems found
+EXIT_UNKNOWN = 2  # Unknown user or operation
+
+
+def read_passwd(args: argparse.Namespace, prompt: str = 'Password: ') -> str:
+    if args.passwd_stdin:
+        return sys.stdin.readline().rstrip('\n')
+    import getpass
+    return getpass.getpass(prompt)
+
+
+def enrol_cmd(args: argparse.Namespace) -> int:
+    from problem1c import Role
+    from problem2c import get_password_hasher
+    from problem3ab import UNAME_TAKEN_MESSAGE, validate_passwd, validate_uname
+    from user_store import NewUser, get_user_store
+
+    valid_roles = {role.value for role in Role}
+    invalid_roles = [role for role in args.roles if role not in valid_roles]
+    if invalid_roles:
+        print('Unknown role(s): ' + ', '.join(invalid_roles), file=sys.stderr)
+        return EXIT_UNKNOWN
+
+    result = validate_uname(args.uname)
+    if result is True:
+        plaintext_passwd = read_passwd(args)
+        result = validate_passwd(plaintext_passwd, args.uname)
+    if result is not True:
+        print(result, file=sys.stderr)
+        return EXIT_FAILED
+
+    if get_user_store().add_users(
+            [NewUser(args.uname, get_password_hasher().hash(plaintext_passwd), args.roles)]):
+        print(UNAME_TAKEN_MESSAGE, file=sys.stderr)  # Enrolled by someone else meanwhile
+        return EXIT_FAILED
+    print(f'Enrolled {args.uname}')
+    return EXIT_OK
+
+
+def login_cmd(args: argparse.Namespace) -> int:
+    from hash_pool import HashServiceBusy
+    from problem4c import LOGIN_BUSY_MESSAGE, login_user, print_login_summary
+    from throttle import LoginThrottled
+
+    try:
+        roles = login_user(args.uname, read_passwd(args))
+    except LoginThrottled as e:
+        print(e.message, file=sys.stderr)
+        return EXIT_FAILED
+    except HashServiceBusy:
+        print(LOGIN_BUSY_MESSAGE, file=sys.stderr)
+        return EXIT_FAILED
+    if isinstance(roles, str):
+        print(roles, file=sys.stderr)
+        return EXIT_FAILED
+    print_login_summary(args.uname, roles)
+    return EXIT_OK
+
+
+def check_authz_cmd(args: argparse.Namespace) -> int:
+    from audit import audit_authorization
+    from problem1c import Operation, is_authorized
+    from user_store import get_user_store
+
+    # By name (VIEW_OWN_ACCOUNT_BALANCE) or description (View your own account balance)
+    operation = Operation.__members__.get(args.operation.upper().replace('-', '_'))
+    if operation is None:
+        operation = next((operation for operation in Operation
+                          if operation.value.lower() == args.operation.lower()), None)
+    if operation is None:
+        print(f'Unknown operation: {args.operation}', file=sys.stderr)
+        return EXIT_UNKNOWN
+
+    roles = get_user_store().get_roles(args.uname)
+    if roles is None:
+        print(f'Unknown user: {args.uname}', file=sys.stderr)
+        return EXIT_UNKNOWN
+    authorized = is_authorized(roles, operation)
+    audit_authorization(args.uname, operation, authorized)
+    if authorized:
+        print('authorized')
+        return EXIT_OK
+    print('denied')
+    return EXIT_FAILED
+
+
+def verify_store_cmd(args: argparse.Namespace) -> int:
+    from store_verifier import export_format, verify_user_store
+    from user_store import get_user_store
+
+    if args.export is not None:
+        try:
+            export_format(args.export)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return EXIT_FAILED
+        if args.export.exists():
+            print(f'{args.export} already exists', file=sys.stderr)
+            return EXIT_FAILED
+
+    report = verify_user_store(get_user_store(), args.workers, args.export,
+                               max_reported_problems=args.max_problems)
+    for problem in report.problems:
+        print(problem)
+    if report.num_problems > len(report.problems):
+        print(f'... and {report.num_problems - len(report.problems)} more')
+    print(f'Checked {report.num_users} user(s), found {report.num_problems} problem(s)'
+          + ''.join(f', {count} {kind}' for kind, count in sorted(report.problem_counts.items())))
+    if args.export is not None:
+        print(f'Exported {report.num_exported} user(s) to {args.export}')
+    return EXIT_FAILED if report.num_problems else EXIT_OK
+
+
+def menu() -> None:
     import questionary
     from problem3ab import enrol_user_cli
     from problem4c import login_user_cli
@@ -21,3 +148,52 @@ if __name__ == '__main__':
             login_user_cli()
         elif option == QUIT_OPTION:
             break
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    enrol_parser = subparsers.add_parser(
+        'enrol', help='enrol a user, reading their password from the terminal or stdin')
+    enrol_parser.add_argument('uname', metavar='username')
+    enrol_parser.add_argument('roles', nargs='*', metavar='role',
+                              help='e.g. "Client" "Premium Client"')
+    enrol_parser.add_argument('--password-stdin', dest='passwd_stdin', action='store_true',
+                              help='read the password from the first line of stdin')
+    enrol_parser.set_defaults(func=enrol_cmd)
+
+    login_parser = subparsers.add_parser(
+        'login', help="log a user in and list their authorized operations")
+    login_parser.add_argument('uname', metavar='username')
+    login_parser.add_argument('--password-stdin', dest='passwd_stdin', action='store_true',
+                              help='read the password from the first line of stdin')
+    login_parser.set_defaults(func=login_cmd)
+
+    check_authz_parser = subparsers.add_parser(
+        'check-authz', help='check if a user may perform an operation right now (exit status 0 if so)')
+    check_authz_parser.add_argument('uname', metavar='username')
+    check_authz_parser.add_argument('operation',
+                                    help='name (e.g. VIEW_OWN_ACCOUNT_BALANCE) or description')
+    check_authz_parser.set_defaults(func=check_authz_cmd)
+
+    verify_parser = subparsers.add_parser(
+        'verify-store', help='check every user record for corruption, optionally exporting them')
+    verify_parser.add_argument('--workers', type=int,
+                               help='processes checking records (default: one per CPU)')
+    verify_parser.add_argument('--export', type=Path, metavar='PATH',
+                               help='also export every user to a new .jsonl or SQLite (.db) file')
+    verify_parser.add_argument('--max-problems', type=int, default=1000,
+                               help='problems to list, the rest are counted (default: %(default)s)')
+    verify_parser.set_defaults(func=verify_store_cmd)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        menu()
+        return EXIT_OK
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
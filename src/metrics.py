@@ -0,0 +1,267 @@
+"""
+Counters and latency histograms for the login and authorization paths, with a
+Prometheus text format exporter.
+
+Instrumentation is off unless the AUTH_METRICS environment variable is set
+(e.g. AUTH_METRICS=1) when the modules are imported. While it is off, `timed`
+hands back the undecorated function, `Histogram.time` is a shared no-op, and
+call sites skip their counters behind `if metrics.ENABLED`, so there is
+nothing to pay.
+"""
+import functools
+import os
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+from file_lock import replacing
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+ENABLED = os.environ.get('AUTH_METRICS', '') not in ('', '0')
+
+# Upper bounds in seconds, from cache hits up to slow Argon2 verifications
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_NULL_TIMER = nullcontext()
+
+
+def _label_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted(labels.items()))
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def _format_labels(label_key: tuple[tuple[str, str], ...]) -> str:
+    if not label_key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in label_key) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(
+                    f'{self.name}{_format_labels(key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Label key -> [per-bucket counts (last one is +Inf), sum]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_key(labels)
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(_label_key(labels))
+        return sum(series[0]) if series else 0
+
+    def time(self, **labels: str):
+        """
+        Context manager timing its body into this histogram.
+        """
+        return _Timer(self, labels) if ENABLED else _NULL_TIMER
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(
+                        f'{self.name}_bucket{_format_labels(key + (("le", le),))} {cumulative}')
+                lines.append(
+                    f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+                lines.append(
+                    f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() -
+                               self.start, **self.labels)
+        return False
+
+
+_metrics: dict[str, Counter | Histogram] = {}
+_metrics_lock = threading.Lock()
+
+
+def _register(metric_type: type, name: str, *args):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = metric_type(name, *args)
+        elif not isinstance(metric, metric_type):
+            raise ValueError(
+                f'{name} is already registered as a {type(metric).__name__}')
+        return metric
+
+
+def counter(name: str, help: str) -> Counter:
+    """
+    Get the counter registered under `name`, registering it if needed.
+    """
+    return _register(Counter, name, help)
+
+
+def histogram(name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    """
+    Get the histogram registered under `name`, registering it if needed.
+    """
+    return _register(Histogram, name, help, buckets)
+
+
+def timed(name: str, help: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator recording how long each call to a function (or coroutine
+    function) takes in the histogram `name`. Returns the function untouched
+    while metrics are disabled.
+    """
+    def decorator(fn: Callable) -> Callable:
+        if not ENABLED:
+            return fn
+        import inspect  # Only needed once metrics are on, like http.server below
+        latency = histogram(name, help)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    latency.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                latency.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format.
+    """
+    with _metrics_lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path: Path) -> None:
+    """
+    Writes the metrics to a file atomically, e.g. for node_exporter's
+    textfile collector.
+    """
+    with replacing(path, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(render())
+
+
+def start_metrics_server(host: str = '127.0.0.1', port: int = 9100) -> 'ThreadingHTTPServer':
+    """
+    Serves the metrics at http://host:port/metrics from a background thread.
+    """
+    # Imported here, it's slow to import and most processes never serve metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would drown out everything else
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever,
+                     name='metrics-server', daemon=True).start()
+    return server
+
+
+def start_metrics_writer(path: Path, interval: float = 15.0) -> threading.Event:
+    """
+    Rewrites the metrics file every `interval` seconds from a background
+    thread.
+
+    Returns:
+        An event that stops the writer once set.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            write_metrics(path)
+        write_metrics(path)
+
+    threading.Thread(target=run, name='metrics-writer', daemon=True).start()
+    return stop
@@ -0,0 +1,179 @@
+import json
+from pathlib import Path
+from typing import Callable, Iterable, NamedTuple
+
+# Defaults, used for any rule the policy file doesn't set
+PASSWD_MIN_LEN = 8
+PASSWD_MAX_LEN = 12
+SPECIAL_CHARACTERS = '!@#$%*&'
+
+# Character classes, as bits of a password's class mask
+SPACE = 1
+UPPER = 2
+LOWER = 4
+DIGIT = 8
+SPECIAL = 16
+
+RETRY = ' Backspace and choose again.'
+
+
+class Violation(NamedTuple):
+    rule: str
+    message: str
+
+
+class PasswdPolicy:
+    """
+    Password rules compiled into a character class table. A password's
+    distinct characters are looked up in the table once each and OR'ed into a
+    class mask, which answers every "must (not) contain" rule at once.
+    Violations are reported in a fixed order: spaces, upper-case, lower-case,
+    digit, special character, length, username, weak.
+    """
+
+    def __init__(self, min_len: int = PASSWD_MIN_LEN, max_len: int = PASSWD_MAX_LEN,
+                 special_characters: str = SPECIAL_CHARACTERS, require_upper: bool = True,
+                 require_lower: bool = True, require_digit: bool = True,
+                 require_special: bool = True, allow_spaces: bool = False,
+                 allow_uname: bool = False, reject_weak: bool = True):
+        if min_len > max_len:
+            raise ValueError(f'min_len ({min_len}) is greater than max_len ({max_len})')
+        self.min_len = min_len
+        self.max_len = max_len
+        self.special_characters = special_characters
+        self.allow_uname = allow_uname
+        self.reject_weak = reject_weak
+
+        # (class, set means a violation, rule, message), in reporting order
+        self._class_rules = []
+        if not allow_spaces:
+            self._class_rules.append((SPACE, True, 'spaces',
+                                      # The repeated retry hint is what users have always seen
+                                      'Passwords must not contain spaces!' + RETRY + RETRY))
+        if require_upper:
+            self._class_rules.append((UPPER, False, 'upper',
+                                      'Passwords must contain at least one upper-case letter!' + RETRY))
+        if require_lower:
+            self._class_rules.append((LOWER, False, 'lower',
+                                      'Passwords must contain at least one lower-case letter!' + RETRY))
+        if require_digit:
+            self._class_rules.append((DIGIT, False, 'digit',
+                                      'Passwords must contain at least one numerical digit!' + RETRY))
+        if require_special:
+            self._class_rules.append((SPECIAL, False, 'special',
+                                      'Passwords must contain at least one special character from the following: '
+                                      + ', '.join(special_characters) + '.' + RETRY))
+        self._length_message = f'Passwords must be {min_len}-{max_len} characters long!' + RETRY
+
+        self._char_classes = {chr(code): self._classify(chr(code)) for code in range(128)}
+        for char in special_characters:
+            self._char_classes[char] = self._classify(char)
+
+    @classmethod
+    def from_dict(cls, rules: dict) -> 'PasswdPolicy':
+        """
+        Makes a policy from a dict of rules (the constructor's arguments).
+        Raises ValueError for unknown rules.
+        """
+        try:
+            return cls(**rules)
+        except TypeError as e:
+            raise ValueError(f'Invalid password policy: {e}') from e
+
+    def _classify(self, char: str) -> int:
+        classes = 0
+        if char == ' ':
+            classes |= SPACE
+        if char.isupper():
+            classes |= UPPER
+        if char.islower():
+            classes |= LOWER
+        if char.isdigit():
+            classes |= DIGIT
+        if char in self.special_characters:
+            classes |= SPECIAL
+        return classes
+
+    def classes(self, passwd: str) -> int:
+        """
+        Get the mask of the character classes found in a password.
+        """
+        char_classes = self._char_classes
+        mask = 0
+        for char in set(passwd):
+            classes = char_classes.get(char)
+            if classes is None:
+                classes = self._classify(char)  # Non-ASCII
+            mask |= classes
+        return mask
+
+    def check(self, passwd: str, uname: str | None = None,
+              is_weak: Callable[[str], bool] | None = None) -> list[Violation]:
+        """
+        Checks a password against every rule. The weak password rule is only
+        checked if `is_weak` is given.
+
+        Returns:
+            The violated rules, empty if the password is valid.
+        """
+        violations = self._check_local(passwd, uname, self.classes(passwd))
+        if self.reject_weak and is_weak is not None and is_weak(passwd):
+            violations.append(self._weak_violation())
+        return violations
+
+    def check_many(self, candidates: Iterable[tuple[str, str | None]],
+                   find_weak: Callable[[set[str]], set[str]] | None = None) -> list[list[Violation]]:
+        """
+        Checks many (password, username) pairs at once. Repeated passwords
+        are classified once, and `find_weak` is asked about all of the
+        distinct passwords in one call, e.g. for a single pass over the weak
+        password list.
+
+        Returns:
+            The violated rules of each pair, in order.
+        """
+        candidates = list(candidates)
+        class_masks = {}
+        for passwd, _ in candidates:
+            if passwd not in class_masks:
+                class_masks[passwd] = self.classes(passwd)
+
+        weak_passwds = set()
+        if self.reject_weak and find_weak is not None:
+            weak_passwds = find_weak(set(class_masks))
+
+        results = []
+        for passwd, uname in candidates:
+            violations = self._check_local(passwd, uname, class_masks[passwd])
+            if passwd in weak_passwds:
+                violations.append(self._weak_violation())
+            results.append(violations)
+        return results
+
+    def _check_local(self, passwd: str, uname: str | None, mask: int) -> list[Violation]:
+        violations = [Violation(rule, message) for char_class, forbidden, rule, message in self._class_rules
+                      if bool(mask & char_class) == forbidden]
+        if not self.min_len <= len(passwd) <= self.max_len:
+            violations.append(Violation('length', self._length_message))
+        if not self.allow_uname and uname is not None and passwd == uname:
+            violations.append(Violation(
+                'uname', 'Passwords cannot be the same as your username!' + RETRY))
+        return violations
+
+    @staticmethod
+    def _weak_violation() -> Violation:
+        return Violation('weak', 'Password too weak!' + RETRY)
+
+
+def load_passwd_policy(path: Path) -> PasswdPolicy:
+    """
+    Loads a password policy from a JSON file of rules (see PasswdPolicy),
+    falling back to the defaults for any that aren't set, or for all of them
+    if the file doesn't exist.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as policy_file:
+            rules = json.load(policy_file)
+    except FileNotFoundError:
+        rules = {}
+    return PasswdPolicy.from_dict(rules)
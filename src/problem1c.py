@@ -1,6 +1,10 @@
 import datetime
+import threading
 from enum import Enum
 from typing import Set, Tuple
+from rbac_policy import RbacPolicy, RbacPolicyFile
+from role_schedule import TimeWindow, RoleSchedule
+import metrics
 
 
 class Operation(Enum):
@@ -67,40 +71,153 @@ ROLE_ACTIVE_TIMES: dict[Role, Tuple[datetime.time, datetime.time]] = {
     Role.TELLER: (BUSINESS_HOURS_START, BUSINESS_HOURS_END)
 }
 
+# Full schedule for each role. Roles are active every day within their
+# ROLE_ACTIVE_TIMES window by default, but a role can be given several
+# windows, restricted to some weekdays (e.g. role_schedule.WEEKDAYS), run
+# overnight (end before start) or skip HOLIDAYS.
+ROLE_ACTIVE_WINDOWS: dict[Role, list[TimeWindow]] = {
+    role: [TimeWindow(start_time, end_time)]
+    for role, (start_time, end_time) in ROLE_ACTIVE_TIMES.items()
+}
+
+HOLIDAYS: Set[datetime.date] = set()
+
+
+# Roles each role inherits the operations of, so e.g. a Premium Client only
+# needs the Premium Client role. Like its own, a role is denied while any
+# role it inherits from is inactive. More can be added in rbac_policy.json.
+ROLE_INHERITANCE: dict[Role, Set[Role]] = {
+    Role.PREMIUM_CLIENT: {Role.CLIENT}
+}
+
+# Bit flags for each operation and role
+OPERATION_BITS: dict[Operation, int] = {
+    operation: 1 << i for i, operation in enumerate(Operation)}
+ROLE_BITS: dict[Role, int] = {role: 1 << i for i, role in enumerate(Role)}
+
+NUM_ROLE_COMBINATIONS = 1 << len(Role)
+
+# The policy above, compiled. Anything set in the RBAC policy file overrides it,
+# and changes to the file are picked up without a restart.
+DEFAULT_RBAC_POLICY = RbacPolicy(Role, Operation, AUTHORIZATION_MATRIX, ROLE_INHERITANCE,
+                                 ROLE_ACTIVE_WINDOWS, HOLIDAYS)
+ROLE_SCHEDULE = DEFAULT_RBAC_POLICY.schedule
+
+# Kept in user_store.DATA_DIR, with the other settings files
+RBAC_POLICY_FILE_NAME = 'rbac_policy.json'
+
+AUTHORIZATION_DECISIONS = metrics.counter(
+    'auth_authorization_decisions_total', 'Authorization decisions by result')
+
+_rbac_policy_file: RbacPolicyFile | None = None
+_rbac_policy_file_lock = threading.Lock()
+
+
+def get_rbac_policy_file() -> RbacPolicyFile:
+    """
+    Gets the process-wide RBAC policy file, loading it on first use.
+    """
+    global _rbac_policy_file
+    with _rbac_policy_file_lock:
+        if _rbac_policy_file is None:
+            from user_store import DATA_DIR  # user_store imports this module
+            _rbac_policy_file = RbacPolicyFile(DATA_DIR / RBAC_POLICY_FILE_NAME, DEFAULT_RBAC_POLICY)
+        return _rbac_policy_file
 
+
+def set_rbac_policy_file(policy_file: RbacPolicyFile) -> None:
+    global _rbac_policy_file
+    with _rbac_policy_file_lock:
+        _rbac_policy_file = policy_file
+
+
+def get_rbac_policy() -> RbacPolicy:
+    """
+    Get the RBAC policy in effect, reloaded if its file changed.
+    """
+    policy_file = _rbac_policy_file  # No lock once it's loaded
+    if policy_file is None:
+        policy_file = get_rbac_policy_file()
+    return policy_file.get()
+
+
+def roles_to_mask(roles: Set[Role]) -> int:
+    roles_mask = 0
+    for role in roles:
+        roles_mask |= ROLE_BITS[role]
+    return roles_mask
+
+
+@metrics.timed('auth_authorization_seconds', 'Time spent working out authorized operations')
 def get_authorized_operations(roles: Set[Role]) -> Set[Operation]:
     """
     Get the complete set of allowable operations, i.e., the union of operations
-    associated with each active role (multi-role composition). By default, a
-    user has no authorized_operations.
+    associated with each active role (multi-role composition) and the roles
+    they inherit from. By default, a user has no authorized_operations.
     """
+    policy = get_rbac_policy()
+    roles_mask = roles_to_mask(roles)
+
     # Completely deny system access if a single role is inactive
-    for role in roles:
-        if not is_active(role):
-            return set()
+    if policy.expanded_masks[roles_mask] & ~policy.schedule.active_mask():
+        if metrics.ENABLED:
+            AUTHORIZATION_DECISIONS.inc(result='denied_inactive_role')
+        return set()
+    if metrics.ENABLED:
+        AUTHORIZATION_DECISIONS.inc(result='granted')
 
     # Grant permissions (union of all operations associated with each role)
-    authorized_operations: Set[Operation] = set()
-    for role in roles:
-        authorized_operations.update(AUTHORIZATION_MATRIX[role])
+    return set(policy.permission_sets[roles_mask])
 
-    return authorized_operations
+
+def is_authorized(roles: Set[Role], operation: Operation) -> bool:
+    """
+    Check if a user with the given roles may perform an operation right now,
+    following the same rules as get_authorized_operations.
+    """
+    policy = get_rbac_policy()
+    roles_mask = roles_to_mask(roles)
+    if policy.expanded_masks[roles_mask] & ~policy.schedule.active_mask():
+        return False
+    return bool(policy.permission_masks[roles_mask] & OPERATION_BITS[operation])
+
+
+def get_active_roles_mask() -> int:
+    """
+    Get the mask of every role that is currently active. The mask is cached
+    by the schedule until the next time a role is activated or deactivated.
+    """
+    return get_rbac_policy().schedule.active_mask()
 
 
 def is_active(role: Role) -> bool:
     """
     Check if a role (and its associated permissions) is currently active, i.e.,
     if a user with the specified role should have system access at this time.
+    A role is inactive while any role it inherits from is.
     """
-    start_time, end_time = ROLE_ACTIVE_TIMES[role]
-    curr_time = datetime.datetime.now().time()
-    return curr_time >= start_time and curr_time <= end_time
+    policy = get_rbac_policy()
+    return not policy.closure_masks[role] & ~policy.schedule.active_mask()
 
 
 if __name__ == "__main__":
     import unittest
+    import json
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    from pathlib import Path
     from unittest.mock import patch
-    import datetime as real_datetime
+
+    # Keep the records and audit log the tests write out of the project root
+    test_data_dir = tempfile.TemporaryDirectory()
+    os.environ['AUTH_DATA_DIR'] = test_data_dir.name
+
+    from main import CHECK_AUTHZ_IMPORT_BUDGET_MS
+
+    def at(hour: int, minute: int, second: int) -> datetime.datetime:
+        return datetime.datetime(2026, 10, 19, hour, minute, second)  # A Monday
 
     class TestAccessControl(unittest.TestCase):
         def test_single_role_operations(self):
@@ -152,9 +269,9 @@ if __name__ == "__main__":
             }
             self.assertEqual(actual, expected)
 
-        @patch('__main__.datetime.datetime')
-        def test_active_role(self, mock_datetime):
-            mock_datetime.now.return_value.time.return_value = real_datetime.time(
+        @patch.object(ROLE_SCHEDULE, 'clock')
+        def test_active_role(self, mock_clock):
+            mock_clock.return_value = at(
                 9, 0, 0)  # 9:00:00 am
             actual = get_authorized_operations({Role.EMPLOYEE, Role.TELLER})
             expected = {
@@ -163,7 +280,7 @@ if __name__ == "__main__":
             }
             self.assertEqual(actual, expected)
 
-            mock_datetime.now.return_value.time.return_value = real_datetime.time(
+            mock_clock.return_value = at(
                 12, 0, 0)  # 12:00:00 pm
             actual = get_authorized_operations({Role.EMPLOYEE, Role.TELLER})
             expected = {
@@ -172,7 +289,7 @@ if __name__ == "__main__":
             }
             self.assertEqual(actual, expected)
 
-            mock_datetime.now.return_value.time.return_value = real_datetime.time(
+            mock_clock.return_value = at(
                 17, 0, 0)  # 5:00:00 pm
             actual = get_authorized_operations({Role.EMPLOYEE, Role.TELLER})
             expected = {
@@ -181,24 +298,170 @@ if __name__ == "__main__":
             }
             self.assertEqual(actual, expected)
 
-        @patch('__main__.datetime.datetime')
-        def test_inactive_role(self, mock_datetime):
-            mock_datetime.now.return_value.time.return_value = real_datetime.time(
+        def test_compiled_matrix(self):
+            # Every role combination matches the union of the matrix entries
+            # of the roles and every role they inherit from
+            def inherited(role):
+                return {role}.union(*(inherited(parent) for parent in ROLE_INHERITANCE.get(role, ())))
+
+            for roles_mask in range(NUM_ROLE_COMBINATIONS):
+                roles = {role for role, bit in ROLE_BITS.items()
+                         if roles_mask & bit}
+                expected = set()
+                for role in set().union(*(inherited(role) for role in roles)):
+                    expected.update(AUTHORIZATION_MATRIX[role])
+                self.assertEqual(set(DEFAULT_RBAC_POLICY.permission_sets[roles_mask]), expected)
+
+        @patch.object(ROLE_SCHEDULE, 'clock')
+        def test_is_authorized(self, mock_clock):
+            mock_clock.return_value = at(
+                12, 0, 0)  # 12:00:00 pm
+            self.assertTrue(is_authorized(
+                {Role.CLIENT}, Operation.VIEW_OWN_ACCOUNT_BALANCE))
+            self.assertFalse(is_authorized(
+                {Role.CLIENT}, Operation.VIEW_ANY_ACCOUNT_BALANCE))
+            self.assertTrue(is_authorized(
+                {Role.EMPLOYEE, Role.TELLER}, Operation.VIEW_ANY_ACCOUNT_BALANCE))
+            self.assertFalse(is_authorized(
+                set(), Operation.VIEW_OWN_ACCOUNT_BALANCE))
+
+            mock_clock.return_value = at(
+                20, 0, 0)  # 8:00:00 pm
+            self.assertFalse(is_authorized(
+                {Role.EMPLOYEE, Role.TELLER}, Operation.VIEW_ANY_ACCOUNT_BALANCE))
+
+        @patch.object(ROLE_SCHEDULE, 'clock')
+        def test_inactive_role(self, mock_clock):
+            mock_clock.return_value = at(
                 8, 59, 59)  # 8:59:59 am
             actual = get_authorized_operations({Role.EMPLOYEE, Role.TELLER})
             expected = set()
             self.assertEqual(actual, expected)
 
-            mock_datetime.now.return_value.time.return_value = real_datetime.time(
+            mock_clock.return_value = at(
                 20, 0, 0)  # 8:00:00 pm
             actual = get_authorized_operations({Role.EMPLOYEE, Role.TELLER})
             expected = set()
             self.assertEqual(actual, expected)
 
-            mock_datetime.now.return_value.time.return_value = real_datetime.time(
+            mock_clock.return_value = at(
                 17, 0, 1)  # 5:00:01 pm
             actual = get_authorized_operations({Role.EMPLOYEE, Role.TELLER})
             expected = set()
             self.assertEqual(actual, expected)
 
+        @patch.object(ROLE_SCHEDULE, 'clock')
+        def test_role_inheritance(self, mock_clock):
+            mock_clock.return_value = at(
+                12, 0, 0)  # 12:00:00 pm
+            self.assertEqual(get_authorized_operations({Role.PREMIUM_CLIENT}),
+                             get_authorized_operations({Role.CLIENT, Role.PREMIUM_CLIENT}))
+            self.assertFalse(is_authorized(
+                {Role.TELLER}, Operation.VIEW_ANY_ACCOUNT_BALANCE))
+
+            # Inherited roles are denied along with the role inheriting them
+            policy = RbacPolicy(Role, Operation, AUTHORIZATION_MATRIX, {Role.EMPLOYEE: {Role.TELLER}},
+                                ROLE_ACTIVE_WINDOWS, HOLIDAYS)
+            employee_mask = ROLE_BITS[Role.EMPLOYEE]
+            self.assertEqual(policy.permission_sets[employee_mask],
+                             AUTHORIZATION_MATRIX[Role.EMPLOYEE] | AUTHORIZATION_MATRIX[Role.TELLER])
+            self.assertFalse(policy.expanded_masks[employee_mask] & ~policy.schedule.active_mask(at(12, 0, 0)))
+            self.assertTrue(policy.expanded_masks[employee_mask] & ~policy.schedule.active_mask(at(20, 0, 0)))
+
+        def test_rbac_policy_file(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = Path(tmp_dir) / 'rbac_policy.json'
+                policy_file = RbacPolicyFile(path, DEFAULT_RBAC_POLICY, check_interval=0)
+                self.assertIs(policy_file.get(), DEFAULT_RBAC_POLICY)
+
+                # Changes are picked up, anything left out keeps its default
+                path.write_text(json.dumps({'roles': {
+                    'Client': {'operations': ['VIEW_OWN_ACCOUNT_BALANCE']},
+                    'Teller': {'inherits': ['Client'], 'active': [{'start': '00:00:00', 'end': '23:59:59'}]},
+                }}))
+                policy = policy_file.get()
+                self.assertEqual(policy_file.reloads, 1)
+                self.assertEqual(policy.permission_sets[ROLE_BITS[Role.PREMIUM_CLIENT]],
+                                 {Operation.VIEW_OWN_ACCOUNT_BALANCE,
+                                  *AUTHORIZATION_MATRIX[Role.PREMIUM_CLIENT]})
+                self.assertEqual(policy.closures[Role.TELLER], {Role.TELLER, Role.CLIENT})
+                self.assertEqual(policy.schedule.active_mask(at(20, 0, 0)) & ROLE_BITS[Role.TELLER],
+                                 ROLE_BITS[Role.TELLER])
+
+                previous_policy_file = get_rbac_policy_file()
+                set_rbac_policy_file(policy_file)
+                try:
+                    self.assertFalse(is_authorized(
+                        {Role.CLIENT}, Operation.VIEW_OWN_INVESTMENT_PORTFOLIO))
+                finally:
+                    set_rbac_policy_file(previous_policy_file)
+
+                # Broken policies are rejected and the last good one is kept
+                for rules in [{'roles': {'Client': {'inherits': ['Premium Client']}}},  # Cycle
+                              {'roles': {'Client': {'operations': ['FLY']}}},
+                              {'roles': {'Janitor': {}}},
+                              {'roles': {'Client': {'active': [{'start': '9am'}]}}}]:
+                    with self.assertRaises(ValueError):
+                        RbacPolicy.from_dict(rules, DEFAULT_RBAC_POLICY)
+                path.write_text('{"roles": ')
+                os.utime(path, ns=(0, 0))  # Changed even if written within the same tick
+                with self.assertLogs('rbac_policy', 'WARNING'):
+                    self.assertIs(policy_file.get(), policy)
+
+                # A policy file that's broken from the start falls back to the
+                # default policy, until it's fixed
+                with self.assertLogs('rbac_policy', 'WARNING'):
+                    policy_file = RbacPolicyFile(path, DEFAULT_RBAC_POLICY, check_interval=0)
+                self.assertIs(policy_file.get(), DEFAULT_RBAC_POLICY)
+                path.write_text('{"roles": {}}')
+                self.assertIsNot(policy_file.get(), DEFAULT_RBAC_POLICY)
+                self.assertEqual(policy_file.reloads, 1)
+
+        def test_role_schedule(self):
+            from role_schedule import WEEKDAYS
+            schedule = RoleSchedule({
+                Role.TELLER: [TimeWindow(BUSINESS_HOURS_START, BUSINESS_HOURS_END, WEEKDAYS, on_holidays=False)],
+                Role.EMPLOYEE: [TimeWindow(datetime.time(22, 0, 0), datetime.time(5, 59, 59))],
+            }, ROLE_BITS, holidays={datetime.date(2026, 10, 20)})
+
+            # Monday business hours, Teller only until 5:00:00 pm inclusive
+            self.assertEqual(schedule.active_mask(
+                at(12, 0, 0)), ROLE_BITS[Role.TELLER])
+            self.assertEqual(schedule.next_transition(at(12, 0, 0)),
+                             at(17, 0, 1))
+
+            # Overnight window spans midnight
+            self.assertEqual(schedule.active_mask(
+                at(23, 0, 0)), ROLE_BITS[Role.EMPLOYEE])
+            self.assertEqual(schedule.active_mask(
+                datetime.datetime(2026, 10, 20, 3, 0, 0)), ROLE_BITS[Role.EMPLOYEE])
+            self.assertEqual(schedule.next_transition(
+                datetime.datetime(2026, 10, 20, 3, 0, 0)), datetime.datetime(2026, 10, 20, 6, 0, 0))
+
+            # Tuesday is a holiday and Saturday isn't a weekday
+            self.assertEqual(schedule.active_mask(
+                datetime.datetime(2026, 10, 20, 12, 0, 0)), 0)
+            self.assertEqual(schedule.active_mask(
+                datetime.datetime(2026, 10, 24, 12, 0, 0)), 0)
+            self.assertEqual(schedule.active_mask(
+                datetime.datetime(2026, 10, 21, 12, 0, 0)), ROLE_BITS[Role.TELLER])
+
+        def test_check_authz_cold_start(self):
+            # -X importtime reports every import on stderr as
+            # "import time: self [us] | cumulative | <indent>module"
+            result = subprocess.run([sys.executable, '-X', 'importtime', 'main.py', 'check-authz',
+                                     'idontexist', 'VIEW_OWN_ACCOUNT_BALANCE'],
+                                    cwd=Path(__file__).parent, capture_output=True, text=True)
+            self.assertEqual(result.returncode, 2)  # Unknown user
+
+            imports = [line.split('|') for line in result.stderr.splitlines()
+                       if line.startswith('import time:') and 'cumulative' not in line]
+            modules = {module.strip() for _, _, module in imports}
+            for heavy_module in ['questionary', 'argon2', 'http.server']:
+                self.assertNotIn(heavy_module, modules)
+
+            top_level_us = sum(int(cumulative) for _, cumulative, module in imports
+                               if not module.startswith('  '))
+            self.assertLess(top_level_us / 1000, CHECK_AUTHZ_IMPORT_BUDGET_MS)
+
     unittest.main()
@@ -1,11 +1,15 @@
-from typing import NamedTuple
-from pathlib import Path
-from argon2 import PasswordHasher
-from argon2 import Type as ArgonType
+import json
+import logging
+import threading
+from typing import TYPE_CHECKING, NamedTuple
+import metrics
+from user_store import DATA_DIR, get_user_store
 
-PASSWD_FILE = Path(__file__).parent.parent / 'passwd.txt'
+if TYPE_CHECKING:
+    from argon2 import PasswordHasher
+
+logger = logging.getLogger(__name__)
 
-PASSWD_FILE_RECORD_DELIMITER = ':'
 NUM_PASSWD_FILE_RECORD_FIELDS = 2
 
 
@@ -14,53 +18,164 @@ class UserPasswdRecord(NamedTuple):
     hash_str: str
 
 
-TIME_COST = 2  # Number of iterations
-PARALLELISM = 1  # 1 lane
-MEMORY_COST_KIB = 19456  # 19 MiB
+class Argon2Params(NamedTuple):
+    time_cost: int
+    memory_cost_kib: int
+    parallelism: int
+
+
+DEFAULT_TIME_COST = 2  # Number of iterations
+DEFAULT_PARALLELISM = 1  # 1 lane
+DEFAULT_MEMORY_COST_KIB = 19456  # 19 MiB
 SALT_LENGTH = 16  # 128-bit salt
 HASH_LENGTH = 32  # 256-bit hash
 
-# Argon2id hashing algorithm config (OWASP recommendations)
-ph = PasswordHasher(
-    time_cost=TIME_COST,
-    parallelism=PARALLELISM,
-    memory_cost=MEMORY_COST_KIB,
-    salt_len=SALT_LENGTH,
-    hash_len=HASH_LENGTH,
-    type=ArgonType.ID
-)
+PASSWD_LOOKUPS = metrics.counter(
+    'auth_passwd_lookups_total', 'Password record lookups by result (hit or miss)')
+
+# Per-host parameters picked by `admin.py calibrate`, if it has been run
+ARGON2_PARAMS_FILE = DATA_DIR / 'argon2_params.json'
+
+
+def load_argon2_params() -> Argon2Params:
+    """
+    Loads the calibrated Argon2 parameters, falling back to the defaults
+    (OWASP recommendations) for any that aren't set.
+
+    Raises:
+        ValueError if the file isn't valid JSON or a parameter isn't a
+        positive integer.
+    """
+    try:
+        with open(ARGON2_PARAMS_FILE, 'r', encoding='utf-8') as params_file:
+            params = json.load(params_file)
+    except FileNotFoundError:
+        params = {}
+    if not isinstance(params, dict):
+        raise ValueError('Argon2 parameters must be a JSON object')
+    argon2_params = Argon2Params(params.get('time_cost', DEFAULT_TIME_COST),
+                                 params.get('memory_cost_kib', DEFAULT_MEMORY_COST_KIB),
+                                 params.get('parallelism', DEFAULT_PARALLELISM))
+    for name, value in argon2_params._asdict().items():
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError(f'{name} must be a positive integer, not {value!r}')
+    return argon2_params
+
+
+_argon2_params: Argon2Params | None = None
+_argon2_params_lock = threading.Lock()
+
+
+def get_argon2_params() -> Argon2Params:
+    """
+    Gets the Argon2 parameters, loading them on first use. A parameters file
+    that fails to load is logged, and the defaults are used instead.
+    """
+    global _argon2_params
+    with _argon2_params_lock:
+        if _argon2_params is None:
+            try:
+                _argon2_params = load_argon2_params()
+            except ValueError as e:
+                logger.warning('Using the default Argon2 parameters, %s failed to load: %s',
+                               ARGON2_PARAMS_FILE, e)
+                _argon2_params = Argon2Params(DEFAULT_TIME_COST, DEFAULT_MEMORY_COST_KIB,
+                                              DEFAULT_PARALLELISM)
+        return _argon2_params
+
+
+_ph: 'PasswordHasher | None' = None
+_ph_lock = threading.Lock()
+
+
+def get_password_hasher() -> 'PasswordHasher':
+    """
+    Gets the Argon2id password hasher, importing argon2 and creating it on
+    first use, so scripts that never hash don't pay for the import.
+    """
+    global _ph
+    with _ph_lock:
+        if _ph is None:
+            from argon2 import PasswordHasher
+            from argon2 import Type as ArgonType
+
+            # Argon2id hashing algorithm config
+            params = get_argon2_params()
+            _ph = PasswordHasher(
+                time_cost=params.time_cost,
+                parallelism=params.parallelism,
+                memory_cost=params.memory_cost_kib,
+                salt_len=SALT_LENGTH,
+                hash_len=HASH_LENGTH,
+                type=ArgonType.ID
+            )
+        return _ph
+
+
+def __getattr__(name: str):
+    # `ph` (e.g. `from problem2c import ph`) is created on first access
+    if name == 'ph':
+        return get_password_hasher()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def add_user_passwd_record(uname: str, plaintext_passwd: str) -> None:
     """
     Hashes and salts a plaintext password and adds a new user record to the
-    password file.
+    user store (the password file by default).
     """
-    hash_str = ph.hash(plaintext_passwd)  # Argon2id adds salt for you
-    record = UserPasswdRecord(uname, hash_str)
-
-    with open(PASSWD_FILE, 'a', encoding='utf-8') as passwd_file:
-        passwd_file.write(PASSWD_FILE_RECORD_DELIMITER.join(record) + '\n')
+    hash_str = get_password_hasher().hash(plaintext_passwd)  # Argon2id adds salt for you
+    get_user_store().add_passwd_record(uname, hash_str)
 
 
+@metrics.timed('auth_passwd_lookup_seconds', 'Time spent looking up password records')
 def get_user_passwd_record(uname: str) -> UserPasswdRecord | None:
     """
-    Retrieves a user record from the password file.
+    Retrieves a user record from the user store (the password file by
+    default).
 
     Returns:
         The user record if it exists.
         None otherwise.
     """
-    try:
-        with open(PASSWD_FILE, 'r', encoding='utf-8') as passwd_file:
-            for line in passwd_file:
-                stripped_line = line.rstrip('\n')
-                if stripped_line.startswith(uname + PASSWD_FILE_RECORD_DELIMITER):
-                    fields = stripped_line.split(
-                        PASSWD_FILE_RECORD_DELIMITER, maxsplit=1)
-                    if len(fields) == NUM_PASSWD_FILE_RECORD_FIELDS:
-                        _, hash_str = fields
-                        return UserPasswdRecord(uname, hash_str)
-    except FileNotFoundError:
-        return None  # Password file gets created when we add the first record
-    return None  # Couldn't find a record for this username
+    hash_str = get_user_store().get_passwd_hash(uname)
+    if metrics.ENABLED:
+        PASSWD_LOOKUPS.inc(result='miss' if hash_str is None else 'hit')
+    if hash_str is None:
+        return None  # Couldn't find a record for this username
+    return UserPasswdRecord(uname, hash_str)
+
+
+def change_user_passwd(uname: str, plaintext_passwd: str) -> bool:
+    """
+    Hashes and salts a new password for an existing user.
+
+    Returns:
+        True if the user exists.
+        False otherwise.
+    """
+    return get_user_store().update_passwd_hash(uname, get_password_hasher().hash(plaintext_passwd))
+
+
+def rehash_user_passwd_if_needed(uname: str, hash_str: str, plaintext_passwd: str) -> bool:
+    """
+    Rehashes a user's password with the current parameters if their stored
+    hash was made with different ones (e.g. before a recalibration). Only
+    call this once the password has been verified. The stored hash is left
+    alone if it's no longer `hash_str`, e.g. after a password change.
+
+    Returns:
+        True if the stored hash was replaced.
+        False otherwise.
+    """
+    if not get_password_hasher().check_needs_rehash(hash_str):
+        return False
+    return get_user_store().update_passwd_hash(
+        uname, get_password_hasher().hash(plaintext_passwd), hash_str)
+
+
+def get_all_unames() -> set[str]:
+    """
+    Reads every username in the user store in one pass.
+    """
+    return {uname for uname, _ in get_user_store().iter_passwd_records()}
@@ -1,7 +1,33 @@
 if __name__ == "__main__":
     import unittest
     import os
-    from problem2c import PASSWD_FILE, ph, add_user_passwd_record, get_user_passwd_record
+    import argparse
+    import asyncio
+    import gzip
+    import io
+    import json
+    import tempfile
+    import threading
+    import time
+    from pathlib import Path
+
+    # Keep the records and audit log the tests write out of the project root
+    test_data_dir = tempfile.TemporaryDirectory()
+    os.environ['AUTH_DATA_DIR'] = test_data_dir.name
+
+    from argon2.exceptions import VerifyMismatchError
+    from argon2 import PasswordHasher
+    from unittest.mock import patch
+    import metrics
+    from audit import BLOCK, AuditLog, get_audit_log, set_audit_log
+    from hash_pool import HashService, HashServiceBusy
+    from problem2c import ARGON2_PARAMS_FILE, Argon2Params, get_argon2_params, rehash_user_passwd_if_needed
+    from main import EXIT_FAILED, login_cmd
+    from problem4c import LOGIN_BUSY_MESSAGE, login_user, login_user_async
+    from problem2c import ph, add_user_passwd_record, get_user_passwd_record
+    from server import handle_connection
+    from throttle import LoginThrottle, LoginThrottled
+    from user_store import PASSWD_FILE, PASSWD_FILE_RECORD_DELIMITER, get_user_store
 
     class TestPasswdFileUsage(unittest.TestCase):
         def setUp(self):
@@ -53,4 +79,351 @@ if __name__ == "__main__":
             stored_user_record = get_user_passwd_record('idontexist')
             self.assertIsNone(stored_user_record)
 
+        def test_index_catches_up_with_appended_records(self):
+            # Enough records to force the index to grow a few times
+            unames = [f'user{i}' for i in range(5000)]
+            with open(PASSWD_FILE, 'a', encoding='utf-8') as passwd_file:
+                for uname in unames:
+                    passwd_file.write(
+                        PASSWD_FILE_RECORD_DELIMITER.join([uname, 'hash' + uname]) + '\n')
+
+            for uname in unames:
+                self.assertEqual(get_user_passwd_record(
+                    uname).hash_str, 'hash' + uname)
+            self.assertIsNone(get_user_passwd_record('idontexist'))
+
+            # Duplicate records resolve to the latest one
+            with open(PASSWD_FILE, 'a', encoding='utf-8') as passwd_file:
+                passwd_file.write(
+                    PASSWD_FILE_RECORD_DELIMITER.join(['user0', 'newer']) + '\n')
+            self.assertEqual(get_user_passwd_record(
+                'user0').hash_str, 'newer')
+
+            self.assertEqual(get_user_store().rebuild_passwd_index(), len(unames))
+            self.assertEqual(get_user_passwd_record(
+                'user4999').hash_str, 'hashuser4999')
+
+        def test_uname_filter(self):
+            store = get_user_store()
+            with open(PASSWD_FILE, 'a', encoding='utf-8') as passwd_file:
+                for i in range(100):
+                    passwd_file.write(
+                        PASSWD_FILE_RECORD_DELIMITER.join([f'user{i}', 'hash']) + '\n')
+
+            # No false negatives, and appended records are picked up
+            for i in range(100):
+                self.assertIn(f'user{i}', store.uname_filter)
+            absent = sum(f'stranger{i}' not in store.uname_filter for i in range(1000))
+            self.assertGreater(absent, 950)
+            self.assertIsNone(get_user_passwd_record('stranger0'))
+
+            # Replacing the file (e.g. compacting it) rebuilds the filter
+            os.remove(PASSWD_FILE)
+            with open(PASSWD_FILE, 'w', encoding='utf-8') as passwd_file:
+                passwd_file.write(
+                    PASSWD_FILE_RECORD_DELIMITER.join(['newcomer', 'hash']) + '\n')
+            self.assertIn('newcomer', store.uname_filter)
+            self.assertEqual(get_user_passwd_record('newcomer').hash_str, 'hash')
+            self.assertEqual(store.rebuild_uname_filter(), 1)
+
+        def test_hash_service(self):
+            hash_service = HashService(max_workers=2, max_queue=2)
+            hash_str = hash_service.hash('secret')
+            self.assertTrue(hash_service.verify(hash_str, 'secret'))
+            self.assertRaises(VerifyMismatchError,
+                              hash_service.verify, hash_str, 'wrong')
+
+            async def verify_all():
+                return await asyncio.gather(*(hash_service.averify(hash_str, 'secret') for _ in range(2)))
+            self.assertEqual(asyncio.run(verify_all()), [True, True])
+
+            # Tie up the workers so requests pile up in the queue
+            release = threading.Event()
+            with self.assertRaises(HashServiceBusy):
+                for _ in range(10):
+                    hash_service.submit(release.wait)
+            release.set()
+            self.assertGreater(hash_service.stats()['rejected'], 0)
+            hash_service.shutdown()
+
+        def test_login_throttle(self):
+            now = [0.0]
+            saturated = [False]
+            throttle = LoginThrottle(uname_burst=2, uname_rate=1, source_burst=3, source_rate=1,
+                                     lockout_threshold=2, max_entries=3,
+                                     is_saturated=lambda: saturated[0], clock=lambda: now[0])
+
+            # Per-username bucket, refilled over time
+            throttle.check('hubert', '10.0.0.1')
+            throttle.check('hubert', '10.0.0.1')
+            with self.assertRaises(LoginThrottled) as cm:
+                throttle.check('hubert', '10.0.0.1')
+            self.assertEqual(cm.exception.reason, 'uname_rate')
+            self.assertAlmostEqual(cm.exception.retry_after, 1.0)
+
+            # Per-source bucket, and rejected attempts don't take tokens
+            throttle.check('dina', '10.0.0.1')
+            with self.assertRaises(LoginThrottled) as cm:
+                throttle.check('johndoe', '10.0.0.1')
+            self.assertEqual(cm.exception.reason, 'source_rate')
+            throttle.check('johndoe', '10.0.0.2')
+
+            # Lockouts double with every failure past the threshold, and a
+            # success clears them
+            now[0] = 100.0
+            throttle.record_failure('hubert')
+            throttle.check('hubert')
+            throttle.record_failure('hubert')
+            with self.assertRaises(LoginThrottled) as cm:
+                throttle.check('hubert')
+            self.assertEqual(cm.exception.reason, 'locked_out')
+            now[0] = 101.0
+            throttle.record_failure('hubert')
+            with self.assertRaises(LoginThrottled) as cm:
+                throttle.check('hubert')
+            self.assertAlmostEqual(cm.exception.retry_after, 2.0)
+            throttle.record_success('hubert')
+            throttle.check('hubert')
+
+            saturated[0] = True
+            with self.assertRaises(HashServiceBusy):
+                throttle.check('dina')
+            self.assertLessEqual(throttle.stats()['entries'], 3)
+
+        def test_audit_log(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = Path(tmp_dir) / 'audit.jsonl'
+                audit_log = AuditLog(path, buffer_size=4, batch_size=2, flush_interval=60)
+                previous_audit_log = get_audit_log()
+                set_audit_log(audit_log)
+                try:
+                    add_user_passwd_record('hubert', 'secret')
+                    login_user('hubert', 'secret', '10.0.0.1')
+                    login_user('hubert', 'wrong')
+                    login_user('idontexist', 'secret')
+                    self.assertTrue(audit_log.flush(timeout=10))
+                finally:
+                    set_audit_log(previous_audit_log)
+                events = [json.loads(line) for line in path.read_text().splitlines()]
+                self.assertEqual([(event['event'], event['uname'], event['outcome']) for event in events],
+                                 [('login', 'hubert', 'success'), ('login', 'hubert', 'wrong_passwd'),
+                                  ('login', 'idontexist', 'unknown_user')])
+                self.assertEqual(events[0]['source'], '10.0.0.1')
+
+                # A full buffer drops events while the writer is busy...
+                with patch.object(audit_log, '_write', side_effect=lambda batch: time.sleep(0.2)):
+                    results = [audit_log.log('test', i=i) for i in range(20)]
+                    self.assertIn(False, results)
+                    self.assertEqual(audit_log.stats()['dropped'], results.count(False))
+                    audit_log.flush(timeout=10)
+                audit_log.close()
+
+                # ... or blocks until it catches up
+                audit_log = AuditLog(path, buffer_size=4, batch_size=2, flush_interval=60,
+                                     rotate_bytes=1000, overflow=BLOCK)
+                for i in range(100):
+                    self.assertTrue(audit_log.log('test', i=i))
+                audit_log.close()
+                stats = audit_log.stats()
+                self.assertEqual((stats['written'], stats['dropped']), (100, 0))
+
+                # Rotated logs are gzipped, nothing is lost
+                self.assertGreater(stats['rotations'], 0)
+                rotated = sorted(Path(tmp_dir).glob('audit-*.jsonl.gz'))
+                self.assertEqual(len(rotated), stats['rotations'])
+                lines = [line for rotated_path in rotated
+                         for line in gzip.decompress(rotated_path.read_bytes()).decode().splitlines()]
+                lines += path.read_text().splitlines()
+                self.assertEqual(sum(json.loads(line)['event'] == 'test' for line in lines), 100)
+
+        def test_rehash_on_new_params(self):
+            add_user_passwd_record('hubert', 'secret')
+            add_user_passwd_record('dina', 'secret')
+            store = get_user_store()
+
+            # Same length hash (only the time cost differs) and a different
+            # length one
+            for old_ph in [PasswordHasher(time_cost=1, memory_cost=ph.memory_cost),
+                           PasswordHasher(time_cost=1, memory_cost=8192)]:
+                old_hash_str = old_ph.hash('secret')
+                self.assertTrue(store.update_passwd_hash(
+                    'hubert', old_hash_str))
+                self.assertEqual(get_user_passwd_record(
+                    'hubert').hash_str, old_hash_str)
+
+                self.assertTrue(rehash_user_passwd_if_needed(
+                    'hubert', old_hash_str, 'secret'))
+                new_hash_str = get_user_passwd_record('hubert').hash_str
+                self.assertFalse(ph.check_needs_rehash(new_hash_str))
+                self.assertTrue(ph.verify(new_hash_str, 'secret'))
+                self.assertFalse(rehash_user_passwd_if_needed(
+                    'hubert', new_hash_str, 'secret'))
+
+                # Neighbouring records are untouched
+                self.assertTrue(
+                    ph.verify(get_user_passwd_record('dina').hash_str, 'secret'))
+
+            self.assertFalse(store.update_passwd_hash('idontexist', 'hash'))
+
+            # A password changed after the old hash was verified isn't
+            # reverted by the rehash, on either login path
+            for login in [login_user, lambda *args: asyncio.run(login_user_async(*args))]:
+                old_hash_str = PasswordHasher(time_cost=1, memory_cost=ph.memory_cost).hash('secret')
+                self.assertTrue(store.update_passwd_hash('hubert', old_hash_str))
+                with patch('problem2c.get_password_hasher') as hasher, \
+                        patch('problem4c.get_password_hasher', hasher):
+                    hasher.return_value.check_needs_rehash.return_value = True
+                    hasher.return_value.hash.side_effect = lambda passwd: (
+                        store.add_passwd_record('hubert', 'changed') or ph.hash(passwd))
+                    with patch('problem4c.get_hash_service') as hash_service:
+                        hash_service.return_value.averify.side_effect = lambda *args: asyncio.sleep(0)
+                        hash_service.return_value.ahash.side_effect = lambda passwd: asyncio.to_thread(
+                            hasher.return_value.hash, passwd)
+                        self.assertIsInstance(login('hubert', 'secret'), set)
+                self.assertEqual(get_user_passwd_record('hubert').hash_str, 'changed')
+
+        def test_server(self):
+            async def round_trips(*requests):
+                server = await asyncio.start_server(handle_connection, '127.0.0.1', 0)
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                responses = []
+                for method, target, body, token in requests:
+                    payload = json.dumps(body).encode() if body is not None else b''
+                    if callable(token):
+                        token = token(responses)
+                    head = f'{method} {target} HTTP/1.1\r\nContent-Length: {len(payload)}\r\n'
+                    if token:
+                        head += f'Authorization: Bearer {token}\r\n'
+                    writer.write((head + '\r\n').encode() + payload)
+                    status_line, *header_lines = (await reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+                    headers = dict(line.split(': ', 1) for line in header_lines if line)
+                    response_body = json.loads(await reader.readexactly(int(headers['Content-Length'])))
+                    responses.append((int(status_line.split(' ')[1]), response_body, headers))
+                writer.write_eof()
+                await reader.read()  # Until the server hangs up
+                writer.close()
+                server.close()
+                await server.wait_closed()
+                return responses
+
+            def last_token(responses):
+                return responses[-1][1]['token']
+
+            credentials = {'username': 'hubertdang', 'password': 'asdfQWE123!'}
+            (privileged, enrolled, taken, logged_in, operations, other_user, no_token) = asyncio.run(round_trips(
+                ('POST', '/enrol', {**credentials, 'roles': ['Client', 'Employee']}, None),
+                ('POST', '/enrol', {**credentials, 'roles': ['Client']}, None),
+                ('POST', '/enrol', {**credentials, 'roles': ['Client']}, None),
+                ('POST', '/login', credentials, None),
+                ('GET', '/authorized-operations', None, last_token),
+                ('GET', '/authorized-operations?username=johndoe', None, lambda responses: responses[3][1]['token']),
+                ('GET', '/authorized-operations?username=hubertdang', None, None)))
+            self.assertEqual(privileged[:2], (403, {'error': 'Role(s) not open to self-enrolment: Employee'}))
+            self.assertEqual(enrolled[:2], (201, {'username': 'hubertdang', 'roles': ['Client']}))
+            self.assertEqual(taken[0], 409)
+            self.assertEqual((logged_in[0], logged_in[1]['roles']), (200, ['Client']))
+            self.assertEqual(operations[:2], (200, {'username': 'hubertdang',
+                                                    'authorized_operations': logged_in[1]['authorized_operations']}))
+            self.assertEqual(other_user[0], 403)
+            self.assertEqual(no_token[0], 401)
+
+            # Throttled logins and a saturated hash service ask the client to
+            # come back later
+            with patch('server.login_user_async',
+                       side_effect=LoginThrottled('Too many login attempts', 'uname_rate', 2.5)):
+                [(status, body, headers)] = asyncio.run(round_trips(('POST', '/login', credentials, None)))
+            self.assertEqual((status, body, headers['Retry-After']), (429, {'error': 'Too many login attempts'}, '3'))
+            with patch('server.login_user_async', side_effect=HashServiceBusy()):
+                [(status, _, headers)] = asyncio.run(round_trips(('POST', '/login', credentials, None)))
+            self.assertEqual((status, headers['Retry-After']), (503, '1'))
+
+        def test_server_rejects_ambiguous_bodies(self):
+            async def raw_round_trip(data):
+                server = await asyncio.start_server(handle_connection, '127.0.0.1', 0)
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                writer.write(data)
+                response = await reader.read()  # Until the server hangs up
+                writer.close()
+                server.close()
+                await server.wait_closed()
+                return response.decode()
+
+            # A chunked body isn't parsed as the next pipelined request
+            smuggled = 'GET /health HTTP/1.1\r\n\r\n'
+            chunked = (f'POST /login HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                       f'0\r\n\r\n{smuggled}')
+            response = asyncio.run(raw_round_trip(chunked.encode()))
+            self.assertTrue(response.startswith('HTTP/1.1 501 '))
+            self.assertEqual(response.count('HTTP/1.1 '), 1)
+
+            for framing in ['Transfer-Encoding: chunked\r\nContent-Length: 5',
+                            'Content-Length: 5\r\nContent-Length: 30',
+                            'Content-Length: -1']:
+                response = asyncio.run(raw_round_trip(
+                    f'POST /login HTTP/1.1\r\n{framing}\r\n\r\n{smuggled}'.encode()))
+                self.assertTrue(response.startswith('HTTP/1.1 400 '), framing)
+                self.assertEqual(response.count('HTTP/1.1 '), 1)
+
+        def test_login_cmd_busy(self):
+            args = argparse.Namespace(uname='hubert', passwd_stdin=True)
+            with patch('problem4c.login_user', side_effect=HashServiceBusy()), \
+                    patch('sys.stdin', io.StringIO('secret\n')), \
+                    patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                self.assertEqual(login_cmd(args), EXIT_FAILED)
+            self.assertEqual(stderr.getvalue(), LOGIN_BUSY_MESSAGE + '\n')
+
+        def test_argon2_params_file(self):
+            defaults = Argon2Params(ph.time_cost, ph.memory_cost, ph.parallelism)
+            try:
+                ARGON2_PARAMS_FILE.write_text('{"time_cost": 3}')
+                with patch('problem2c._argon2_params', None):
+                    self.assertEqual(get_argon2_params(), defaults._replace(time_cost=3))
+
+                # A malformed file falls back to the defaults instead of
+                # failing every import
+                for params in ['{"time_cost": ', '{"memory_cost_kib": "19 MiB"}', '[]']:
+                    ARGON2_PARAMS_FILE.write_text(params)
+                    with patch('problem2c._argon2_params', None), self.assertLogs('problem2c', 'WARNING'):
+                        self.assertEqual(get_argon2_params(), defaults)
+            finally:
+                ARGON2_PARAMS_FILE.unlink()
+
+        def test_metrics(self):
+            def lookup(uname):
+                return get_user_passwd_record(uname)
+
+            # Nothing is wrapped while metrics are disabled
+            with patch.object(metrics, 'ENABLED', False):
+                self.assertIs(metrics.timed('test_seconds', 'Test')(lookup), lookup)
+
+            lookups = metrics.counter(
+                'auth_passwd_lookups_total', 'Password record lookups by result (hit or miss)')
+            hits, misses = lookups.value(result='hit'), lookups.value(result='miss')
+            with patch.object(metrics, 'ENABLED', True):
+                timed_lookup = metrics.timed(
+                    'test_lookup_seconds', 'Test lookups')(lookup)
+                add_user_passwd_record('hubert', 'secret')
+                timed_lookup('hubert')
+                timed_lookup('idontexist')
+
+            latency = metrics.histogram('test_lookup_seconds', 'Test lookups')
+            self.assertEqual(latency.count(), 2)
+            text = metrics.render()
+            self.assertIn('# TYPE test_lookup_seconds histogram', text)
+            self.assertIn('test_lookup_seconds_bucket{le="+Inf"} 2', text)
+            self.assertIn('test_lookup_seconds_count 2', text)
+            self.assertEqual(lookups.value(result='hit'), hits + 1)
+            self.assertEqual(lookups.value(result='miss'), misses + 1)
+            self.assertIn('auth_passwd_lookups_total{result="hit"}', text)
+
+            # The file exporter rewrites the same text, and once more when stopped
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = Path(tmp_dir) / 'auth.prom'
+                stop = metrics.start_metrics_writer(path, interval=0.01)
+                deadline = time.monotonic() + 10
+                while not path.exists() and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                stop.set()
+                self.assertIn('test_lookup_seconds_count 2', path.read_text())
+
     unittest.main()
@@ -1,35 +1,54 @@
-import questionary
-from typing import NamedTuple
+from typing import Container, Iterable, NamedTuple
 from pathlib import Path
 from functools import partial
+import logging
+import threading
+import metrics
 from problem1c import Role
-from problem2c import add_user_passwd_record, get_user_passwd_record
+from password_policy import PasswdPolicy, load_passwd_policy
+from problem2c import get_password_hasher, get_user_passwd_record
+from sessions import get_session_store
+from user_store import DATA_DIR, NewUser, get_user_store
+from weak_passwd_db import WeakPasswdDB
 
-UNAME_MIN_LEN = 6
-UNAME_MAX_LEN = 12
+logger = logging.getLogger(__name__)
 
-PASSWD_MIN_LEN = 8
-PASSWD_MAX_LEN = 12
+UNAME_TAKEN_MESSAGE = 'Username already chosen! Backspace and choose again.'
 
-SPECIAL_CHARACTERS = set('!@#$%*&')
+UNAME_MIN_LEN = 6
+UNAME_MAX_LEN = 12
 
-WEAK_PASSWD_FILE = Path(__file__).parent.parent / 'weak_passwd.txt'
+# Password rules (lengths, special characters, ...), the defaults if it
+# doesn't exist or fails to load
+PASSWD_POLICY_FILE = DATA_DIR / 'passwd_policy.json'
 
-ROLES_FILE = Path(__file__).parent.parent / 'roles.txt'
+WEAK_PASSWD_FILE = Path(__file__).parent.parent / 'weak_passwd.txt'  # Shipped with the sources
+# Compiled from it, see admin.py build-weak-passwd-db
+WEAK_PASSWD_DB_FILE = DATA_DIR / 'weak_passwd.db'
+WEAK_PASSWD_BLOOM_FILE = DATA_DIR / 'weak_passwd.bloom'
 
-ROLES_FILE_RECORD_DELIMITER = ':'
 NUM_ROLES_FILE_RECORD_FIELDS = 2
 
+ROLES_LOOKUPS = metrics.counter(
+    'auth_roles_lookups_total', 'Roles record lookups by result (hit or miss)')
+WEAK_PASSWD_CHECKS = metrics.counter(
+    'auth_weak_passwd_checks_total', 'Weak password checks by method (compiled or scan)')
+BYTES_READ = metrics.counter(
+    'auth_bytes_read_total', 'Bytes read from data files on lookups')
+
 
 class UserRolesRecord(NamedTuple):
     uname: str
     roles: set[Role]
 
 
-def validate_uname(uname: str) -> bool | str:
+@metrics.timed('auth_validate_uname_seconds', 'Time spent validating usernames')
+def validate_uname(uname: str, taken_unames: Container[str] | None = None) -> bool | str:
     """
     Validates a username. Usernames are unique, 6-12 characters long, contain
     only upper and lower-case letters, numerical digits, and no spaces.
+    Uniqueness is checked against the password file, or against
+    `taken_unames` if given (e.g. when validating many usernames at once).
 
     Returns:
         True if the username is valid.
@@ -41,94 +60,197 @@ def validate_uname(uname: str) -> bool | str:
         return 'Usernames must only contain letters and numbers! Backspace and choose again.'
     if len(uname) < UNAME_MIN_LEN or len(uname) > UNAME_MAX_LEN:
         return 'Usernames must be 6-12 characters long! Backspace and choose again.'
-    if get_user_passwd_record(uname) is not None:
-        return 'Username already chosen! Backspace and choose again.'
+    if taken_unames is not None:
+        is_taken = uname in taken_unames
+    else:
+        is_taken = get_user_passwd_record(uname) is not None
+    if is_taken:
+        return UNAME_TAKEN_MESSAGE
     return True
 
 
+weak_passwd_db = WeakPasswdDB(
+    WEAK_PASSWD_FILE, WEAK_PASSWD_DB_FILE, WEAK_PASSWD_BLOOM_FILE)
+
+_passwd_policy: PasswdPolicy | None = None
+_passwd_policy_lock = threading.Lock()
+
+
+def get_passwd_policy() -> PasswdPolicy:
+    """
+    Gets the password policy, loading it on first use. A policy file that
+    fails to load is logged, and the defaults are used instead.
+    """
+    global _passwd_policy
+    with _passwd_policy_lock:
+        if _passwd_policy is None:
+            try:
+                _passwd_policy = load_passwd_policy(PASSWD_POLICY_FILE)
+            except ValueError as e:
+                logger.warning('Using the default password policy, %s failed to load: %s',
+                               PASSWD_POLICY_FILE, e)
+                _passwd_policy = PasswdPolicy()
+        return _passwd_policy
+
+
+def set_passwd_policy(policy: PasswdPolicy | None) -> None:
+    """
+    Sets the password policy, or with None, reloads it on next use.
+    """
+    global _passwd_policy
+    with _passwd_policy_lock:
+        _passwd_policy = policy
+
+
+@metrics.timed('auth_weak_passwd_check_seconds', 'Time spent checking for weak passwords')
 def is_weak(passwd: str) -> bool:
     """
-    Checks if a password is "weak" by going through the weak password file and
-    checking if there is a match.
+    Checks if a password is "weak" by looking it up in the compiled weak
+    password list, or, if the weak password file hasn't been compiled (or
+    changed since), by going through it and checking if there is a match.
+    """
+    if weak_passwd_db.is_current():
+        if metrics.ENABLED:
+            WEAK_PASSWD_CHECKS.inc(method='compiled')
+        return passwd in weak_passwd_db
+
+    if metrics.ENABLED:
+        WEAK_PASSWD_CHECKS.inc(method='scan')
+    passwd_bytes = passwd.encode('utf-8')
+    with open(WEAK_PASSWD_FILE, 'rb') as weak_passwd_file:
+        try:
+            for line in weak_passwd_file:
+                weak_passwd = line.rstrip(b'\r\n')
+                if passwd_bytes == weak_passwd:
+                    return True
+            return False
+        finally:
+            if metrics.ENABLED:
+                BYTES_READ.inc(weak_passwd_file.tell(), file='weak_passwd')
+
+
+def find_weak(passwds: Iterable[str]) -> set[str]:
+    """
+    Checks many passwords for weak ones at once, with a single pass over the
+    weak password file if it hasn't been compiled.
+
+    Returns:
+        The passwords that are weak.
     """
-    with open(WEAK_PASSWD_FILE, 'r', encoding='utf-8') as weak_passwd_file:
+    passwds = set(passwds)
+    if weak_passwd_db.is_current():
+        if metrics.ENABLED:
+            WEAK_PASSWD_CHECKS.inc(len(passwds), method='compiled')
+        return {passwd for passwd in passwds if passwd in weak_passwd_db}
+
+    if metrics.ENABLED:
+        WEAK_PASSWD_CHECKS.inc(len(passwds), method='scan')
+    remaining = {passwd.encode('utf-8'): passwd for passwd in passwds}
+    weak = set()
+    with open(WEAK_PASSWD_FILE, 'rb') as weak_passwd_file:
         for line in weak_passwd_file:
-            weak_passwd = line.rstrip('\n')
-            if passwd == weak_passwd:
-                return True
-    return False
+            passwd = remaining.pop(line.rstrip(b'\r\n'), None)
+            if passwd is not None:
+                weak.add(passwd)
+                if not remaining:
+                    break
+        if metrics.ENABLED:
+            BYTES_READ.inc(weak_passwd_file.tell(), file='weak_passwd')
+    return weak
 
 
+@metrics.timed('auth_validate_passwd_seconds', 'Time spent validating passwords')
 def validate_passwd(passwd: str, uname: str) -> bool | str:
     """
-    Validates a password. Passwords are unique, 8-12 characters long, and must
-    include at least one upper-case letter, one lower-case letter, one numerical
-    digit, and one special character from the following: !, @, #, $, %, *, &.
-    Additionally, Passwords must not match a password found on a list of common
-    weak passwords, and passwords matching the username must be prohibited.
+    Validates a password against the password policy. By default, passwords
+    are 8-12 characters long, and must include at least one upper-case letter,
+    one lower-case letter, one numerical digit, and one special character from
+    the following: !, @, #, $, %, *, &. Additionally, Passwords must not match
+    a password found on a list of common weak passwords, and passwords
+    matching the username must be prohibited.
 
     Returns:
         True if the password is valid.
         String error message (for questionary library) otherwise.
     """
-    if ' ' in passwd:
-        return 'Passwords must not contain spaces! Backspace and choose again. Backspace and choose again.'
-    if not any(char.isupper() for char in passwd):
-        return 'Passwords must contain at least one upper-case letter! Backspace and choose again.'
-    if not any(char.islower() for char in passwd):
-        return 'Passwords must contain at least one lower-case letter! Backspace and choose again.'
-    if not any(char.isdigit() for char in passwd):
-        return 'Passwords must contain at least one numerical digit! Backspace and choose again.'
-    if not any(char in SPECIAL_CHARACTERS for char in passwd):
-        return 'Passwords must contain at least one special character from the following: !, @, #, $, %, *, &. Backspace and choose again.'
-    if len(passwd) < PASSWD_MIN_LEN or len(passwd) > PASSWD_MAX_LEN:
-        return 'Passwords must be 8-12 characters long! Backspace and choose again.'
-    if passwd == uname:
-        return 'Passwords cannot be the same as your username! Backspace and choose again.'
-    if is_weak(passwd):
+    # The weak password lookup is the expensive one, so it's left for last
+    policy = get_passwd_policy()
+    violations = policy.check(passwd, uname)
+    if not violations and policy.reject_weak and is_weak(passwd):
         return 'Password too weak! Backspace and choose again.'
+    return violations[0].message if violations else True
 
-    return True
+
+def validate_passwds(candidates: Iterable[tuple[str, str]]) -> list[bool | str]:
+    """
+    Validates many (password, username) pairs at once, e.g. for bulk imports
+    or policy audits, looking up every weak password in one go.
+
+    Returns:
+        For each pair, in order, what validate_passwd would.
+    """
+    return [violations[0].message if violations else True
+            for violations in get_passwd_policy().check_many(candidates, find_weak)]
 
 
 def add_user_roles_record(uname: str, roles: list[str]) -> None:
     """
-    Adds a record to the user roles file containing a username and their roles.
+    Adds a record to the user store (the user roles file by default)
+    containing a username and their roles.
     """
-    with open(ROLES_FILE, 'a', encoding='utf-8') as roles_file:
-        # Roles are stored as comma-separated strings
-        roles_str = ','.join(roles)
-        fields = [uname, roles_str]
-        roles_file.write(ROLES_FILE_RECORD_DELIMITER.join(fields) + '\n')
+    get_user_store().add_roles_record(uname, roles)
 
 
+@metrics.timed('auth_roles_lookup_seconds', 'Time spent looking up roles records')
 def get_user_roles_record(uname: str) -> UserRolesRecord | None:
     """
-    Retrieves a user record from the user roles file.
+    Retrieves a user record from the user store (the user roles file by
+    default).
 
     Returns:
         The user record if it exists.
         None otherwise.
     """
-    try:
-        with open(ROLES_FILE, 'r', encoding='utf-8') as passwd_file:
-            for line in passwd_file:
-                stripped_line = line.rstrip('\n')
-                if stripped_line.startswith(uname + ROLES_FILE_RECORD_DELIMITER):
-                    fields = stripped_line.split(
-                        ROLES_FILE_RECORD_DELIMITER, maxsplit=1)
-                    if len(fields) == NUM_ROLES_FILE_RECORD_FIELDS:
-                        _, roles_str = fields
-                        if roles_str:
-                            # Convert comma-separated string into set of roles
-                            roles = {Role(role)
-                                     for role in roles_str.split(',')}
-                        else:
-                            roles = set()  # Handle a user having no roles
-                        return UserRolesRecord(uname, roles)
-    except FileNotFoundError:
-        return None  # Roles file gets created when we add the first record
-    return None  # Couldn't find a record for this username
+    roles = get_user_store().get_roles(uname)
+    if metrics.ENABLED:
+        ROLES_LOOKUPS.inc(result='miss' if roles is None else 'hit')
+    if roles is None:
+        return None  # Couldn't find a record for this username
+    return UserRolesRecord(uname, set(roles))
+
+
+def set_user_roles_record(uname: str, roles: list[str]) -> bool:
+    """
+    Replaces the roles of an existing user, e.g. to revoke a role, ending
+    their sessions.
+
+    Returns:
+        True if the user exists.
+        False otherwise.
+
+    Raises:
+        ValueError if one of the roles doesn't exist.
+    """
+    valid_roles = {role.value for role in Role}
+    for role in roles:
+        if role not in valid_roles:
+            raise ValueError(f'Unknown role: {role}')
+    if not get_user_store().set_roles(uname, roles):
+        return False
+    get_session_store().invalidate_user(uname)
+    return True
+
+
+def delete_user(uname: str) -> bool:
+    """
+    Deletes a user's password and roles records, ending their sessions.
+
+    Returns:
+        True if the user existed.
+        False otherwise.
+    """
+    get_session_store().invalidate_user(uname)
+    return get_user_store().delete_user(uname)
 
 
 def enrol_user_cli():
@@ -137,6 +259,8 @@ def enrol_user_cli():
     (https://questionary.readthedocs.io/en/stable/pages/quickstart.html) to
     enrol a user into the system.
     """
+    import questionary  # Slow to import, and only needed for the prompts
+
     chosen_uname = questionary.text(
         'Choose a username: ', validate=validate_uname, validate_while_typing=False).ask()
 
@@ -146,8 +270,6 @@ def enrol_user_cli():
     chosen_passwd = questionary.password(
         'Choose a password: ', validate=validate_passwd_with_uname, validate_while_typing=False).ask()
 
-    add_user_passwd_record(chosen_uname, chosen_passwd)
-
     # Prompt user to select role(s) based on Role enum from problem 1.c)
     role_prompt = questionary.checkbox(
         'Select role(s)',
@@ -155,4 +277,8 @@ def enrol_user_cli():
         instruction='(Use arrow keys to move, <space> to select, <Enter> to submit)')
 
     selected_roles = role_prompt.ask()
-    add_user_roles_record(chosen_uname, selected_roles)
+
+    # Both records in one commit, so the user never exists without their roles
+    if get_user_store().add_users(
+            [NewUser(chosen_uname, get_password_hasher().hash(chosen_passwd), selected_roles)]):
+        print(f'Enrolment failed! {chosen_uname} was enrolled by someone else meanwhile.')
@@ -1,12 +1,37 @@
-from problem2c import add_user_passwd_record
-
-
 if __name__ == "__main__":
     import unittest
+    import argparse
+    import datetime
+    import io
+    import json
     import os
-    from problem1c import Role
-    from problem2c import PASSWD_FILE, add_user_passwd_record
-    from problem3ab import ROLES_FILE, UserRolesRecord, validate_uname, validate_passwd, add_user_roles_record, get_user_roles_record
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from pathlib import Path
+    from unittest.mock import patch
+
+    # Keep the records and audit log the tests write out of the project root
+    test_data_dir = tempfile.TemporaryDirectory()
+    os.environ['AUTH_DATA_DIR'] = test_data_dir.name
+
+    from problem1c import ROLE_BITS, Operation, Role
+    from problem2c import add_user_passwd_record, get_user_passwd_record, ph
+    from problem3ab import validate_uname, validate_passwd, validate_passwds, add_user_roles_record, get_user_roles_record
+    from admin import set_roles_cmd, users_with_cmd
+    from bulk_enrol import EnrolmentFailure, bulk_enrol
+    from file_lock import locked
+    from password_policy import PasswdPolicy
+    from role_index import RoleIndex
+    from role_schedule import RoleSchedule, TimeWindow
+    from sessions import SessionStore, get_session_store, set_session_store
+    from sharded_store import ShardedUserStore
+    from store_verifier import verify_user_store
+    from problem3ab import (PASSWD_POLICY_FILE, delete_user, get_passwd_policy, set_passwd_policy,
+                            set_user_roles_record)
+    from record_cache import RecordCache
+    from user_store import (PASSWD_FILE, ROLES_FILE, FlatFileUserStore, SQLiteUserStore, NewUser, UserStore,
+                            get_user_store, set_user_store, migrate_user_store, parse_roles)
+    from weak_passwd_db import WeakPasswdDB, build_weak_passwd_db
 
     class TestEnrolment(unittest.TestCase):
         def setUp(self):
@@ -90,6 +115,102 @@ if __name__ == "__main__":
             passwd = 'asdfQWE123!'
             self.assertTrue(validate_passwd(passwd, uname))
 
+        def test_passwd_policy(self):
+            policy = PasswdPolicy()
+            self.assertEqual([violation.rule for violation in policy.check('aq 1', 'hubertdang', lambda passwd: True)],
+                             ['spaces', 'upper', 'special', 'length', 'weak'])
+            self.assertEqual(policy.check('asdfQWE123!', 'asdfQWE123!'),
+                             [('uname', 'Passwords cannot be the same as your username! Backspace and choose again.')])
+
+            policy = PasswdPolicy.from_dict(
+                {'min_len': 4, 'special_characters': '?', 'require_upper': False})
+            self.assertEqual(policy.check('asd1?'), [])
+            self.assertEqual(policy.check('ASD1!')[0].message,
+                             'Passwords must contain at least one lower-case letter! Backspace and choose again.')
+            self.assertEqual(policy.check('asd1!')[0].message,
+                             'Passwords must contain at least one special character from the following: ?. Backspace and choose again.')
+            with self.assertRaises(ValueError):
+                PasswdPolicy.from_dict({'min_length': 4})
+
+            # A malformed policy file falls back to the defaults
+            PASSWD_POLICY_FILE.write_text('{"min_len": ')
+            set_passwd_policy(None)
+            try:
+                with self.assertLogs('problem3ab', 'WARNING'):
+                    self.assertEqual(get_passwd_policy().min_len, PasswdPolicy().min_len)
+                self.assertTrue(validate_passwd('asdfQWE123!', 'hubertdang'))
+            finally:
+                PASSWD_POLICY_FILE.unlink()
+                set_passwd_policy(None)
+
+            # The batch API agrees with validating one at a time
+            candidates = [(' asdfQWE123!', 'hubertdang'), ('P@ssw0rd', 'hubertdang'),
+                          ('asdfQWE123!', 'hubertdang'), ('asdfQWE123!', 'asdfQWE123!'),
+                          ('aQ1!', 'hubertdang'), ('P@ssw0rd', 'johndoe1')]
+            self.assertEqual(validate_passwds(candidates),
+                             [validate_passwd(passwd, uname) for passwd, uname in candidates])
+
+        def test_bulk_enrol(self):
+            add_user_passwd_record('existing1', 'asdfQWE123!')
+            store = get_user_store()
+            add_users = store.add_users
+
+            def add_users_late(users):
+                # Someone else enrols one of the users while the passwords are hashed
+                add_user_passwd_record('latecomer', 'asdfQWE123!')
+                return add_users(users)
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = Path(tmp_dir) / 'users.csv'
+                path.write_text('username,password,roles\n'
+                                'hubertdang,asdfQWE123!,"Client,Premium Client"\n'  # Line 2
+                                'hub,asdfQWE123!,Client\n'
+                                'johndoe1,P@ssw0rd,Client\n'
+                                'hubertdang,asdfQWE123!,Client\n'  # In-file duplicate
+                                'existing1,asdfQWE123!,Client\n'  # Already enrolled
+                                'latecomer,asdfQWE123!,Client\n'
+                                'janedoe1,asdfQWE123!,Janitor\n'
+                                'janedoe2\n'
+                                'janedoe3,asdfQWE123!,\n')
+                with patch.object(store, 'add_users', side_effect=add_users_late) as mock_add_users:
+                    report = bulk_enrol(path, max_workers=2)
+                mock_add_users.assert_called_once()  # All records in one batch
+
+            taken = 'Username already chosen! Backspace and choose again.'
+            self.assertEqual(report.enrolled, ['hubertdang', 'janedoe3'])
+            self.assertEqual(report.failures, [
+                EnrolmentFailure(3, 'hub', 'Usernames must be 6-12 characters long! Backspace and choose again.'),
+                EnrolmentFailure(4, 'johndoe1', 'Password too weak! Backspace and choose again.'),
+                EnrolmentFailure(5, 'hubertdang', taken),
+                EnrolmentFailure(6, 'existing1', taken),
+                EnrolmentFailure(7, 'latecomer', taken),
+                EnrolmentFailure(8, 'janedoe1', 'Unknown role(s): Janitor'),
+                EnrolmentFailure(9, '', 'Malformed row: missing username or password'),
+            ])
+            self.assertTrue(ph.verify(get_user_passwd_record('hubertdang').hash_str, 'asdfQWE123!'))
+            self.assertEqual(get_user_roles_record('hubertdang').roles, {Role.CLIENT, Role.PREMIUM_CLIENT})
+            self.assertEqual(get_user_roles_record('janedoe3').roles, set())
+
+            # Rows of the wrong types fail on their own, and roles are optional
+            # in both formats
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = Path(tmp_dir) / 'users.jsonl'
+                path.write_text('{"username": 12345678, "password": "asdfQWE123!"}\n'
+                                '{"username": "johndoe2", "password": 12345678}\n'
+                                '{"username": "johndoe3", "password": "asdfQWE123!", "roles": "Client"}\n'
+                                '{"username": "johndoe4", "password": "asdfQWE123!", "roles": [1]}\n'
+                                '["johndoe5"]\n'
+                                '{"username": "johndoe6", "password": "asdfQWE123!"}\n')
+                report = bulk_enrol(path, max_workers=2)
+                self.assertEqual(report.enrolled, ['johndoe6'])
+                self.assertEqual([(failure.line_num, failure.uname) for failure in report.failures],
+                                 [(1, '12345678'), (2, 'johndoe2'), (3, 'johndoe3'), (4, 'johndoe4'), (5, '')])
+                self.assertTrue(all(failure.reason.startswith('Malformed row: ') for failure in report.failures))
+
+                path = Path(tmp_dir) / 'users.csv'
+                path.write_text('username,password\njohndoe7,asdfQWE123!\n')
+                self.assertEqual(bulk_enrol(path, max_workers=2), (['johndoe7'], []))
+
         def test_add_get_user_roles_record(self):
             uname = 'hubertdang'
             roles = ['Client', 'Premium Client']
@@ -105,4 +226,409 @@ if __name__ == "__main__":
             record = get_user_roles_record(uname)
             self.assertEqual(record.roles, set())
 
+        def test_roles_cache(self):
+            roles_cache = get_user_store().roles_cache
+            add_user_roles_record('hubertdang', ['Client'])
+            hits = roles_cache.hits
+            self.assertEqual(get_user_roles_record(
+                'hubertdang').roles, {Role.CLIENT})
+            self.assertEqual(get_user_roles_record(
+                'hubertdang').roles, {Role.CLIENT})
+            self.assertEqual(roles_cache.hits, hits + 2)
+
+            # Appended records are picked up without a full reload
+            reloads = roles_cache.reloads
+            add_user_roles_record('johndoe', ['Teller'])
+            self.assertEqual(get_user_roles_record(
+                'johndoe').roles, {Role.TELLER})
+            self.assertEqual(roles_cache.reloads, reloads)
+
+        def test_roles_lru_cache(self):
+            cache = RecordCache(ROLES_FILE, parse_roles,
+                                max_entries=1, loader=get_user_store().scan_roles)
+            self.assertIsNone(cache.get('hubertdang'))
+
+            # Negative lookups are invalidated when the record is appended
+            add_user_roles_record('hubertdang', ['Client'])
+            self.assertEqual(cache.get('hubertdang'), {Role.CLIENT})
+
+            add_user_roles_record('johndoe', ['Teller'])
+            self.assertEqual(cache.get('johndoe'), {Role.TELLER})
+            self.assertEqual(cache.stats()['entries'], 1)
+            self.assertEqual(cache.evictions, 1)
+
+        def test_compiled_weak_passwd_db(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                src_path = Path(tmp_dir) / 'weak_passwd.txt'
+                db_path = Path(tmp_dir) / 'weak_passwd.db'
+                bloom_path = Path(tmp_dir) / 'weak_passwd.bloom'
+                weak_passwds = [f'weak{i}' for i in range(10000)]
+                src_path.write_text('\n'.join(weak_passwds) + '\n')
+
+                db = WeakPasswdDB(src_path, db_path, bloom_path)
+                self.assertFalse(db.is_current())  # Not compiled yet
+
+                self.assertEqual(build_weak_passwd_db(
+                    src_path, db_path, bloom_path), len(weak_passwds))
+                self.assertTrue(db.is_current())
+                for passwd in weak_passwds:
+                    self.assertIn(passwd, db)
+                for i in range(1000):
+                    self.assertNotIn(f'strong{i}', db)
+
+                # Editing the source list makes the compiled list stale
+                with open(src_path, 'a') as src_file:
+                    src_file.write('newweak\n')
+                self.assertFalse(db.is_current())
+                db.close()
+
+        def test_sqlite_user_store(self):
+            # A backend missing part of the store API fails when it's created
+            class PartialUserStore(UserStore):
+                def get_passwd_hash(self, uname):
+                    return None
+            self.assertRaises(TypeError, PartialUserStore)
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store = SQLiteUserStore(Path(tmp_dir) / 'users.db')
+                self.assertIsNone(store.get_login_record('hubertdang'))
+
+                store.add_passwd_record('hubertdang', 'hash1')
+                self.assertEqual(store.get_login_record(
+                    'hubertdang'), ('hash1', None))
+                store.add_roles_record('hubertdang', ['Client', 'Teller'])
+                store.add_passwd_record('hubertdang', 'hash2')  # Latest wins
+                self.assertEqual(store.get_login_record('hubertdang'),
+                                 ('hash2', {Role.CLIENT, Role.TELLER}))
+
+                store.add_users([NewUser('johndoe', 'hash3', [])])
+                self.assertEqual(store.get_roles('johndoe'), set())
+                self.assertEqual(store.get_passwd_hash('johndoe'), 'hash3')
+
+                # Round trip through the flat files
+                flat_store = FlatFileUserStore(Path(tmp_dir) / 'passwd.txt', Path(tmp_dir) / 'roles.txt',
+                                               Path(tmp_dir) / 'passwd.idx')
+                self.assertEqual(migrate_user_store(store, flat_store), (2, 2))
+                self.assertEqual(flat_store.get_login_record('hubertdang'),
+                                 ('hash2', {Role.CLIENT, Role.TELLER}))
+                self.assertEqual(flat_store.get_login_record('johndoe'),
+                                 ('hash3', set()))
+
+                # Updates and deletes
+                for user_store in [store, flat_store]:
+                    self.assertTrue(user_store.set_roles(
+                        'hubertdang', ['Client']))
+                    self.assertFalse(user_store.set_roles(
+                        'idontexist', ['Client']))
+                    self.assertTrue(user_store.delete_user('johndoe'))
+                    self.assertFalse(user_store.delete_user('johndoe'))
+                    self.assertIsNone(user_store.get_login_record('johndoe'))
+                    self.assertEqual(user_store.get_login_record('hubertdang'),
+                                     ('hash2', {Role.CLIENT}))
+                    user_store.compact()
+                    self.assertEqual(list(user_store.iter_roles_records()),
+                                     [('hubertdang', ['Client'])])
+
+                    # Enrolments never replace a taken username, and a
+                    # password change only lands on the hash it was based on
+                    self.assertEqual(user_store.add_users([NewUser('hubertdang', 'hash9', []),
+                                                           NewUser('janedoe', 'hash4', None),
+                                                           NewUser('janedoe', 'hash5', [])]),
+                                     ['hubertdang', 'janedoe'])
+                    self.assertEqual(user_store.get_login_record('hubertdang'),
+                                     ('hash2', {Role.CLIENT}))
+                    self.assertEqual(user_store.get_login_record('janedoe'), ('hash4', None))
+                    self.assertFalse(user_store.update_passwd_hash('janedoe', 'hash6', 'hash5'))
+                    self.assertTrue(user_store.update_passwd_hash('janedoe', 'hash6', 'hash4'))
+                    self.assertEqual(user_store.get_passwd_hash('janedoe'), 'hash6')
+                store.close()
+                flat_store.close()
+
+        def test_sessions(self):
+            now = [datetime.datetime(2026, 10, 19, 10, 0, 0)]  # A Monday
+            schedule = RoleSchedule({Role.CLIENT: [TimeWindow(datetime.time(0, 0, 0), datetime.time(23, 59, 59))],
+                                     Role.TELLER: [TimeWindow(datetime.time(9, 0, 0), datetime.time(17, 0, 0))]},
+                                    ROLE_BITS, clock=lambda: now[0])
+            sessions = SessionStore(schedule=schedule)
+            previous_sessions = get_session_store()
+            set_session_store(sessions)
+            try:
+                get_user_store().add_users([NewUser('hubertdang', 'hash', ['Client']),
+                                            NewUser('johndoe', 'hash', ['Client', 'Teller'])])
+
+                token = sessions.create('hubertdang', {Role.CLIENT})
+                self.assertTrue(sessions.is_authorized(token, Operation.VIEW_OWN_ACCOUNT_BALANCE))
+                self.assertFalse(sessions.is_authorized(token, Operation.VIEW_ANY_ACCOUNT_BALANCE))
+                self.assertFalse(sessions.is_authorized('idontexist', Operation.VIEW_OWN_ACCOUNT_BALANCE))
+
+                # Roles changes end the user's sessions
+                self.assertTrue(set_user_roles_record('hubertdang', ['Client', 'Premium Client']))
+                self.assertIsNone(sessions.get(token))
+
+                # A mistyped role is reported, not raised
+                with self.assertRaises(SystemExit) as cm:
+                    set_roles_cmd(argparse.Namespace(uname='hubertdang', roles=['Client', 'Janitor']))
+                self.assertEqual(str(cm.exception), 'Unknown role: Janitor')
+                self.assertEqual(get_user_roles_record('hubertdang').roles, {Role.CLIENT, Role.PREMIUM_CLIENT})
+
+                # Even when made by another process, after a recheck
+                token = sessions.create('hubertdang', {Role.CLIENT, Role.PREMIUM_CLIENT})
+                get_user_store().add_roles_record('hubertdang', ['Client'])
+                self.assertIsNotNone(sessions.get(token))
+                now[0] += datetime.timedelta(seconds=5)
+                self.assertIsNone(sessions.get(token))
+
+                # Sessions end when one of their roles' windows closes
+                token = sessions.create('johndoe', {Role.CLIENT, Role.TELLER})
+                self.assertTrue(sessions.is_authorized(token, Operation.VIEW_OWN_ACCOUNT_BALANCE))
+                now[0] = datetime.datetime(2026, 10, 19, 17, 0, 1)
+                self.assertIsNone(sessions.get(token))
+
+                # ... but sessions started outside them grant nothing until they open
+                now[0] = datetime.datetime(2026, 10, 20, 8, 50, 0)
+                token = sessions.create('johndoe', {Role.CLIENT, Role.TELLER})
+                self.assertEqual(sessions.get(token).get_authorized_operations(), set())
+                now[0] = datetime.datetime(2026, 10, 20, 9, 0, 0)
+                self.assertTrue(sessions.is_authorized(token, Operation.VIEW_OWN_ACCOUNT_BALANCE))
+
+                # Deleting users and expiry
+                self.assertTrue(delete_user('johndoe'))
+                self.assertIsNone(sessions.get(token))
+                token = sessions.create('hubertdang', {Role.CLIENT})
+                now[0] += sessions.ttl
+                self.assertIsNone(sessions.get(token))
+                self.assertEqual(sessions.stats(), {'sessions': 0, 'users': 0})
+            finally:
+                set_session_store(previous_sessions)
+
+        def test_log_structured_user_store(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                passwd_file = Path(tmp_dir) / 'passwd.txt'
+                store = FlatFileUserStore(passwd_file, Path(tmp_dir) / 'roles.txt',
+                                          Path(tmp_dir) / 'passwd.idx', passwd_cache_max_entries=10)
+                store.add_users([NewUser(f'user{i}', 'hash', ['Client'])
+                                 for i in range(100)])
+                for i in range(0, 100, 2):
+                    self.assertTrue(
+                        store.update_passwd_hash(f'user{i}', 'newhash'))
+                for i in range(0, 100, 4):
+                    self.assertTrue(store.delete_user(f'user{i}'))
+                self.assertFalse(store.update_passwd_hash('user0', 'hash'))
+
+                # Latest versions win, deleted users are gone
+                self.assertIsNone(store.get_passwd_hash('user0'))
+                self.assertEqual(store.get_passwd_hash('user2'), 'newhash')
+                self.assertEqual(store.get_passwd_hash('user3'), 'hash')
+                self.assertEqual(len(store.passwd_index), 75)
+                self.assertAlmostEqual(store.garbage_ratio(), 1 - 75 / 175)
+
+                size = passwd_file.stat().st_size
+                store.compact()
+                self.assertLess(passwd_file.stat().st_size, size)
+                self.assertEqual(store.garbage_ratio(), 0)
+                self.assertEqual(len(dict(store.iter_passwd_records())), 75)
+                self.assertIsNone(store.get_passwd_hash('user4'))
+                self.assertEqual(store.get_login_record('user2'),
+                                 ('newhash', {Role.CLIENT}))
+
+                # Deleted usernames can be enrolled again
+                store.add_users([NewUser('user0', 'hash0', [])])
+                self.assertEqual(store.get_login_record('user0'), ('hash0', set()))
+                store.close()
+
+        def test_group_commit(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store = FlatFileUserStore(Path(tmp_dir) / 'passwd.txt', Path(tmp_dir) / 'roles.txt',
+                                          Path(tmp_dir) / 'passwd.idx', group_commit_max_delay=0.01)
+                unames = [f'user{i:04d}' for i in range(200)]
+                with ThreadPoolExecutor(max_workers=20) as executor:
+                    list(executor.map(lambda uname: store.add_users(
+                        [NewUser(uname, 'hash_' + uname, ['Client'])]), unames))
+
+                # Concurrent enrolments shared writes and fsyncs
+                stats = store.writer.stats()
+                self.assertEqual(stats['writes'], len(unames))
+                self.assertLess(stats['commits'], len(unames))
+
+                # Every record landed whole, with the roles alongside it
+                passwd_records = dict(store.iter_passwd_records())
+                self.assertEqual(sorted(passwd_records), unames)
+                for uname in unames:
+                    self.assertEqual(store.get_login_record(uname),
+                                     ('hash_' + uname, {Role.CLIENT}))
+
+                # Of concurrent enrolments of one username, only one gets it,
+                # even when they share a group commit
+                with ThreadPoolExecutor(max_workers=20) as executor:
+                    taken = list(executor.map(lambda i: store.add_users(
+                        [NewUser('contested', f'hash{i}', [])]), range(20)))
+                winners = [i for i, unames_taken in enumerate(taken) if not unames_taken]
+                self.assertEqual(len(winners), 1)
+                self.assertEqual(store.get_passwd_hash('contested'), f'hash{winners[0]}')
+                store.close()
+
+                # A writer may read under its exclusive lock, but a reader
+                # can't quietly write under a shared one
+                with locked(store.passwd_file, exclusive=True), locked(store.passwd_file):
+                    pass
+                with locked(store.passwd_file):
+                    with self.assertRaises(RuntimeError):
+                        with locked(store.passwd_file, exclusive=True):
+                            pass
+
+        def test_role_index(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                index_file = Path(tmp_dir) / 'roles.ridx'
+                store = FlatFileUserStore(Path(tmp_dir) / 'passwd.txt', Path(tmp_dir) / 'roles.txt',
+                                          Path(tmp_dir) / 'passwd.idx', roles_index_file=index_file)
+                store.add_users([NewUser(f'client{i}', 'hash', ['Client']) for i in range(20)]
+                                + [NewUser(f'premium{i}', 'hash', ['Client', 'Premium Client'])
+                                   for i in range(5)]
+                                + [NewUser('teller', 'hash', ['Employee', 'Teller']),
+                                   NewUser('advisor', 'hash', ['Employee', 'Financial Advisor'])])
+                index = store.role_index
+                clients = index.users_with_role(Role.CLIENT)
+                employees = index.users_with_role(Role.EMPLOYEE)
+                self.assertEqual(len(clients), 25)
+                self.assertEqual(len(clients - index.users_with_role(Role.PREMIUM_CLIENT)), 20)
+                self.assertEqual(set(employees & index.users_with_role(Role.TELLER)), {'teller'})
+                self.assertEqual(len(employees | index.users_with_role(Role.PREMIUM_CLIENT)), 7)
+                self.assertEqual(set(~clients), {'teller', 'advisor'})
+
+                # Holders of a role inheriting it count too, and roles can be
+                # given by name
+                store.add_users([NewUser('premiumonly', 'hash', ['Premium Client'])])
+                self.assertIn('premiumonly', index.users_with_role('Client'))
+                self.assertNotIn('premiumonly', index.users_with_role(Role.EMPLOYEE))
+                self.assertRaises(ValueError, index.users_with_role, 'Janitor')
+                store.delete_user('premiumonly')
+                self.assertEqual(set(index.users_with_operation(Operation.MODIFY_ANY_INVESTMENT_PORTFOLIO)),
+                                 {'advisor'})
+
+                # Only users whose roles are all active are granted anything
+                active_mask = ROLE_BITS[Role.EMPLOYEE] | ROLE_BITS[Role.FINANCIAL_ADVISOR]
+                self.assertEqual(set(index.users_with_operation(Operation.VIEW_ANY_ACCOUNT_BALANCE,
+                                                                active_mask)), {'advisor'})
+
+                # Records appended since are picked up, latest record wins
+                store.set_roles('client0', ['Employee'])
+                store.delete_user('client1')
+                self.assertIn('client0', index.users_with_role(Role.EMPLOYEE))
+                self.assertNotIn('client0', index.users_with_role(Role.CLIENT))
+                self.assertNotIn('client1', index.all_users())
+                self.assertEqual(len(index.users_with_role(Role.CLIENT)), 23)
+                store.close()
+
+                # Loaded back from disk, then caught up on new records
+                store.add_users([NewUser('client1', 'hash', ['Client'])])
+                reloaded = RoleIndex(Path(tmp_dir) / 'roles.txt', index_file)
+                self.assertEqual(len(reloaded.users_with_role(Role.CLIENT)), 24)
+                self.assertEqual(len(reloaded.all_users()), 27)
+                reloaded.close()
+
+                # Rebuilt after compaction replaces the roles file
+                store.compact()
+                self.assertEqual(len(store.role_index.users_with_role(Role.CLIENT)), 24)
+                self.assertEqual(store.rebuild_role_index(), 27)
+                store.close()
+
+        def test_verify_user_store(self):
+            from argon2 import PasswordHasher, Type
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store = FlatFileUserStore(Path(tmp_dir) / 'passwd.txt', Path(tmp_dir) / 'roles.txt',
+                                          Path(tmp_dir) / 'passwd.idx')
+                hash_str = ph.hash('secret')
+                store.add_users([NewUser(f'user{i:03d}', hash_str, ['Client']) for i in range(100)])
+                store.update_passwd_hash('user000', 'garbage')
+                outdated_ph = PasswordHasher(time_cost=1, memory_cost=64, parallelism=1, type=Type.ID)
+                store.update_passwd_hash('user001', outdated_ph.hash('secret'))
+                store.update_passwd_hash('user002', PasswordHasher(type=Type.I).hash('secret'))
+                store.set_roles('user003', ['Client', 'Janitor'])
+                store.add_passwd_records([('orphan', hash_str)])
+                store.add_roles_records([('rolesonly', ['Client'])])
+                store.update_passwd_hash('user004', hash_str[:-1] + '*')  # Corrupted
+                store.update_passwd_hash('user005', hash_str[:-1] + '*')
+                store.delete_user('user004')  # Deleted users aren't checked
+
+                # Split into several partitions, checked on two processes
+                export_path = Path(tmp_dir) / 'users.jsonl'
+                report = verify_user_store(store, workers=2, export_path=export_path,
+                                           partition_bytes=4096, max_reported_problems=3)
+                self.assertEqual(report.num_users, 101)
+                self.assertEqual(report.problem_counts, {
+                    'malformed_hash': 2, 'outdated_params': 1, 'not_argon2id': 1,
+                    'unknown_role': 1, 'no_roles_record': 1, 'no_passwd_record': 1})
+                self.assertEqual((report.num_problems, len(report.problems)), (7, 3))
+
+                exported = {record['uname']: record for record in
+                            map(json.loads, export_path.read_text().splitlines())}
+                self.assertEqual(report.num_exported, len(exported))
+                self.assertEqual(len(exported), 101)
+                self.assertEqual(exported['user003']['roles'], ['Client', 'Janitor'])
+                self.assertIsNone(exported['orphan']['roles'])
+
+                # The SQLite export is a user store
+                db_path = Path(tmp_dir) / 'users.db'
+                report = verify_user_store(store, workers=1, export_path=db_path)
+                self.assertEqual(report.num_problems, 7)
+                exported_store = SQLiteUserStore(db_path)
+                self.assertEqual(exported_store.get_login_record('user006'), (hash_str, {Role.CLIENT}))
+                self.assertEqual(len(dict(exported_store.iter_passwd_records())), 100)
+                exported_store.close()
+                self.assertRaises(FileExistsError, verify_user_store, store, export_path=db_path)
+                store.close()
+
+        def test_sharded_user_store(self):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store = ShardedUserStore(Path(tmp_dir), initial_shards=2, fsync=False)
+                store.add_users([NewUser(f'user{i:04d}', f'hash{i}', ['Client']) for i in range(200)])
+                store.delete_user('user0000')
+                store.set_roles('user0001', ['Employee'])
+                self.assertTrue(all(stats['users'] for stats in store.shard_stats()))
+                self.assertEqual(sum(stats['users'] for stats in store.shard_stats()), 199)
+                self.assertEqual(store.get_login_record('user0002'), ('hash2', {Role.CLIENT}))
+
+                # Split while another thread keeps enrolling and a second
+                # router (as in another process) looks users up
+                other = ShardedUserStore(Path(tmp_dir), check_interval=0, fsync=False)
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    enrolling = executor.submit(lambda: [
+                        store.add_users([NewUser(f'new{i:04d}', f'hash{i}', [])]) for i in range(100)])
+                    low, high = store.split_shard('shard-1-0')
+                    enrolling.result()
+                self.assertEqual((low, high), ('shard-2-0', 'shard-2-2'))
+                self.assertEqual(sorted(store.shards()), ['shard-1-1', 'shard-2-0', 'shard-2-2'])
+                self.assertRaises(ValueError, store.split_shard, 'shard-1-0')
+
+                for router in (store, other):
+                    self.assertIsNone(router.get_passwd_hash('user0000'))
+                    self.assertEqual(router.get_roles('user0001'), {Role.EMPLOYEE})
+                    for i in range(1, 200):
+                        self.assertEqual(router.get_passwd_hash(f'user{i:04d}'), f'hash{i}')
+                    for i in range(100):
+                        self.assertEqual(router.get_login_record(f'new{i:04d}'), (f'hash{i}', set()))
+                self.assertEqual(len(dict(other.iter_passwd_records())), 299)
+                self.assertEqual(sum(stats['users'] for stats in store.shard_stats()), 299)
+
+                # Writes through the other router land in the new shards
+                other.add_users([NewUser('latecomer', 'hash', ['Client'])])
+                self.assertEqual(store.get_login_record('latecomer'), ('hash', {Role.CLIENT}))
+
+                # Entitlement queries cover every shard
+                args = argparse.Namespace(roles=['Client'], without_roles=[], operations=[],
+                                          any=False, count=False)
+                previous_store = get_user_store()
+                set_user_store(store)
+                try:
+                    with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                        users_with_cmd(args)
+                    self.assertEqual(sorted(stdout.getvalue().split()),
+                                     sorted([f'user{i:04d}' for i in range(2, 200)] + ['latecomer']))
+                    with self.assertRaises(SystemExit):
+                        users_with_cmd(argparse.Namespace(**{**vars(args), 'roles': ['Janitor']}))
+                finally:
+                    set_user_store(previous_store)
+                other.close()
+                store.close()
+
     unittest.main()
@@ -1,8 +1,131 @@
-import questionary
+import asyncio
 from argon2.exceptions import VerifyMismatchError
-from problem1c import Operation, get_authorized_operations
-from problem2c import ph, get_user_passwd_record
-from problem3ab import get_user_roles_record
+import metrics
+from audit import audit_login
+from problem1c import Operation, Role, get_authorized_operations
+from hash_pool import HashServiceBusy, get_hash_service
+from problem2c import get_password_hasher, rehash_user_passwd_if_needed
+from throttle import LoginThrottle, LoginThrottled, get_login_throttle
+from user_store import LoginRecord, get_user_store
+
+
+INVALID_CREDENTIALS_MESSAGE = 'Login failed! Invalid user credentials!'
+INVALID_PASSWD_MESSAGE = 'Login failed! Invalid password!'
+LOGIN_BUSY_MESSAGE = 'Login failed! Too many logins in progress, try again shortly.'
+
+LOGINS = metrics.counter(
+    'auth_logins_total', 'Login attempts by outcome (success, unknown_user or wrong_passwd)')
+LOGIN_RECORD_LATENCY = metrics.histogram(
+    'auth_login_record_lookup_seconds', 'Time spent looking up password hashes and roles on login')
+VERIFY_LATENCY = metrics.histogram(
+    'auth_argon2_verify_seconds', 'Time spent verifying passwords, including any wait for a worker')
+
+
+def check_login_throttle(throttle: LoginThrottle, uname: str, source: str | None) -> None:
+    """
+    Lets a login attempt past the throttle, auditing it if it's rejected.
+    """
+    try:
+        throttle.check(uname, source)
+    except LoginThrottled as e:
+        audit_login(uname, 'throttled', source, reason=e.reason)
+        raise
+    except HashServiceBusy:
+        audit_login(uname, 'overloaded', source)
+        raise
+
+
+def _start_login(uname: str, source: str | None) -> tuple[LoginThrottle, LoginRecord | None]:
+    """
+    Lets a login attempt past the throttle and looks up the user's password
+    hash and roles, logging the attempt if the user doesn't exist.
+    """
+    throttle = get_login_throttle()
+    check_login_throttle(throttle, uname, source)  # Before any hashing
+
+    # Password hash and roles in one lookup
+    with LOGIN_RECORD_LATENCY.time():
+        login_record = get_user_store().get_login_record(uname)
+    if login_record is None:
+        _log_login(uname, source, 'unknown_user')
+    return throttle, login_record
+
+
+def _finish_login(throttle: LoginThrottle, uname: str, source: str | None, verified: bool) -> None:
+    if verified:
+        throttle.record_success(uname)
+    else:
+        throttle.record_failure(uname)
+    _log_login(uname, source, 'success' if verified else 'wrong_passwd')
+
+
+def _log_login(uname: str, source: str | None, outcome: str) -> None:
+    audit_login(uname, outcome, source)
+    if metrics.ENABLED:
+        LOGINS.inc(outcome=outcome)
+
+
+@metrics.timed('auth_login_seconds', 'Time spent logging users in')
+def login_user(uname: str, plaintext_passwd: str, source: str | None = None) -> set[Role] | str:
+    """
+    Logs a user in without any prompts. `source` (e.g. the client's IP
+    address) is rate limited on top of the username.
+
+    Returns:
+        The user's roles if they successfully logged in.
+        String error message otherwise.
+
+    Raises:
+        LoginThrottled if the attempt was rejected by the login throttle.
+        HashServiceBusy if the hash service is saturated.
+    """
+    throttle, login_record = _start_login(uname, source)
+    if login_record is None:
+        return INVALID_CREDENTIALS_MESSAGE
+    try:
+        # raises VerifyMismatchError if verification fails, pass otherwise
+        with VERIFY_LATENCY.time():
+            get_hash_service().verify(login_record.hash_str, plaintext_passwd)
+        verified = True
+    except VerifyMismatchError:
+        verified = False
+    _finish_login(throttle, uname, source, verified)
+    if not verified:
+        return INVALID_PASSWD_MESSAGE
+
+    # Migrate the stored hash to the current Argon2 parameters
+    rehash_user_passwd_if_needed(
+        uname, login_record.hash_str, plaintext_passwd)
+    return login_record.roles or set()
+
+
+@metrics.timed('auth_login_seconds', 'Time spent logging users in')
+async def login_user_async(uname: str, plaintext_passwd: str, source: str | None = None) -> set[Role] | str:
+    """
+    Same as login_user, but waits for password verification, and any
+    rehash, without blocking the event loop.
+    """
+    # The lookup may wait on the store's file locks
+    throttle, login_record = await asyncio.to_thread(_start_login, uname, source)
+    if login_record is None:
+        return INVALID_CREDENTIALS_MESSAGE
+    try:
+        with VERIFY_LATENCY.time():
+            await get_hash_service().averify(login_record.hash_str, plaintext_passwd)
+        verified = True
+    except VerifyMismatchError:
+        verified = False
+    _finish_login(throttle, uname, source, verified)
+    if not verified:
+        return INVALID_PASSWD_MESSAGE
+
+    if get_password_hasher().check_needs_rehash(login_record.hash_str):
+        hash_str = await get_hash_service().ahash(plaintext_passwd)
+        # Waits for a group commit, and is skipped if the password was
+        # changed since it was verified
+        await asyncio.to_thread(get_user_store().update_passwd_hash,
+                                uname, hash_str, login_record.hash_str)
+    return login_record.roles or set()
 
 
 def login_user_cli():
@@ -11,34 +134,42 @@ def login_user_cli():
     (https://questionary.readthedocs.io/en/stable/pages/quickstart.html) to
     log a user into the system.
     """
+    import questionary  # Slow to import, and only needed for the prompts
+
     uname = questionary.text('Enter your username: ').ask()
     plaintext_passwd = questionary.password('Enter your password: ').ask()
 
-    user_passwd_record = get_user_passwd_record(uname)
-    if user_passwd_record:
-        try:
-            # raises VerifyMismatchError if verification fails, pass otherwise
-            ph.verify(user_passwd_record.hash_str, plaintext_passwd)
+    try:
+        roles = login_user(uname, plaintext_passwd)
+    except LoginThrottled as e:
+        print(e.message)
+        return
+    except HashServiceBusy:
+        print(LOGIN_BUSY_MESSAGE)
+        return
+    if isinstance(roles, str):
+        print(roles)
+        return
 
-            # At this point, user has successfully logged in
-            user_roles_record = get_user_roles_record(uname)
-            print('\nUsername: ' + uname)
+    # At this point, user has successfully logged in
+    print_login_summary(uname, roles)
 
-            roles_str = ", ".join(
-                sorted(role.value for role in user_roles_record.roles))
-            print('Role(s): ' + roles_str)
 
-            print('\nSystem operations:')
-            for operation in Operation:
-                print('- ' + operation.value)
+def print_login_summary(uname: str, roles: set[Role]) -> None:
+    """
+    Prints a logged in user's roles and authorized operations.
+    """
+    print('\nUsername: ' + uname)
 
-            authorized_operations = get_authorized_operations(
-                user_roles_record.roles)
-            print('\nAuthorized operations:')
-            for operation in authorized_operations:
-                print('- ' + operation.value)
+    roles_str = ", ".join(
+        sorted(role.value for role in roles))
+    print('Role(s): ' + roles_str)
 
-        except VerifyMismatchError:
-            print('Login failed! Invalid password!')
-    else:
-        print('Login failed! Invalid user credentials!')
+    print('\nSystem operations:')
+    for operation in Operation:
+        print('- ' + operation.value)
+
+    authorized_operations = get_authorized_operations(roles)
+    print('\nAuthorized operations:')
+    for operation in authorized_operations:
+        print('- ' + operation.value)
@@ -0,0 +1,242 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Iterable, Set
+from role_schedule import ALL_WEEKDAYS, RoleSchedule, TimeWindow
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the policy file for changes
+RELOAD_CHECK_INTERVAL = 1.0
+
+
+class RbacPolicy:
+    """
+    An authorization policy compiled for table lookups: each role's
+    operations, the roles it inherits from and its active windows.
+
+    Inheritance is transitive, and a role is only usable while every role it
+    inherits from is active too. At construction, each role is expanded to
+    its closure (itself and every role it inherits from, directly or not),
+    and then every combination of roles is compiled to the mask of roles it
+    expands to and the mask of operations it grants. Authorizing a user is
+    then a couple of lookups by their roles mask.
+
+    Roles and operations are members of the given enums. A role's bit is its
+    position in its enum, and the same goes for operations.
+    """
+
+    def __init__(self, role_type: type[Enum], operation_type: type[Enum],
+                 authorization_matrix: dict[Enum, Set[Enum]],
+                 inheritance: dict[Enum, Set[Enum]] | None = None,
+                 windows: dict[Enum, Iterable[TimeWindow]] | None = None,
+                 holidays: Iterable[datetime.date] = (),
+                 clock: Callable[[], datetime.datetime] = datetime.datetime.now):
+        self.role_type = role_type
+        self.operation_type = operation_type
+        roles = list(role_type)
+        self.role_bits = {role: 1 << i for i, role in enumerate(roles)}
+        self.operation_bits = {operation: 1 << i for i, operation in enumerate(operation_type)}
+
+        self.authorization_matrix = {role: frozenset(authorization_matrix.get(role, ()))
+                                     for role in roles}
+        self.inheritance = {role: frozenset((inheritance or {}).get(role, ())) for role in roles}
+        self.closures = {role: self._closure(role) for role in roles}
+        self.closure_masks = {role: self.roles_to_mask(closure)
+                              for role, closure in self.closures.items()}
+
+        # Operations granted by each role, inherited ones included
+        self.role_permission_masks = {}
+        for role, closure in self.closures.items():
+            permission_mask = 0
+            for inherited in closure:
+                for operation in self.authorization_matrix[inherited]:
+                    permission_mask |= self.operation_bits[operation]
+            self.role_permission_masks[role] = permission_mask
+
+        # Tables indexed by roles mask, each entry extending the one for the
+        # same roles minus the highest one
+        num_combinations = 1 << len(roles)
+        self.expanded_masks = [0] * num_combinations
+        self.permission_masks = [0] * num_combinations
+        for roles_mask in range(1, num_combinations):
+            highest_bit = 1 << (roles_mask.bit_length() - 1)
+            highest_role = roles[highest_bit.bit_length() - 1]
+            rest = roles_mask ^ highest_bit
+            self.expanded_masks[roles_mask] = self.expanded_masks[rest] | self.closure_masks[highest_role]
+            self.permission_masks[roles_mask] = (self.permission_masks[rest]
+                                                 | self.role_permission_masks[highest_role])
+
+        # Operations granted by each permission mask, decoded once up front
+        self.permission_sets: list[frozenset[Enum]] = [
+            frozenset(operation for operation, bit in self.operation_bits.items()
+                      if permission_mask & bit)
+            for permission_mask in self.permission_masks
+        ]
+
+        self.schedule = RoleSchedule(windows if windows is not None else {},
+                                     self.role_bits, holidays, clock)
+
+    @classmethod
+    def from_dict(cls, rules: dict, default: 'RbacPolicy') -> 'RbacPolicy':
+        """
+        Makes a policy from a dict shaped like rbac_policy.json (see the
+        README), where anything left out keeps its value in `default`.
+        Raises ValueError for unknown roles, operations or keys, malformed
+        times and dates, and inheritance cycles.
+        """
+        unknown_keys = set(rules) - {'roles', 'holidays'}
+        if unknown_keys:
+            raise ValueError(f'Invalid RBAC policy: unknown keys {sorted(unknown_keys)}')
+
+        authorization_matrix = dict(default.authorization_matrix)
+        inheritance = dict(default.inheritance)
+        windows = dict(default.schedule.windows)
+        holidays = default.schedule.holidays
+        try:
+            for role_name, role_rules in rules.get('roles', {}).items():
+                role = default.role_type(role_name)
+                unknown_keys = set(role_rules) - {'operations', 'inherits', 'active'}
+                if unknown_keys:
+                    raise ValueError(f'unknown keys {sorted(unknown_keys)} for {role_name}')
+                if 'operations' in role_rules:
+                    authorization_matrix[role] = {default.operation_type[name]
+                                                  for name in role_rules['operations']}
+                if 'inherits' in role_rules:
+                    inheritance[role] = {default.role_type(name) for name in role_rules['inherits']}
+                if 'active' in role_rules:
+                    windows[role] = [_parse_window(window) for window in role_rules['active']]
+            if 'holidays' in rules:
+                holidays = {datetime.date.fromisoformat(date) for date in rules['holidays']}
+        except KeyError as e:
+            raise ValueError(f'Invalid RBAC policy: unknown operation {e}') from e
+        except (TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f'Invalid RBAC policy: {e}') from e
+
+        return cls(default.role_type, default.operation_type, authorization_matrix, inheritance,
+                   windows, holidays, default.schedule.clock)
+
+    def roles_to_mask(self, roles: Iterable[Enum]) -> int:
+        roles_mask = 0
+        for role in roles:
+            roles_mask |= self.role_bits[role]
+        return roles_mask
+
+    def roles_granting(self, operation: Enum) -> list[Enum]:
+        """
+        Get the roles granting an operation, directly or through inheritance.
+        """
+        bit = self.operation_bits[operation]
+        return [role for role, permission_mask in self.role_permission_masks.items()
+                if permission_mask & bit]
+
+    def _closure(self, role: Enum, path: tuple[Enum, ...] = ()) -> frozenset[Enum]:
+        if role in path:
+            cycle = ' -> '.join(r.value for r in path[path.index(role):] + (role,))
+            raise ValueError(f'Invalid RBAC policy: role inheritance cycle {cycle}')
+        closure = {role}
+        for inherited in self.inheritance[role]:
+            closure |= self._closure(inherited, path + (role,))
+        return frozenset(closure)
+
+
+def _parse_window(window: dict) -> TimeWindow:
+    unknown_keys = set(window) - {'start', 'end', 'weekdays', 'on_holidays'}
+    if unknown_keys:
+        raise ValueError(f'unknown keys {sorted(unknown_keys)} for an active window')
+    if 'start' not in window or 'end' not in window:
+        raise ValueError('active windows need a start and an end')
+    weekdays = frozenset(window.get('weekdays', ALL_WEEKDAYS))
+    if not weekdays <= ALL_WEEKDAYS:
+        raise ValueError(f'weekdays must be 0 (Monday) to 6, not {sorted(weekdays)}')
+    return TimeWindow(datetime.time.fromisoformat(window['start']),
+                      datetime.time.fromisoformat(window['end']),
+                      weekdays, bool(window.get('on_holidays', True)))
+
+
+def load_rbac_policy(path: Path, default: RbacPolicy) -> RbacPolicy:
+    """
+    Loads a policy from a JSON file, falling back to `default` for anything
+    it doesn't set, or for everything if the file doesn't exist.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as policy_file:
+            rules = json.load(policy_file)
+    except FileNotFoundError:
+        return default
+    except json.JSONDecodeError as e:
+        raise ValueError(f'Invalid RBAC policy: {e}') from e
+    return RbacPolicy.from_dict(rules, default)
+
+
+class RbacPolicyFile:
+    """
+    Keeps a compiled policy in step with its file. The file is stat'ed at
+    most every `check_interval` seconds, and when it changed it's loaded and
+    compiled in full before it's swapped in with a single assignment, so
+    callers see either the old policy or the new one and never a mix. A file
+    that fails to load is logged and the policy in use is kept, or the
+    default one if it fails from the start.
+    """
+
+    def __init__(self, path: Path, default: RbacPolicy,
+                 check_interval: float = RELOAD_CHECK_INTERVAL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.path = Path(path)
+        self.default = default
+        self.check_interval = check_interval
+        self.clock = clock
+        self.reloads = 0
+
+        self._lock = threading.Lock()
+        self._file_id = self._stat()
+        try:
+            self._policy = load_rbac_policy(self.path, default)
+        except ValueError as e:
+            # Like other broken settings files, and picked up once it's fixed
+            logger.warning('Using the default RBAC policy, %s failed to load: %s', self.path, e)
+            self._policy = default
+        self._next_check = clock() + check_interval
+
+    def get(self) -> RbacPolicy:
+        """
+        Get the current policy, reloading it first if its file changed.
+        """
+        if self.clock() >= self._next_check:
+            self.reload()
+        return self._policy
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Reloads the policy if its file changed since it was last loaded.
+
+        Returns:
+            True if a new policy was swapped in.
+            False otherwise.
+        """
+        with self._lock:
+            self._next_check = self.clock() + self.check_interval
+            file_id = self._stat()
+            if file_id == self._file_id and not force:
+                return False
+            self._file_id = file_id  # Only warn once about a broken file
+            try:
+                policy = load_rbac_policy(self.path, self.default)
+            except ValueError as e:
+                logger.warning('Keeping the current RBAC policy, %s failed to load: %s', self.path, e)
+                return False
+            self._policy = policy
+            self.reloads += 1
+            return True
+
+    def _stat(self) -> tuple[int, int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
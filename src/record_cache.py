@@ -0,0 +1,175 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+import metrics
+from file_lock import locked
+from record_index import TOMBSTONE_PREFIX
+
+_MISSING = object()
+
+BYTES_READ = metrics.counter(
+    'auth_bytes_read_total', 'Bytes read from data files on lookups')
+
+
+class RecordCache:
+    """
+    In-process cache of the parsed records in a delimited text file, keyed by
+    the first field of each record. The file is stat'ed on every lookup: when
+    it only grew, just the appended tail is read, and when it was truncated or
+    replaced the cache starts over.
+
+    By default every record is loaded into memory once and misses are
+    answered from memory too. Passing `max_entries` switches to an LRU mode for
+    user bases too big to hold in memory, where misses are handed to `loader`
+    and the least recently used entries are evicted past the limit.
+
+    Like RecordIndex, lookups resolve to the latest record with a given key,
+    unless a later tombstone deleted it.
+    """
+
+    def __init__(self, path: Path, parse: Callable[[str], Any], delimiter: str = ':',
+                 max_entries: int | None = None, loader: Callable[[str], Any] | None = None):
+        if max_entries is not None and loader is None:
+            raise ValueError('LRU mode needs a loader for cache misses')
+
+        self.path = Path(path)
+        self.parse = parse
+        self.delimiter = delimiter
+        self.max_entries = max_entries
+        self.loader = loader
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+        self._records: OrderedDict[str, Any] = OrderedDict()
+        self._file_id = None  # (inode, size, mtime) at the last refresh
+        # Like RecordIndex, holds the file open so its inode can't be reused
+        # by a replacement file while the cache refers to it
+        self._fd: int | None = None
+        self._offset = 0  # Bytes of the file reflected in the cache
+        self._num_records = 0  # Records (live or not) read, in full mode
+
+    def get(self, key: str) -> Any:
+        """
+        Retrieves the parsed record with the given key.
+
+        Returns:
+            The record if it exists.
+            None otherwise.
+        """
+        self.refresh()
+
+        record = self._records.get(key, _MISSING)
+        if record is not _MISSING:
+            self.hits += 1
+            if self.max_entries is not None:
+                self._records.move_to_end(key)
+            return record
+
+        self.misses += 1
+        if self.max_entries is None:
+            return None  # Every record is loaded, so it doesn't exist
+
+        # Remember negative lookups too, they're invalidated by refresh()
+        record = self.loader(key)
+        self._records[key] = record
+        if len(self._records) > self.max_entries:
+            self._records.popitem(last=False)
+            self.evictions += 1
+        return record
+
+    def refresh(self) -> None:
+        """
+        Brings the cache up to date with the file.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+
+        if stat is None:
+            file_id = None
+        else:
+            file_id = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if file_id == self._file_id:
+            return
+
+        if (stat is None or self._file_id is None
+                or stat.st_ino != self._file_id[0] or stat.st_size <= self._offset):
+            # File is new, gone, truncated or rewritten in place
+            self.clear()
+            self.reloads += 1
+            if stat is not None:
+                try:
+                    self._fd = os.open(self.path, os.O_RDONLY)
+                except FileNotFoundError:
+                    return  # Replaced again since the stat, next refresh picks it up
+                stat = os.fstat(self._fd)
+                file_id = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if self.max_entries is not None and stat is not None:
+                # Nothing cached yet, so there's nothing in the file to
+                # invalidate. The loader reads records as they're needed.
+                self._offset = stat.st_size
+        self._file_id = file_id
+
+        if stat is not None and stat.st_size > self._offset:
+            self._read_tail()
+
+    def clear(self) -> None:
+        self._records.clear()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._file_id = None
+        self._offset = 0
+        self._num_records = 0
+
+    def garbage_ratio(self) -> float | None:
+        """
+        Share of the records in the file that were since updated or deleted,
+        or None in LRU mode, where the file isn't read in full.
+        """
+        if self.max_entries is not None:
+            return None
+        self.refresh()
+        if not self._num_records:
+            return 0.0
+        return 1 - len(self._records) / self._num_records
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self._records),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'reloads': self.reloads,
+        }
+
+    def _read_tail(self) -> None:
+        start = self._offset
+        # Shared lock, so a group commit in progress is read in full or not at all
+        with locked(self.path), open(self._fd, 'rb', closefd=False) as file:
+            file.seek(self._offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break  # Partially written record, pick it up next refresh
+                self._offset += len(line)
+
+                record = line.decode('utf-8').rstrip('\n')
+                key, sep, value = record.partition(self.delimiter)
+                if not sep:
+                    if not record.startswith(TOMBSTONE_PREFIX):
+                        continue
+                    key = record[len(TOMBSTONE_PREFIX):]
+                self._num_records += 1
+                if self.max_entries is None and sep:
+                    self._records[key] = self.parse(value)
+                else:
+                    # Deleted, or in LRU mode possibly cached as missing or
+                    # with an older version, so let the loader decide
+                    self._records.pop(key, None)
+        if metrics.ENABLED:
+            BYTES_READ.inc(self._offset - start, file=self.path.name)
@@ -0,0 +1,403 @@
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+import metrics
+from file_lock import locked, replacing
+
+INDEX_MAGIC = b'RIDX0002'
+
+# Header: magic, capacity (slots), count (keys, deleted ones included), live
+# keys, records (lines indexed), indexed data size, data inode, and the
+# source_checksum() of the indexed data
+INDEX_HEADER = struct.Struct('<8sQQQQQQQ')
+
+# Slot: 64-bit key hash, record offset + 1 (0 marks an empty slot)
+INDEX_SLOT = struct.Struct('<QQ')
+
+MIN_INDEX_CAPACITY = 1024  # Must be a power of two
+MAX_LOAD_FACTOR = 0.5
+
+RECORD_READ_SIZE = 256  # Enough for a username and an Argon2 hash string
+
+# A line made of this prefix and a key deletes every earlier record with that key
+TOMBSTONE_PREFIX = '-'
+
+# Bytes before the indexed size checksummed to tell a data file from another
+# one that got the same inode, e.g. after it was deleted and recreated
+SOURCE_CHECK_BYTES = 4096
+
+BYTES_READ = metrics.counter(
+    'auth_bytes_read_total', 'Bytes read from data files on lookups')
+
+
+def source_checksum(fd: int, size: int) -> int:
+    """
+    Checksums the last SOURCE_CHECK_BYTES of the first `size` bytes of a file.
+    Persistent indexes record it with the size and inode they were built up
+    to: inodes are reused once no process holds a file open, so a file with
+    the same inode and at least the same size may still be a different one.
+    """
+    start = max(0, size - SOURCE_CHECK_BYTES)
+    return zlib.crc32(os.pread(fd, size - start, start))
+
+
+def hash_key(key: bytes) -> int:
+    """
+    Stable 64-bit hash of a record key. Python's built-in hash() is salted per
+    process, so it can't be used for an index that lives on disk.
+    """
+    key_hash = int.from_bytes(hashlib.blake2b(
+        key, digest_size=8).digest(), 'little')
+    return key_hash or 1  # 0 is reserved for empty slots
+
+
+class RecordIndex:
+    """
+    Persistent open-addressing hash table mapping the key (first field) of each
+    line in a delimited text file to the byte offset of that line. The text
+    file stays the source of truth: the index is a memory-mapped sidecar that
+    can always be rebuilt from it, and it catches up on its own with records
+    appended since it was last synced.
+
+    The data file is a log: lookups resolve to the latest record with a given
+    key, and a tombstone line (TOMBSTONE_PREFIX followed by the key) deletes
+    it.
+    """
+
+    def __init__(self, data_path: Path, index_path: Path, delimiter: str = ':'):
+        self.data_path = Path(data_path)
+        self.index_path = Path(index_path)
+        self.delimiter = delimiter.encode('utf-8')
+        self.tombstone_prefix = TOMBSTONE_PREFIX.encode('utf-8')
+        self._index_file = None
+        self._index_map = None
+        self._data_fd = None
+        self._data_inode = None
+
+    def get(self, key: str) -> str | None:
+        """
+        Retrieves the remainder of the latest record (after the key and
+        delimiter) with the given key.
+
+        Returns:
+            The record's value if it exists.
+            None otherwise.
+        """
+        record = self.locate(key)
+        return record[1] if record else None
+
+    def locate(self, key: str) -> tuple[int, str] | None:
+        """
+        Finds the latest record with the given key.
+
+        Returns:
+            The byte offset of the record's line and the record's value if it
+            exists.
+            None otherwise.
+        """
+        if not self.sync():
+            return None  # No data file yet
+
+        key_bytes = key.encode('utf-8')
+        record = self._find(key_bytes)
+        if record is False:
+            # Index doesn't agree with the data file (e.g. it was replaced
+            # in a way we couldn't detect from its size), so start over
+            self.rebuild()
+            record = self._find(key_bytes)
+        return record
+
+    def sync(self) -> bool:
+        """
+        Brings the index up to date with the data file, indexing any records
+        appended since the last sync, or rebuilding from scratch if the data
+        file was truncated or replaced.
+
+        Returns:
+            True if the data file exists.
+            False otherwise.
+        """
+        try:
+            stat = os.stat(self.data_path)
+        except FileNotFoundError:
+            self._close_data()
+            return False
+        if self._index_map is not None and self._data_inode == stat.st_ino:
+            indexed_size, inode = self._read_header()[5:7]
+            if inode == stat.st_ino and indexed_size == stat.st_size:
+                return True  # Up to date
+
+        # Processes share the index file, so only one may update it at a
+        # time. The data file is locked first, in the same order as writers
+        # that read the index while holding the data file's lock.
+        with locked(self.data_path), locked(self.index_path, exclusive=True):
+            try:
+                stat = os.stat(self.data_path)
+            except FileNotFoundError:
+                self._close_data()
+                return False
+
+            opened = False
+            if self._data_inode != stat.st_ino:
+                self._open_data()
+                opened = True
+
+            # Another process may have updated or replaced the index since
+            # we last looked at it
+            self._open_index()
+            _, _, _, _, _, indexed_size, inode, checksum = self._read_header()
+            if (inode != stat.st_ino or indexed_size > stat.st_size
+                    or (opened and checksum != source_checksum(self._data_fd, indexed_size))):
+                self._rebuild()
+            elif indexed_size < stat.st_size:
+                self._index_from(indexed_size)
+        return True
+
+    def rebuild(self) -> None:
+        """
+        Rebuilds the whole index from the data file.
+        """
+        with locked(self.data_path), locked(self.index_path, exclusive=True):
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        if self._data_fd is None:
+            self._open_data()
+        self._close_index()
+        self._create_index(MIN_INDEX_CAPACITY)
+        self._index_from(0)
+
+    def close(self) -> None:
+        self._close_index()
+        self._close_data()
+
+    def __len__(self) -> int:
+        """
+        Number of keys with a live (not deleted) record.
+        """
+        if not self.sync():
+            return 0
+        return self._read_header()[3]
+
+    def num_records(self) -> int:
+        """
+        Number of records (superseded ones and tombstones included) in the
+        data file.
+        """
+        if not self.sync():
+            return 0
+        return self._read_header()[4]
+
+    def _find(self, key: bytes) -> tuple[int, str] | None | bool:
+        """
+        Probes the table for a key.
+
+        Returns:
+            The record's offset and value if found, None if the key isn't
+            indexed or was deleted, or False if a slot points at a record that
+            doesn't hash to it.
+        """
+        key_hash = hash_key(key)
+        capacity = self._read_header()[1]
+        mask = capacity - 1
+        slot = key_hash & mask
+        while True:
+            slot_hash, slot_offset = self._read_slot(slot)
+            if slot_offset == 0:
+                return None
+            if slot_hash == key_hash:
+                record_key, value = self._read_record(slot_offset - 1)
+                if record_key == key:
+                    if value is None:
+                        return None  # Tombstone
+                    return slot_offset - 1, value.decode('utf-8')
+                if record_key is None or hash_key(record_key) != key_hash:
+                    return False
+            slot = (slot + 1) & mask
+
+    def _insert(self, key: bytes, offset: int, is_tombstone: bool = False) -> None:
+        _, capacity, count, live, records, _, _, _ = self._read_header()
+        if (count + 1) > capacity * MAX_LOAD_FACTOR:
+            self._grow(capacity * 2)
+            _, capacity, count, live, records, _, _, _ = self._read_header()
+
+        key_hash = hash_key(key)
+        mask = capacity - 1
+        slot = key_hash & mask
+        while True:
+            slot_hash, slot_offset = self._read_slot(slot)
+            if slot_offset == 0:
+                count += 1
+                break
+            if slot_hash == key_hash:
+                record_key, value = self._read_record(slot_offset - 1)
+                if record_key == key:
+                    # Newer record with this key replaces the older one
+                    if value is not None:
+                        live -= 1
+                    break
+            slot = (slot + 1) & mask
+
+        if not is_tombstone:
+            live += 1
+        self._write_slot(slot, key_hash, offset + 1)
+        self._write_header(capacity, count, live, records + 1)
+
+    def _index_from(self, start: int) -> None:
+        """
+        Indexes every complete record starting at byte offset `start`.
+        """
+        offset = start
+        with locked(self.data_path), open(self.data_path, 'rb') as data_file:
+            data_file.seek(start)
+            for line in data_file:
+                if not line.endswith(b'\n'):
+                    break  # Partially written record, pick it up next sync
+                key, sep, _ = line.partition(self.delimiter)
+                if sep:
+                    self._insert(key, offset)
+                elif line.startswith(self.tombstone_prefix):
+                    self._insert(
+                        line[len(self.tombstone_prefix):-1], offset, is_tombstone=True)
+                offset += len(line)
+
+        if metrics.ENABLED:
+            BYTES_READ.inc(offset - start, file=self.data_path.name)
+        self._write_source(offset, self._data_inode, source_checksum(self._data_fd, offset))
+        self._index_map.flush()
+
+    def _read_record(self, offset: int) -> tuple[bytes | None, bytes | None]:
+        """
+        Returns:
+            The key and value of the record at `offset`, the key and None for
+            a tombstone, or None and b'' if there's no record there.
+        """
+        data = b''
+        while True:
+            chunk = os.pread(self._data_fd, RECORD_READ_SIZE,
+                             offset + len(data))
+            if not chunk:
+                return None, b''  # Offset past the end of the data file
+            if metrics.ENABLED:
+                BYTES_READ.inc(len(chunk), file=self.data_path.name)
+            data += chunk
+            line, newline, _ = data.partition(b'\n')
+            if newline:
+                key, sep, value = line.partition(self.delimiter)
+                if sep:
+                    return key, value
+                if line.startswith(self.tombstone_prefix):
+                    return line[len(self.tombstone_prefix):], None
+                return None, b''
+
+    def _grow(self, capacity: int) -> None:
+        old_map = self._index_map
+        _, old_capacity, _, live, records, indexed_size, inode, checksum = self._read_header()
+        slots = [INDEX_SLOT.unpack_from(old_map, INDEX_HEADER.size + i * INDEX_SLOT.size)
+                 for i in range(old_capacity)]
+
+        self._close_index()
+        self._create_index(capacity)
+        mask = capacity - 1
+        count = 0
+        for slot_hash, slot_offset in slots:
+            if slot_offset == 0:
+                continue
+            slot = slot_hash & mask
+            while self._read_slot(slot)[1] != 0:
+                slot = (slot + 1) & mask
+            self._write_slot(slot, slot_hash, slot_offset)
+            count += 1
+        self._write_header(capacity, count, live, records)
+        self._write_source(indexed_size, inode, checksum)
+
+    def _create_index(self, capacity: int) -> None:
+        # Build the new table beside the old one so readers never see a
+        # half-initialized file
+        with replacing(self.index_path) as tmp_file:
+            tmp_file.write(INDEX_HEADER.pack(
+                INDEX_MAGIC, capacity, 0, 0, 0, 0, self._data_inode or 0, 0))
+            tmp_file.truncate(INDEX_HEADER.size + capacity * INDEX_SLOT.size)
+        self._map_index()
+
+    def _open_index(self) -> None:
+        """
+        Maps the index file, unless the one already mapped is still in place,
+        and starts a new one if it's missing or not a valid index.
+        """
+        if self._index_file is not None:
+            try:
+                if os.stat(self.index_path).st_ino == os.fstat(self._index_file.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self._close_index()
+
+        try:
+            self._map_index()
+        except (FileNotFoundError, ValueError):  # ValueError: empty file
+            self._create_index(MIN_INDEX_CAPACITY)
+            return
+
+        if len(self._index_map) < INDEX_HEADER.size:
+            magic, capacity = None, 0
+        else:
+            magic, capacity, _, _, _, _, _, _ = self._read_header()
+        expected_size = INDEX_HEADER.size + capacity * INDEX_SLOT.size
+        if magic != INDEX_MAGIC or len(self._index_map) != expected_size:
+            self._close_index()
+            self._create_index(MIN_INDEX_CAPACITY)
+
+    def _map_index(self) -> None:
+        self._index_file = open(self.index_path, 'r+b')
+        try:
+            self._index_map = mmap.mmap(self._index_file.fileno(), 0)
+        except ValueError:
+            self._index_file.close()
+            self._index_file = None
+            raise
+
+    def _read_header(self) -> tuple[bytes, int, int, int, int, int, int, int]:
+        return INDEX_HEADER.unpack_from(self._index_map, 0)
+
+    def _write_header(self, capacity: int, count: int, live: int, records: int) -> None:
+        *_, indexed_size, inode, checksum = self._read_header()
+        INDEX_HEADER.pack_into(self._index_map, 0, INDEX_MAGIC, capacity, count, live,
+                               records, indexed_size, inode, checksum)
+
+    def _write_source(self, indexed_size: int, inode: int, checksum: int) -> None:
+        """
+        Records how much of which data file is indexed.
+        """
+        _, capacity, count, live, records, _, _, _ = self._read_header()
+        INDEX_HEADER.pack_into(self._index_map, 0, INDEX_MAGIC, capacity, count, live,
+                               records, indexed_size, inode, checksum)
+
+    def _read_slot(self, slot: int) -> tuple[int, int]:
+        return INDEX_SLOT.unpack_from(self._index_map, INDEX_HEADER.size + slot * INDEX_SLOT.size)
+
+    def _write_slot(self, slot: int, key_hash: int, offset: int) -> None:
+        INDEX_SLOT.pack_into(self._index_map, INDEX_HEADER.size +
+                             slot * INDEX_SLOT.size, key_hash, offset)
+
+    def _close_index(self) -> None:
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def _open_data(self) -> None:
+        self._close_data()
+        self._data_fd = os.open(self.data_path, os.O_RDONLY)
+        self._data_inode = os.fstat(self._data_fd).st_ino
+
+    def _close_data(self) -> None:
+        if self._data_fd is not None:
+            os.close(self._data_fd)
+            self._data_fd = None
+            self._data_inode = None
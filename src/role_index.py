@@ -0,0 +1,310 @@
+import os
+import struct
+import threading
+import zlib
+from array import array
+from pathlib import Path
+from typing import Iterator
+from file_lock import locked, replacing
+from problem1c import ROLE_BITS, Operation, Role, get_rbac_policy
+from record_index import TOMBSTONE_PREFIX, source_checksum
+
+ROLE_INDEX_MAGIC = b'ROLEIDX1'
+
+# Header: magic, roles file size indexed, roles file inode, source_checksum()
+# of the indexed roles and number of user ids. The rest is zlib compressed.
+ROLE_INDEX_HEADER = struct.Struct('<8sQQQQ')
+SECTION_LENGTH = struct.Struct('<Q')
+
+SAVE_EVERY_RECORDS = 10_000  # Records read before the index is written out again
+
+ROLES = list(Role)
+ROLE_BY_NAME = {role.value: role for role in Role}
+
+
+def _iter_bits(bits: int) -> Iterator[int]:
+    # bin() and str.find() scan in C, where shifting through a huge int
+    # one bit at a time would be quadratic
+    digits = bin(bits)[:1:-1]  # Least significant first, without '0b'
+    i = digits.find('1')
+    while i != -1:
+        yield i
+        i = digits.find('1', i + 1)
+
+
+class UserSet:
+    """
+    Set of users from a RoleIndex, as a bitmap of user ids. Sets combine with
+    & (and), | (or), - (and not) and ~ (every other enrolled user).
+    """
+    __slots__ = ('index', 'bits')
+
+    def __init__(self, index: 'RoleIndex', bits: int):
+        self.index = index
+        self.bits = bits
+
+    def __and__(self, other: 'UserSet') -> 'UserSet':
+        return UserSet(self.index, self.bits & other.bits)
+
+    def __or__(self, other: 'UserSet') -> 'UserSet':
+        return UserSet(self.index, self.bits | other.bits)
+
+    def __sub__(self, other: 'UserSet') -> 'UserSet':
+        return UserSet(self.index, self.bits & ~other.bits)
+
+    def __invert__(self) -> 'UserSet':
+        return self.index.all_users() - self
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
+    def __iter__(self) -> Iterator[str]:
+        unames = self.index.unames
+        for user_id in _iter_bits(self.bits):
+            yield unames[user_id]
+
+    def __contains__(self, uname: str) -> bool:
+        user_id = self.index.user_ids.get(uname)
+        return user_id is not None and bool(self.bits >> user_id & 1)
+
+
+class RoleIndex:
+    """
+    Inverted index from each role to the users holding it, for entitlement
+    reviews (e.g. "which users hold Teller, but not Employee") without parsing
+    every roles record. Users get ids in the order they first appear in the
+    roles file, and every role keeps a bitmap of user ids, so set operations
+    across roles are bitwise operations on Python ints.
+
+    Like RecordIndex, the index remembers how much of the roles file it has
+    read: records appended since (e.g. by add_user_roles_record) are applied
+    on the next query, latest record wins, and it's rebuilt if the file was
+    replaced. The index is written to `index_path`, zlib compressed, every
+    SAVE_EVERY_RECORDS records and on close().
+    """
+
+    def __init__(self, roles_path: Path, index_path: Path, delimiter: str = ':'):
+        self.roles_path = Path(roles_path)
+        self.index_path = Path(index_path)
+        self.delimiter = delimiter
+
+        self.unames: list[str] = []
+        self.user_ids: dict[str, int] = {}
+        self._role_masks = array('B')  # Roles of each user id, as ROLE_BITS
+        self._live = bytearray()  # Bitmap of user ids that weren't deleted
+        self._role_bitmaps = {role: bytearray() for role in ROLES}
+
+        self._offset = 0  # Bytes of the roles file read
+        self._inode = None
+        self._loaded = False
+        self._unsaved = 0  # Records read since the index was last written
+        # Like RecordIndex, holds the roles file open so its inode can't be
+        # reused by a replacement file while the index refers to it
+        self._fd: int | None = None
+        self._lock = threading.Lock()
+
+    def users_with_role(self, role: Role | str) -> UserSet:
+        """
+        Users holding a role (or its name) under the current RBAC policy,
+        directly or through a role inheriting from it, e.g. Premium Clients
+        are Clients too.
+
+        Raises:
+            ValueError if there is no role by that name.
+        """
+        if not isinstance(role, Role):
+            if role not in ROLE_BY_NAME:
+                raise ValueError(f'Unknown role: {role}')
+            role = ROLE_BY_NAME[role]
+        policy = get_rbac_policy()
+        with self._lock:
+            self._sync()
+            bits = 0
+            for holder in ROLES:
+                if role in policy.closures[holder]:
+                    bits |= int.from_bytes(self._role_bitmaps[holder], 'little')
+            return UserSet(self, bits)
+
+    def users_with_operation(self, operation: Operation, active_mask: int | None = None) -> UserSet:
+        """
+        Users holding a role that grants an operation under the current RBAC
+        policy, directly or through inheritance. Given the mask of active
+        roles (e.g. problem1c.get_active_roles_mask()), users holding a role
+        that is inactive, or inherits from one, are left out, since they're
+        currently denied everything.
+        """
+        policy = get_rbac_policy()
+        with self._lock:
+            self._sync()
+            bits = 0
+            for role in policy.roles_granting(operation):
+                bits |= int.from_bytes(self._role_bitmaps[role], 'little')
+            if active_mask is not None:
+                for role in ROLES:
+                    if policy.closure_masks[role] & ~active_mask:
+                        bits &= ~int.from_bytes(self._role_bitmaps[role], 'little')
+            return UserSet(self, bits)
+
+    def all_users(self) -> UserSet:
+        with self._lock:
+            self._sync()
+            return UserSet(self, int.from_bytes(self._live, 'little'))
+
+    def rebuild(self) -> int:
+        """
+        Rebuilds the index from the roles file and writes it out.
+
+        Returns:
+            The number of users indexed.
+        """
+        with self._lock:
+            self._reset()
+            self._loaded = True  # Don't load the old index back
+            self._sync()
+            self._save()
+            return int.from_bytes(self._live, 'little').bit_count()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._unsaved:
+                self._save()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+                self._inode = None
+
+    def _sync(self) -> None:
+        try:
+            stat = os.stat(self.roles_path)
+        except FileNotFoundError:
+            self._reset()
+            return
+
+        if stat.st_ino != self._inode:
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = os.open(self.roles_path, os.O_RDONLY)
+            self._inode = os.fstat(self._fd).st_ino
+            if self._offset:
+                self._reset()  # Replaced, e.g. compacted
+                self._loaded = True
+        if not self._loaded:
+            self._loaded = True
+            self._load(stat.st_size)
+        if stat.st_size < self._offset:
+            self._reset()  # Truncated
+
+        if stat.st_size > self._offset:
+            self._read_tail()
+            if self._unsaved >= SAVE_EVERY_RECORDS:
+                self._save()
+
+    def _reset(self) -> None:
+        self.unames = []
+        self.user_ids = {}
+        self._role_masks = array('B')
+        self._live = bytearray()
+        self._role_bitmaps = {role: bytearray() for role in ROLES}
+        self._offset = 0
+        self._unsaved = 0
+
+    def _read_tail(self) -> None:
+        # Shared lock, so a group commit in progress is read in full or not at all
+        with locked(self.roles_path), open(self._fd, 'rb', closefd=False) as roles_file:
+            roles_file.seek(self._offset)
+            for line in roles_file:
+                if not line.endswith(b'\n'):
+                    break  # Partially written record, pick it up next sync
+                self._offset += len(line)
+                self._unsaved += 1
+
+                record = line.decode('utf-8').rstrip('\n')
+                uname, sep, roles_str = record.partition(self.delimiter)
+                if sep:
+                    role_mask = 0
+                    for role_name in roles_str.split(',') if roles_str else ():
+                        role = ROLE_BY_NAME.get(role_name)
+                        if role is not None:
+                            role_mask |= ROLE_BITS[role]
+                    self._apply(uname, role_mask, live=True)
+                elif record.startswith(TOMBSTONE_PREFIX):
+                    uname = record[len(TOMBSTONE_PREFIX):]
+                    if uname in self.user_ids:
+                        self._apply(uname, 0, live=False)
+
+    def _apply(self, uname: str, role_mask: int, live: bool) -> None:
+        user_id = self.user_ids.get(uname)
+        if user_id is None:
+            user_id = self.user_ids[uname] = len(self.unames)
+            self.unames.append(uname)
+            self._role_masks.append(0)
+            if user_id % 8 == 0:
+                self._live.append(0)
+                for bitmap in self._role_bitmaps.values():
+                    bitmap.append(0)
+
+        byte, bit = user_id >> 3, 1 << (user_id & 7)
+        changed = self._role_masks[user_id] ^ role_mask
+        for role in ROLES:
+            if changed & ROLE_BITS[role]:
+                self._role_bitmaps[role][byte] ^= bit
+        self._role_masks[user_id] = role_mask
+        if live:
+            self._live[byte] |= bit
+        else:
+            self._live[byte] &= ~bit
+
+    def _load(self, roles_size: int) -> None:
+        """
+        Loads the index written out earlier, if it was made from the current
+        roles file.
+        """
+        try:
+            data = self.index_path.read_bytes()
+        except FileNotFoundError:
+            return
+        if len(data) < ROLE_INDEX_HEADER.size:
+            return
+        magic, offset, inode, checksum, num_users = ROLE_INDEX_HEADER.unpack_from(data)
+        if (magic != ROLE_INDEX_MAGIC or inode != self._inode or offset > roles_size
+                or checksum != source_checksum(self._fd, offset)):
+            return  # Older format or a different roles file, read it all again
+
+        try:
+            payload = zlib.decompress(data[ROLE_INDEX_HEADER.size:])
+        except zlib.error:
+            return
+        sections = []
+        position = 0
+        while position < len(payload):
+            (length,) = SECTION_LENGTH.unpack_from(payload, position)
+            position += SECTION_LENGTH.size
+            sections.append(payload[position:position + length])
+            position += length
+        if len(sections) != 3 + len(ROLES):
+            return
+
+        unames_blob, role_masks, live, *role_bitmaps = sections
+        self.unames = unames_blob.decode('utf-8').split('\n') if num_users else []
+        self.user_ids = {uname: user_id for user_id, uname in enumerate(self.unames)}
+        self._role_masks = array('B', role_masks)
+        self._live = bytearray(live)
+        self._role_bitmaps = {role: bytearray(bitmap)
+                              for role, bitmap in zip(ROLES, role_bitmaps)}
+        self._offset = offset
+
+    def _save(self) -> None:
+        sections = [
+            '\n'.join(self.unames).encode('utf-8'),
+            self._role_masks.tobytes(),
+            bytes(self._live),
+            *(bytes(self._role_bitmaps[role]) for role in ROLES),
+        ]
+        payload = b''.join(SECTION_LENGTH.pack(len(section)) + section for section in sections)
+        with replacing(self.index_path) as index_file:
+            index_file.write(ROLE_INDEX_HEADER.pack(
+                ROLE_INDEX_MAGIC, self._offset, self._inode or 0,
+                source_checksum(self._fd, self._offset) if self._fd is not None else 0,
+                len(self.unames)))
+            index_file.write(zlib.compress(payload))
+        self._unsaved = 0
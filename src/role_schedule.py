@@ -0,0 +1,113 @@
+import datetime
+import threading
+from typing import Callable, Hashable, Iterable, NamedTuple
+
+ALL_WEEKDAYS = frozenset(range(7))  # Monday is 0
+WEEKDAYS = frozenset(range(5))
+
+# How far ahead to look for the next window boundary. If nothing changes
+# within it the decision is simply recomputed once it runs out.
+LOOKAHEAD_DAYS = 8
+
+ONE_SECOND = datetime.timedelta(seconds=1)
+ONE_DAY = datetime.timedelta(days=1)
+
+
+class TimeWindow(NamedTuple):
+    """
+    A daily window during which a role is active. The end time is inclusive
+    to the second (so 9:00:00-17:00:00 includes 17:00:00), and a window ending
+    before it starts runs overnight into the next day. `weekdays` are the days
+    the window starts on, and windows don't start on holidays unless
+    `on_holidays` is set.
+    """
+    start: datetime.time
+    end: datetime.time
+    weekdays: frozenset[int] = ALL_WEEKDAYS
+    on_holidays: bool = True
+
+
+class RoleSchedule:
+    """
+    Decides which roles are active at a given instant from their time windows.
+    Along with the mask of active roles, it works out the next instant any
+    role's state can change, so the mask is cached and reused until then
+    instead of being recomputed on every request.
+    """
+
+    def __init__(self, windows: dict[Hashable, Iterable[TimeWindow]], role_bits: dict[Hashable, int],
+                 holidays: Iterable[datetime.date] = (),
+                 clock: Callable[[], datetime.datetime] = datetime.datetime.now):
+        self.windows = {role: list(role_windows)
+                        for role, role_windows in windows.items()}
+        self.role_bits = role_bits
+        self.holidays = frozenset(holidays)
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        # (valid from, valid until, active roles mask)
+        self._cached: tuple[datetime.datetime, datetime.datetime, int] | None = None
+
+    def active_mask(self, now: datetime.datetime | None = None) -> int:
+        """
+        Get the mask of roles active at `now` (the clock's time by default).
+        """
+        if now is None:
+            now = self.clock()
+
+        cached = self._cached
+        if cached is not None and cached[0] <= now < cached[1]:
+            return cached[2]
+
+        active_mask, next_transition = self.compute(now)
+        with self._lock:
+            self._cached = (now, next_transition, active_mask)
+        return active_mask
+
+    def next_transition(self, now: datetime.datetime | None = None) -> datetime.datetime:
+        """
+        Get the next instant after `now` at which any role may be activated or
+        deactivated.
+        """
+        if now is None:
+            now = self.clock()
+        self.active_mask(now)
+        return self._cached[1]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._cached = None
+
+    def compute(self, now: datetime.datetime) -> tuple[int, datetime.datetime]:
+        """
+        Works out the active roles mask at `now` without the cache.
+
+        Returns:
+            The active roles mask and the next instant it may change.
+        """
+        active_mask = 0
+        next_transition = now + LOOKAHEAD_DAYS * ONE_DAY
+        for role, role_windows in self.windows.items():
+            for window in role_windows:
+                for start, end in self._occurrences(window, now.date(), now.tzinfo):
+                    if start <= now < end:
+                        active_mask |= self.role_bits[role]
+                    for boundary in (start, end):
+                        if now < boundary < next_transition:
+                            next_transition = boundary
+        return active_mask, next_transition
+
+    def _occurrences(self, window: TimeWindow, today: datetime.date, tzinfo: datetime.tzinfo | None):
+        # Start yesterday in case an overnight window is still running
+        for day_offset in range(-1, LOOKAHEAD_DAYS):
+            date = today + day_offset * ONE_DAY
+            if date.weekday() not in window.weekdays:
+                continue
+            if not window.on_holidays and date in self.holidays:
+                continue
+            start = datetime.datetime.combine(date, window.start, tzinfo)
+            end = datetime.datetime.combine(
+                date, window.end, tzinfo) + ONE_SECOND
+            if window.end < window.start:
+                end += ONE_DAY
+            yield start, end
@@ -0,0 +1,393 @@
+"""
+Headless HTTP/JSON login and authorization service, meant to sit behind a load
+balancer. Run `python3 src/server.py --help` from the project root for options.
+
+Endpoints:
+    POST /enrol {"username": ..., "password": ..., "roles": [...]} (client roles only)
+    POST /login {"username": ..., "password": ...}
+    GET /authorized-operations (Authorization: Bearer <token>)
+    GET /session (Authorization: Bearer <token from /login>)
+    GET /session/authorized?operation=... (Authorization: Bearer <token>)
+    POST /logout (Authorization: Bearer <token>)
+    GET /health
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import time
+from http import HTTPStatus
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+import metrics
+from audit import audit_authorization
+from hash_pool import HashServiceBusy, get_hash_service
+from problem1c import Operation, Role, get_authorized_operations
+from problem3ab import UNAME_TAKEN_MESSAGE, validate_passwd, validate_uname
+from problem4c import login_user_async
+from sessions import Session, get_session_store
+from throttle import LoginThrottled
+from user_store import NewUser, get_user_store, start_background_compaction
+
+logger = logging.getLogger('auth_server')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+KEEP_ALIVE_TIMEOUT = 15  # Seconds an idle connection is kept open
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 64 * 1024
+
+RETRY_AFTER_SECONDS = 1  # Suggested back-off when the hash service is busy
+
+# Roles anyone can give themselves on /enrol. Employees are enrolled with
+# src/main.py or src/admin.py instead.
+SELF_ENROL_ROLES = frozenset({Role.CLIENT, Role.PREMIUM_CLIENT})
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str | None = None):
+        super().__init__(message or status.phrase)
+        self.status = status
+        self.message = message or status.phrase
+
+
+class Request:
+    def __init__(self, method: str, target: str, version: str, headers: dict[str, str], body: bytes,
+                 client: str | None = None):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.client = client  # Peer IP address
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {key: values[0]
+                      for key, values in parse_qs(url.query).items()}
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    @property
+    def bearer_token(self) -> str:
+        scheme, _, token = self.headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            raise HTTPError(HTTPStatus.UNAUTHORIZED,
+                            'A session token is required (Authorization: Bearer <token>)')
+        return token.strip()
+
+    def json(self) -> dict:
+        try:
+            body = json.loads(self.body or b'{}')
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                            'Request body must be JSON') from None
+        if not isinstance(body, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                            'Request body must be a JSON object')
+        return body
+
+
+async def read_request(reader: asyncio.StreamReader, client: str | None = None) -> Request | None:
+    """
+    Reads one HTTP/1.1 request off a connection.
+
+    Returns:
+        The request, or None if the client closed the connection.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise HTTPError(HTTPStatus.BAD_REQUEST, 'Incomplete request')
+    except asyncio.LimitOverrunError:
+        raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE) from None
+
+    request_line, *header_lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = request_line.split(' ')
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        'Malformed request line') from None
+
+    headers = {}
+    for header_line in header_lines:
+        name, sep, value = header_line.partition(':')
+        if sep:
+            name, value = name.strip().lower(), value.strip()
+            if name == 'content-length' and headers.get(name, value) != value:
+                raise HTTPError(HTTPStatus.BAD_REQUEST,
+                                'Conflicting Content-Length headers')
+            headers[name] = value
+
+    # Bodies are only framed by Content-Length. Anything else could be read
+    # differently by a proxy in front, and smuggle a request past it, so the
+    # connection is closed instead.
+    if 'transfer-encoding' in headers:
+        if 'content-length' in headers:
+            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                            'Transfer-Encoding and Content-Length must not both be set')
+        raise HTTPError(HTTPStatus.NOT_IMPLEMENTED,
+                        'Transfer-Encoding is not supported, send a Content-Length')
+
+    try:
+        content_length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        'Malformed Content-Length') from None
+    if content_length < 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        'Malformed Content-Length')
+    if content_length > MAX_BODY_BYTES:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(content_length) if content_length else b''
+    return Request(method, target, version, headers, body, client)
+
+
+def write_response(writer: asyncio.StreamWriter, status: HTTPStatus, body: dict,
+                   keep_alive: bool, headers: dict[str, str] | None = None) -> None:
+    payload = json.dumps(body).encode('utf-8')
+    lines = [
+        f'HTTP/1.1 {status.value} {status.phrase}',
+        'Content-Type: application/json',
+        f'Content-Length: {len(payload)}',
+        'Connection: ' + ('keep-alive' if keep_alive else 'close'),
+    ]
+    if keep_alive:
+        lines.append(f'Keep-Alive: timeout={KEEP_ALIVE_TIMEOUT}')
+    for name, value in (headers or {}).items():
+        lines.append(f'{name}: {value}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+
+
+def require_str(body: dict, field: str) -> str:
+    value = body.get(field)
+    if not isinstance(value, str):
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        f'"{field}" must be a string')
+    return value
+
+
+def validate_enrolment(uname: str, plaintext_passwd: str) -> bool | str:
+    result = validate_uname(uname)
+    if result is True:
+        result = validate_passwd(plaintext_passwd, uname)
+    return result
+
+
+async def enrol(request: Request) -> tuple[HTTPStatus, dict]:
+    body = request.json()
+    uname = require_str(body, 'username')
+    plaintext_passwd = require_str(body, 'password')
+    roles = body.get('roles', [])
+    if not isinstance(roles, list) or not all(isinstance(role, str) for role in roles):
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        '"roles" must be a list of strings')
+
+    valid_roles = {role.value for role in Role}
+    invalid_roles = [role for role in roles if role not in valid_roles]
+    if invalid_roles:
+        return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': 'Unknown role(s): ' + ', '.join(invalid_roles)}
+    privileged_roles = [role for role in roles if Role(role) not in SELF_ENROL_ROLES]
+    if privileged_roles:
+        return HTTPStatus.FORBIDDEN, {'error': 'Role(s) not open to self-enrolment: ' + ', '.join(privileged_roles)}
+
+    # Store lookups and the weak password check, off the event loop
+    result = await asyncio.to_thread(validate_enrolment, uname, plaintext_passwd)
+    if result == UNAME_TAKEN_MESSAGE:
+        return HTTPStatus.CONFLICT, {'error': result}
+    if result is not True:
+        return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': result}
+
+    hash_str = await get_hash_service().ahash(plaintext_passwd)
+    # Waits for a group commit, off the event loop so concurrent enrolments can
+    # share it. The username may have been taken while the password was hashed.
+    if await asyncio.to_thread(get_user_store().add_users, [NewUser(uname, hash_str, roles)]):
+        return HTTPStatus.CONFLICT, {'error': UNAME_TAKEN_MESSAGE}
+    return HTTPStatus.CREATED, {'username': uname, 'roles': sorted(roles)}
+
+
+async def login(request: Request) -> tuple[HTTPStatus, dict]:
+    body = request.json()
+    uname = require_str(body, 'username')
+    roles = await login_user_async(uname, require_str(body, 'password'), request.client)
+    if isinstance(roles, str):
+        return HTTPStatus.UNAUTHORIZED, {'error': roles}
+
+    authorized_operations = get_authorized_operations(roles)
+    return HTTPStatus.OK, {
+        'username': uname,
+        'roles': sorted(role.value for role in roles),
+        'authorized_operations': sorted(operation.name for operation in authorized_operations),
+        'token': get_session_store().create(uname, roles),
+    }
+
+
+async def get_user_session(request: Request) -> Session:
+    # Rechecking the user's roles may wait on the store's file locks
+    user_session = await asyncio.to_thread(get_session_store().get, request.bearer_token)
+    if user_session is None:
+        raise HTTPError(HTTPStatus.UNAUTHORIZED, 'Invalid or expired session')
+    return user_session
+
+
+async def session(request: Request) -> tuple[HTTPStatus, dict]:
+    user_session = await get_user_session(request)
+    return HTTPStatus.OK, {
+        'username': user_session.uname,
+        'roles': sorted(role.value for role in user_session.roles),
+        'authorized_operations': sorted(operation.name for operation in user_session.get_authorized_operations()),
+        'expires_at': user_session.expires_at.isoformat(),
+    }
+
+
+async def session_authorized(request: Request) -> tuple[HTTPStatus, dict]:
+    try:
+        operation = Operation[request.query.get('operation', '')]
+    except KeyError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        '"operation" query parameter must be an operation name') from None
+    user_session = await get_user_session(request)
+    authorized = user_session.is_authorized(operation)
+    audit_authorization(user_session.uname, operation, authorized, request.client)
+    return HTTPStatus.OK, {'operation': operation.name, 'authorized': authorized}
+
+
+async def logout(request: Request) -> tuple[HTTPStatus, dict]:
+    if not get_session_store().revoke(request.bearer_token):
+        raise HTTPError(HTTPStatus.UNAUTHORIZED, 'Invalid or expired session')
+    return HTTPStatus.OK, {'status': 'logged out'}
+
+
+async def authorized_operations(request: Request) -> tuple[HTTPStatus, dict]:
+    user_session = await get_user_session(request)
+    uname = request.query.get('username', user_session.uname)
+    if uname != user_session.uname:
+        raise HTTPError(HTTPStatus.FORBIDDEN,
+                        "Only the session's own user can be looked up")
+
+    operations = user_session.get_authorized_operations()
+    for operation in Operation:
+        audit_authorization(uname, operation, operation in operations, request.client)
+    return HTTPStatus.OK, {'username': uname,
+                           'authorized_operations': sorted(operation.name for operation in operations)}
+
+
+async def health(request: Request) -> tuple[HTTPStatus, dict]:
+    return HTTPStatus.OK, {'status': 'ok', 'hash_service': get_hash_service().stats()}
+
+
+ROUTES = {
+    ('POST', '/enrol'): enrol,
+    ('POST', '/login'): login,
+    ('GET', '/authorized-operations'): authorized_operations,
+    ('GET', '/session'): session,
+    ('GET', '/session/authorized'): session_authorized,
+    ('POST', '/logout'): logout,
+    ('GET', '/health'): health,
+}
+
+
+async def handle_request(request: Request) -> tuple[HTTPStatus, dict, dict[str, str]]:
+    handler = ROUTES.get((request.method, request.path))
+    if handler is None:
+        if any(path == request.path for _, path in ROUTES):
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+        raise HTTPError(HTTPStatus.NOT_FOUND)
+
+    try:
+        status, body = await handler(request)
+    except HashServiceBusy:
+        return (HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'Too many requests in progress, try again later'},
+                {'Retry-After': str(RETRY_AFTER_SECONDS)})
+    except LoginThrottled as e:
+        return (HTTPStatus.TOO_MANY_REQUESTS, {'error': e.message},
+                {'Retry-After': str(max(1, math.ceil(e.retry_after)))})
+    return status, body, {}
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    peer = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader, peer[0] if peer else None),
+                                                 KEEP_ALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break  # Idle keep-alive connection
+            except HTTPError as e:
+                write_response(writer, e.status, {
+                               'error': e.message}, keep_alive=False)
+                await writer.drain()
+                break
+            if request is None:
+                break
+
+            start = time.perf_counter()
+            try:
+                status, body, headers = await handle_request(request)
+            except HTTPError as e:
+                status, body, headers = e.status, {'error': e.message}, {}
+            except Exception:
+                logger.exception('Unhandled error for %s %s',
+                                 request.method, request.path)
+                status, body, headers = HTTPStatus.INTERNAL_SERVER_ERROR, {
+                    'error': HTTPStatus.INTERNAL_SERVER_ERROR.phrase}, {}
+
+            write_response(writer, status, body, request.keep_alive, headers)
+            await writer.drain()
+            logger.info('%s %s %s %d %.2fms', peer[0] if peer else '-', request.method,
+                        request.path, status.value, (time.perf_counter() - start) * 1000)
+
+            if not request.keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass  # Client went away mid-request
+    finally:
+        writer.close()
+
+
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+    get_hash_service()  # Start the worker pool before the first request
+    start_background_compaction(get_user_store())
+    server = await asyncio.start_server(handle_connection, host, port, limit=MAX_HEADER_BYTES)
+    logger.info('Listening on %s:%d', host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this port (needs AUTH_METRICS=1)')
+    parser.add_argument('--metrics-file', type=Path,
+                        help="rewrite the metrics to this file every 15 seconds, e.g. for "
+                             "node_exporter's textfile collector (needs AUTH_METRICS=1)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if (args.metrics_port is not None or args.metrics_file is not None) and not metrics.ENABLED:
+        logger.warning(
+            'Metrics are disabled, set AUTH_METRICS=1 to collect them')
+    if args.metrics_port is not None:
+        metrics.start_metrics_server(args.host, args.metrics_port)
+    if args.metrics_file is not None:
+        metrics.start_metrics_writer(args.metrics_file)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import datetime
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Set
+import metrics
+from audit import audit_authorization
+from problem1c import OPERATION_BITS, Operation, Role, get_rbac_policy, roles_to_mask
+from rbac_policy import RbacPolicy
+from role_schedule import RoleSchedule
+from user_store import get_user_store
+
+SESSION_TTL = datetime.timedelta(minutes=30)
+MAX_SESSIONS = 100_000  # Least recently used sessions are evicted past this
+
+# How stale a session's roles may get when they're changed by another
+# process (changes made through this one invalidate sessions right away)
+ROLES_RECHECK_INTERVAL = datetime.timedelta(seconds=5)
+
+TOKEN_BYTES = 32
+
+SESSION_CHECKS = metrics.counter(
+    'auth_session_checks_total', 'Session lookups by result (valid, unknown, expired, roles_changed or window_closed)')
+
+
+class Session:
+    """
+    What a logged in user may do, worked out once at login: their roles and
+    the permission mask they grant. The snapshot is good until `valid_until`,
+    the next time any role may be activated or deactivated (or the session
+    expires), or until the RBAC policy it was taken under is reloaded.
+    """
+    __slots__ = ('uname', 'roles', 'roles_mask', 'active', 'permission_mask', 'policy',
+                 'expires_at', 'valid_until', 'checked_at')
+
+    def __init__(self, uname: str, roles: frozenset[Role], expires_at: datetime.datetime,
+                 checked_at: datetime.datetime):
+        self.uname = uname
+        self.roles = roles
+        self.roles_mask = roles_to_mask(roles)
+        self.active = False
+        self.permission_mask = 0
+        self.policy: RbacPolicy | None = None
+        self.expires_at = expires_at
+        self.valid_until = checked_at
+        self.checked_at = checked_at
+
+    def is_authorized(self, operation: Operation) -> bool:
+        return bool(self.permission_mask & OPERATION_BITS[operation])
+
+    def get_authorized_operations(self) -> Set[Operation]:
+        return set(self.policy.permission_sets[self.roles_mask]) if self.active else set()
+
+
+class SessionStore:
+    """
+    In-memory store of sessions by opaque token, answering authorization
+    checks for logged in users without going back to the user store or
+    recomputing their permissions.
+
+    Following get_authorized_operations, a session whose roles aren't all
+    active grants nothing. A session is dropped once one of its roles'
+    active windows closes, once it expires, or once its user's roles record
+    changes: right away for changes made through invalidate_user, and within
+    `roles_recheck_interval` for changes made by other processes.
+    """
+
+    def __init__(self, ttl: datetime.timedelta = SESSION_TTL, max_sessions: int = MAX_SESSIONS,
+                 roles_recheck_interval: datetime.timedelta = ROLES_RECHECK_INTERVAL,
+                 schedule: RoleSchedule | None = None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.roles_recheck_interval = roles_recheck_interval
+        self.schedule = schedule  # None follows the RBAC policy's schedule
+
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._tokens_by_uname: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, uname: str, roles: Set[Role]) -> str:
+        """
+        Starts a session for a user who just logged in.
+
+        Returns:
+            The session's token.
+        """
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        now = self._schedule().clock()
+        session = Session(uname, frozenset(roles), now + self.ttl, now)
+        self._snapshot(session, now)
+        with self._lock:
+            self._sessions[token] = session
+            self._tokens_by_uname.setdefault(uname, set()).add(token)
+            if len(self._sessions) > self.max_sessions:
+                evicted_token, evicted = self._sessions.popitem(last=False)
+                self._forget(evicted_token, evicted.uname)
+        return token
+
+    def get(self, token: str) -> Session | None:
+        """
+        Looks up a session, dropping it if it is no longer valid.
+
+        Returns:
+            The session if it is valid.
+            None otherwise.
+        """
+        now = self._schedule().clock()
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is not None:
+                self._sessions.move_to_end(token)
+        if session is None:
+            return self._result(None, 'unknown')
+
+        if now >= session.expires_at:
+            self.revoke(token)
+            return self._result(None, 'expired')
+        if ((now >= session.valid_until or session.policy is not get_rbac_policy())
+                and not self._snapshot(session, now)):
+            self.revoke(token)
+            return self._result(None, 'window_closed')
+        if now - session.checked_at >= self.roles_recheck_interval:
+            roles = get_user_store().get_roles(session.uname)
+            if roles is None or frozenset(roles) != session.roles:
+                self.revoke(token)
+                return self._result(None, 'roles_changed')
+            session.checked_at = now
+        return self._result(session, 'valid')
+
+    def is_authorized(self, token: str, operation: Operation) -> bool:
+        """
+        Check if the user of a session may perform an operation right now.
+        """
+        session = self.get(token)
+        if session is None:
+            return False
+        authorized = session.is_authorized(operation)
+        audit_authorization(session.uname, operation, authorized)
+        return authorized
+
+    def revoke(self, token: str) -> bool:
+        """
+        Ends a session, e.g. when its user logs out.
+
+        Returns:
+            True if the session existed.
+            False otherwise.
+        """
+        with self._lock:
+            session = self._sessions.pop(token, None)
+            if session is None:
+                return False
+            self._forget(token, session.uname)
+            return True
+
+    def invalidate_user(self, uname: str) -> int:
+        """
+        Ends every session of a user, e.g. after their roles change.
+
+        Returns:
+            The number of sessions ended.
+        """
+        with self._lock:
+            tokens = self._tokens_by_uname.pop(uname, set())
+            for token in tokens:
+                del self._sessions[token]
+            return len(tokens)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'sessions': len(self._sessions), 'users': len(self._tokens_by_uname)}
+
+    def _snapshot(self, session: Session, now: datetime.datetime) -> bool:
+        """
+        Recomputes a session's permissions for the roles active at `now`,
+        under the current RBAC policy.
+
+        Returns:
+            False if one of the session's roles was deactivated since the last
+            snapshot, True otherwise.
+        """
+        policy = get_rbac_policy()
+        schedule = self.schedule or policy.schedule
+        active = not policy.expanded_masks[session.roles_mask] & ~schedule.active_mask(now)
+        if session.active and not active:
+            return False
+        session.active = active
+        session.permission_mask = policy.permission_masks[session.roles_mask] if active else 0
+        session.policy = policy
+        session.valid_until = min(session.expires_at, schedule.next_transition(now))
+        return True
+
+    def _schedule(self) -> RoleSchedule:
+        return self.schedule or get_rbac_policy().schedule
+
+    def _forget(self, token: str, uname: str) -> None:
+        tokens = self._tokens_by_uname.get(uname)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_uname[uname]
+
+    @staticmethod
+    def _result(session: Session | None, result: str) -> Session | None:
+        if metrics.ENABLED:
+            SESSION_CHECKS.inc(result=result)
+        return session
+
+
+_session_store: SessionStore | None = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """
+    Gets the process-wide session store, creating it on first use.
+    """
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = SessionStore()
+        return _session_store
+
+
+def set_session_store(store: SessionStore) -> None:
+    global _session_store
+    with _session_store_lock:
+        _session_store = store
@@ -0,0 +1,436 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple
+from file_lock import locked, replacing
+from problem1c import Role
+from record_index import TOMBSTONE_PREFIX
+from user_store import (DATA_DIR, PASSWD_FILE_RECORD_DELIMITER, ROLES_FILE_RECORD_DELIMITER,
+                        FlatFileUserStore, LoginRecord, NewUser, UserStore)
+
+SHARDS_DIR = Path(os.environ.get('USER_STORE_SHARDS_DIR', DATA_DIR / 'shards'))
+MANIFEST_NAME = 'shards.json'
+
+# Shards a new sharded store starts with, a power of two
+INITIAL_SHARDS = int(os.environ.get('USER_STORE_SHARDS', 4))
+
+# Seconds between checks of the manifest for splits made by other processes.
+# Writes always check it first.
+MANIFEST_CHECK_INTERVAL = 1.0
+
+# Seconds a split shard's files are kept for processes that haven't noticed
+# the split yet, before the next split deletes them
+RETIRED_SHARD_GRACE = 60.0
+
+# Files of a shard and their record delimiters, roles before passwords like
+# the group commit writer
+SHARD_FILES = [('roles.txt', ROLES_FILE_RECORD_DELIMITER), ('passwd.txt', PASSWD_FILE_RECORD_DELIMITER)]
+
+
+def shard_hash(uname: str | bytes) -> int:
+    """
+    Stable 64-bit hash of a username, the same in every process (unlike
+    hash(), which is salted per process).
+    """
+    if isinstance(uname, str):
+        uname = uname.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(uname, digest_size=8).digest(), 'little')
+
+
+def shard_name(depth: int, bits: int) -> str:
+    return f'shard-{depth}-{bits}'
+
+
+class ShardInfo(NamedTuple):
+    depth: int  # Number of low hash bits the shard's usernames share
+    bits: int  # ... and their value
+
+
+class _Layout(NamedTuple):
+    version: int
+    global_depth: int
+    shards: dict[str, ShardInfo]
+    retired: dict[str, float]  # Split shards, by when they were split
+    buckets: list[FlatFileUserStore]  # Shard of each value of the low global_depth hash bits
+    file_id: tuple[int, int, int]
+
+
+class ShardedUserStore(UserStore):
+    """
+    Partitions users across flat file stores by a stable hash of their
+    username, each shard with its own files, index, filter, caches, locks and
+    group commit writer, so enrolments and lookups for different users don't
+    contend. A router in front of them sends each call to its user's shard.
+
+    The layout uses extendible hashing: the manifest (shards.json) maps every
+    value of the low `global_depth` bits of the hash to a shard, and a shard
+    owns the usernames whose low `depth` bits match its own. Splitting a
+    shard moves its users to two shards one bit deeper, doubling the map
+    when the split shard was as deep as it, and leaves every other shard be.
+
+    Splits happen online. Writers hold a shared lock on the manifest and
+    check it for changes before every write, and a split copies the shard
+    while they carry on, then catches up on what they appended under an
+    exclusive lock and swaps the manifest in before releasing it, so no write
+    lands in a shard after it was split. Readers check the manifest every
+    `check_interval` seconds, and until they notice a split keep reading the
+    split shard, as of the split.
+    """
+
+    def __init__(self, directory: Path = SHARDS_DIR, initial_shards: int = INITIAL_SHARDS,
+                 check_interval: float = MANIFEST_CHECK_INTERVAL,
+                 clock: Callable[[], float] = time.monotonic, **shard_options):
+        if initial_shards < 1 or initial_shards & (initial_shards - 1):
+            raise ValueError(f'The number of shards must be a power of two, not {initial_shards}')
+        self.directory = Path(directory)
+        self.manifest_path = self.directory / MANIFEST_NAME
+        self.check_interval = check_interval
+        self.clock = clock
+        self.shard_options = shard_options  # For FlatFileUserStore, e.g. fsync=False
+
+        self._stores: dict[str, FlatFileUserStore] = {}  # Every shard opened, split ones included
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with locked(self.manifest_path, exclusive=True):
+            if not self.manifest_path.exists():
+                depth = initial_shards.bit_length() - 1
+                self._write_manifest(0, depth, {shard_name(depth, bits): ShardInfo(depth, bits)
+                                                for bits in range(initial_shards)}, {})
+            self._layout = self._load_layout()
+        self._next_check = clock() + check_interval
+
+    def shard_for(self, uname: str) -> FlatFileUserStore:
+        layout = self._current_layout()
+        return layout.buckets[shard_hash(uname) & ((1 << layout.global_depth) - 1)]
+
+    def shards(self) -> dict[str, FlatFileUserStore]:
+        """
+        Gets the current shards by name.
+        """
+        layout = self._current_layout()
+        return {name: self._stores[name] for name in layout.shards}
+
+    def shard_stats(self) -> list[dict]:
+        layout = self._current_layout()
+        stats = []
+        for name, info in sorted(layout.shards.items()):
+            store = self._stores[name]
+            stats.append({
+                'shard': name, 'depth': info.depth,
+                'users': len(store.passwd_index),
+                'bytes': sum(path.stat().st_size for path in (store.passwd_file, store.roles_file)
+                             if path.exists()),
+            })
+        return stats
+
+    def add_passwd_record(self, uname: str, hash_str: str) -> None:
+        self.add_passwd_records([(uname, hash_str)])
+
+    def get_passwd_hash(self, uname: str) -> str | None:
+        return self.shard_for(uname).get_passwd_hash(uname)
+
+    def update_passwd_hash(self, uname: str, hash_str: str, old_hash_str: str | None = None) -> bool:
+        with self._writing():
+            return self.shard_for(uname).update_passwd_hash(uname, hash_str, old_hash_str)
+
+    def add_roles_record(self, uname: str, roles: list[str]) -> None:
+        self.add_roles_records([(uname, roles)])
+
+    def get_roles(self, uname: str) -> set[Role] | None:
+        return self.shard_for(uname).get_roles(uname)
+
+    def set_roles(self, uname: str, roles: list[str]) -> bool:
+        with self._writing():
+            return self.shard_for(uname).set_roles(uname, roles)
+
+    def delete_user(self, uname: str) -> bool:
+        with self._writing():
+            return self.shard_for(uname).delete_user(uname)
+
+    def get_login_record(self, uname: str) -> LoginRecord | None:
+        return self.shard_for(uname).get_login_record(uname)
+
+    def add_passwd_records(self, records: Iterable[tuple[str, str]]) -> None:
+        with self._writing():
+            for shard, shard_records in self._by_shard(records, lambda record: record[0]):
+                shard.add_passwd_records(shard_records)
+
+    def add_roles_records(self, records: Iterable[tuple[str, list[str]]]) -> None:
+        with self._writing():
+            for shard, shard_records in self._by_shard(records, lambda record: record[0]):
+                shard.add_roles_records(shard_records)
+
+    def add_users(self, users: Iterable[NewUser]) -> list[str]:
+        taken = []
+        with self._writing():
+            for shard, shard_users in self._by_shard(users, lambda user: user.uname):
+                taken += shard.add_users(shard_users)
+        return taken
+
+    def iter_passwd_records(self) -> Iterator[tuple[str, str]]:
+        for shard in self.shards().values():
+            yield from shard.iter_passwd_records()
+
+    def iter_roles_records(self) -> Iterator[tuple[str, list[str]]]:
+        for shard in self.shards().values():
+            yield from shard.iter_roles_records()
+
+    def iter_passwd_log(self) -> Iterator[tuple[str, str | None]]:
+        for shard in self.shards().values():
+            yield from shard.iter_passwd_log()
+
+    def iter_roles_log(self) -> Iterator[tuple[str, list[str] | None]]:
+        for shard in self.shards().values():
+            yield from shard.iter_roles_log()
+
+    def needs_compaction(self) -> bool:
+        return any(shard.needs_compaction() for shard in self.shards().values())
+
+    def compact(self) -> None:
+        # Under the manifest lock, so a split doesn't copy a file being replaced
+        with self._writing():
+            for shard in self.shards().values():
+                if shard.needs_compaction():
+                    shard.compact()
+
+    def rebuild_passwd_index(self) -> int:
+        return sum(shard.rebuild_passwd_index() for shard in self.shards().values())
+
+    def rebuild_uname_filter(self) -> int:
+        return sum(shard.rebuild_uname_filter() for shard in self.shards().values())
+
+    def rebuild_role_index(self) -> int:
+        return sum(shard.rebuild_role_index() for shard in self.shards().values())
+
+    def split_shard(self, name: str) -> tuple[str, str]:
+        """
+        Splits a shard in two, online: the shard is copied while other
+        threads and processes keep reading and writing it, and only the
+        records appended meanwhile are copied with writes held off.
+
+        Returns:
+            The names of the two new shards.
+
+        Raises:
+            ValueError if there is no such shard.
+        """
+        # One split at a time, across processes
+        with locked(self.directory / 'split', exclusive=True):
+            self._prune_retired()
+            shard = self._read_manifest()['shards'].get(name)
+            if shard is None:
+                raise ValueError(f'No such shard: {name}')
+            info = ShardInfo(shard['depth'], shard['bits'])
+            parent_dir = self.directory / name
+            children = [ShardInfo(info.depth + 1, info.bits),
+                        ShardInfo(info.depth + 1, info.bits | 1 << info.depth)]
+            child_dirs = [self.directory / shard_name(*child) for child in children]
+            for child_dir in child_dirs:
+                shutil.rmtree(child_dir, ignore_errors=True)  # Left over from a failed split
+                child_dir.mkdir()
+
+            copies = [_ShardFileCopy(parent_dir / file_name,
+                                     [child_dir / file_name for child_dir in child_dirs],
+                                     delimiter, info.depth)
+                      for file_name, delimiter in SHARD_FILES]
+            try:
+                for copy in copies:
+                    copy.copy()
+                # Build the new shards' indexes while writes carry on, so they
+                # only catch up on the tail once in use
+                for child_dir in child_dirs:
+                    child = self._new_shard_store(child_dir.name)
+                    child.rebuild_passwd_index()
+                    child.rebuild_uname_filter()
+                    child.rebuild_role_index()
+                    child.close()
+
+                with locked(self.manifest_path, exclusive=True):
+                    for copy in copies:
+                        copy.copy(final=True)
+                    manifest = self._read_manifest()
+                    shards = {other_name: ShardInfo(other['depth'], other['bits'])
+                              for other_name, other in manifest['shards'].items()}
+                    del shards[name]
+                    for child in children:
+                        shards[shard_name(*child)] = child
+                    self._write_manifest(manifest['version'] + 1,
+                                         max(manifest['global_depth'], info.depth + 1),
+                                         shards, {**manifest['retired'], name: time.time()})
+                    self._refresh(force=True)
+            finally:
+                for copy in copies:
+                    copy.close()
+        return shard_name(*children[0]), shard_name(*children[1])
+
+    def close(self) -> None:
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """
+        Holds off splits while writing, with the latest layout.
+        """
+        with locked(self.manifest_path):
+            self._refresh()
+            yield
+
+    def _by_shard(self, items: Iterable, uname_of: Callable) -> Iterator[tuple[FlatFileUserStore, list]]:
+        groups: dict[FlatFileUserStore, list] = {}
+        for item in items:
+            groups.setdefault(self.shard_for(uname_of(item)), []).append(item)
+        yield from groups.items()
+
+    def _current_layout(self, check: bool = False) -> _Layout:
+        if check or self.clock() >= self._next_check:
+            self._refresh()
+        return self._layout
+
+    def _refresh(self, force: bool = False) -> None:
+        with self._lock:
+            self._next_check = self.clock() + self.check_interval
+            if force or _file_id(self.manifest_path) != self._layout.file_id:
+                self._layout = self._load_layout()
+
+    def _read_manifest(self) -> dict:
+        with open(self.manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+            manifest['file_id'] = _file_id(manifest_file.fileno())
+        return manifest
+
+    def _load_layout(self) -> _Layout:
+        manifest = self._read_manifest()
+        global_depth = manifest['global_depth']
+        shards = {name: ShardInfo(shard['depth'], shard['bits'])
+                  for name, shard in manifest['shards'].items()}
+        buckets: list[FlatFileUserStore | None] = [None] * (1 << global_depth)
+        for name, info in shards.items():
+            store = self._stores.get(name)
+            if store is None:
+                store = self._stores[name] = self._new_shard_store(name)
+            for bucket in range(info.bits, len(buckets), 1 << info.depth):
+                buckets[bucket] = store
+        if None in buckets:
+            raise ValueError(f'Invalid shard manifest {self.manifest_path}: '
+                             f'hash values {buckets.index(None)} and up have no shard')
+        return _Layout(manifest['version'], global_depth, shards, manifest['retired'],
+                       buckets, manifest['file_id'])
+
+    def _new_shard_store(self, name: str) -> FlatFileUserStore:
+        shard_dir = self.directory / name
+        shard_dir.mkdir(exist_ok=True)
+        return FlatFileUserStore(shard_dir / 'passwd.txt', shard_dir / 'roles.txt',
+                                 shard_dir / 'passwd.idx', **self.shard_options)
+
+    def _write_manifest(self, version: int, global_depth: int, shards: dict[str, ShardInfo],
+                        retired: dict[str, float]) -> None:
+        with replacing(self.manifest_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'version': version, 'global_depth': global_depth,
+                       'shards': {name: info._asdict() for name, info in sorted(shards.items())},
+                       'retired': retired}, manifest_file, indent=4)
+            manifest_file.write('\n')
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+    def _prune_retired(self) -> None:
+        """
+        Deletes the files of shards split long enough ago that every process
+        has moved on to the new ones.
+        """
+        with locked(self.manifest_path, exclusive=True):
+            manifest = self._read_manifest()
+            now = time.time()
+            expired = [name for name, retired_at in manifest['retired'].items()
+                       if now - retired_at >= RETIRED_SHARD_GRACE]
+            if not expired:
+                return
+            self._write_manifest(manifest['version'] + 1, manifest['global_depth'],
+                                 {name: ShardInfo(shard['depth'], shard['bits'])
+                                  for name, shard in manifest['shards'].items()},
+                                 {name: retired_at for name, retired_at in manifest['retired'].items()
+                                  if name not in expired})
+            for name in expired:
+                with self._lock:
+                    store = self._stores.pop(name, None)
+                if store is not None:
+                    store.close()
+                shutil.rmtree(self.directory / name, ignore_errors=True)
+            self._refresh(force=True)
+
+
+class _ShardFileCopy:
+    """
+    Copies one of a shard's files to the two shards it's split into,
+    record by record, by the next bit of the usernames' hash. Records are
+    copied as they are, tombstones and all, so each new shard's file reads
+    the same as the original for its users.
+    """
+
+    def __init__(self, path: Path, child_paths: list[Path], delimiter: str, depth: int):
+        self.path = path
+        self.child_paths = child_paths
+        self.delimiter = delimiter.encode('utf-8')
+        self.bit = 1 << depth
+        self._fd: int | None = None
+        self._inode = None
+        self._offset = 0
+
+    def copy(self, final: bool = False) -> None:
+        """
+        Copies the records appended since the last call. The file is read
+        through a descriptor kept open, so it's copied consistently even if
+        it's compacted meanwhile, in which case the final copy starts over.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.path.touch()
+            stat = os.stat(self.path)
+        if stat.st_ino != self._inode:
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDONLY)
+            self._inode = os.fstat(self._fd).st_ino
+            self._offset = 0
+            # Replaced, e.g. compacted, so start over on new files (new
+            # inodes, so indexes built from the old ones aren't trusted)
+            for child_path in self.child_paths:
+                child_path.unlink(missing_ok=True)
+
+        tombstone_prefix = TOMBSTONE_PREFIX.encode('utf-8')
+        with open(self._fd, 'rb', closefd=False) as src, \
+                open(self.child_paths[0], 'ab') as low, open(self.child_paths[1], 'ab') as high:
+            src.seek(self._offset)
+            for line in src:
+                if not line.endswith(b'\n'):
+                    break  # Partially written record, copied next time
+                self._offset += len(line)
+                uname, sep, _ = line.partition(self.delimiter)
+                if not sep:
+                    if not line.startswith(tombstone_prefix):
+                        continue
+                    uname = line[len(tombstone_prefix):-1]
+                (high if shard_hash(uname) & self.bit else low).write(line)
+            if final:
+                for child_file in (low, high):
+                    child_file.flush()
+                    os.fsync(child_file.fileno())
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _file_id(path_or_fd: Path | int) -> tuple[int, int, int]:
+    stat = os.stat(path_or_fd)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
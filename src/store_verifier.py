@@ -0,0 +1,353 @@
+import json
+import os
+import re
+import tempfile
+import zlib
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple
+from problem1c import Role
+from record_index import TOMBSTONE_PREFIX
+from sharded_store import ShardedUserStore
+from user_store import FlatFileUserStore, SQLiteUserStore, UserStore
+
+if TYPE_CHECKING:
+    from argon2 import Parameters
+
+# The records are split by username into partitions of about this many bytes,
+# each one checked (and held in memory) at once by a worker
+PARTITION_BYTES = 32 * 1024 * 1024
+MAX_PARTITIONS = 512  # Partition files open at once while splitting
+
+# Problems listed in a report, the rest are only counted
+MAX_REPORTED_PROBLEMS = 1000
+
+EXPORT_BATCH_SIZE = 10_000
+
+JSONL_FORMAT = 'jsonl'
+SQLITE_FORMAT = 'sqlite'
+EXPORT_FORMATS_BY_SUFFIX = {'.jsonl': JSONL_FORMAT, '.db': SQLITE_FORMAT,
+                            '.sqlite': SQLITE_FORMAT, '.sqlite3': SQLITE_FORMAT}
+
+# Kinds of problem, as counted in a report
+MALFORMED_HASH = 'malformed_hash'
+NOT_ARGON2ID = 'not_argon2id'
+OUTDATED_PARAMS = 'outdated_params'
+UNKNOWN_ROLE = 'unknown_role'
+NO_ROLES_RECORD = 'no_roles_record'
+NO_PASSWD_RECORD = 'no_passwd_record'
+
+PARTITION_DELIMITER = ':'
+
+BASE64 = re.compile(r'[A-Za-z0-9+/]+')  # Unpadded, as in Argon2 hashes
+MAX_CACHED_PARAMETERS = 1000
+
+
+class UserRecord(NamedTuple):
+    uname: str
+    hash_str: str | None  # None if the user has no password record
+    roles: list[str] | None  # None if the user has no roles record
+
+
+class VerificationReport(NamedTuple):
+    num_users: int
+    num_problems: int
+    problem_counts: dict[str, int]  # By kind
+    problems: list[str]  # The first MAX_REPORTED_PROBLEMS, described
+    num_exported: int
+
+
+class _PartitionResult(NamedTuple):
+    num_users: int
+    problem_counts: Counter
+    problems: list[str]
+    records: list[UserRecord] | None
+
+
+def export_format(path: Path) -> str:
+    """
+    Gets the export format for a file from its suffix.
+
+    Raises:
+        ValueError for an unknown suffix.
+    """
+    try:
+        return EXPORT_FORMATS_BY_SUFFIX[Path(path).suffix.lower()]
+    except KeyError:
+        raise ValueError(f'Unknown export format for {path}, expected one of '
+                         f'{", ".join(EXPORT_FORMATS_BY_SUFFIX)}') from None
+
+
+def verify_user_store(store: UserStore, workers: int | None = None, export_path: Path | None = None,
+                      partition_bytes: int = PARTITION_BYTES,
+                      max_reported_problems: int = MAX_REPORTED_PROBLEMS) -> VerificationReport:
+    """
+    Checks that every password hash is a valid Argon2id hash made with the
+    current parameters, every role exists, and every user has both a
+    password and a roles record, optionally exporting every user to
+    `export_path` (JSONL or SQLite, by its suffix) in the same pass.
+
+    Both record logs are streamed once and split by username into temporary
+    partition files, which `workers` processes then check independently, so
+    memory use is bounded by the partition size rather than the store's.
+
+    Raises:
+        FileExistsError if `export_path` exists.
+        ValueError if its format is unknown.
+    """
+    exporter = _open_exporter(Path(export_path)) if export_path is not None else None
+    workers = workers or os.cpu_count() or 1
+    num_users = 0
+    num_exported = 0
+    problem_counts = Counter()
+    problems = []
+
+    with tempfile.TemporaryDirectory(prefix='verify-') as tmp_dir:
+        try:
+            partitions = _partition(store, Path(tmp_dir), partition_bytes)
+            for result in _check_partitions(partitions, workers, exporter is not None,
+                                            max_reported_problems):
+                num_users += result.num_users
+                problem_counts.update(result.problem_counts)
+                problems.extend(result.problems[:max_reported_problems - len(problems)])
+                if exporter is not None:
+                    num_exported += exporter.write(result.records)
+        except BaseException:
+            if exporter is not None:
+                exporter.abort()
+            raise
+    if exporter is not None:
+        exporter.close()
+    return VerificationReport(num_users, sum(problem_counts.values()), dict(problem_counts),
+                              problems, num_exported)
+
+
+def _partition(store: UserStore, directory: Path, partition_bytes: int) -> list[tuple[Path, Path]]:
+    """
+    Streams the password and roles records into partition files by a hash of
+    their username, keeping their order, so every record of a user lands in
+    the same partition and the last one still wins.
+
+    Returns:
+        The (password records, roles records) paths of each partition.
+    """
+    num_partitions = min(MAX_PARTITIONS, max(1, -(-_store_size(store) // partition_bytes)))
+    paths = [(directory / f'{i}.passwd', directory / f'{i}.roles') for i in range(num_partitions)]
+    for which, records in [(0, store.iter_passwd_log()),
+                           (1, ((uname, ','.join(roles) if roles is not None else None)
+                                for uname, roles in store.iter_roles_log()))]:
+        files = [open(partition_paths[which], 'w', encoding='utf-8') for partition_paths in paths]
+        try:
+            for uname, value in records:
+                partition_file = files[zlib.crc32(uname.encode('utf-8')) % num_partitions]
+                if value is None:
+                    partition_file.write(TOMBSTONE_PREFIX + uname + '\n')
+                else:
+                    partition_file.write(uname + PARTITION_DELIMITER + value + '\n')
+        finally:
+            for partition_file in files:
+                partition_file.close()
+    return paths
+
+
+def _store_size(store: UserStore) -> int:
+    if isinstance(store, FlatFileUserStore):
+        paths = [store.passwd_file, store.roles_file]
+    elif isinstance(store, SQLiteUserStore):
+        paths = [store.db_file]
+    elif isinstance(store, ShardedUserStore):
+        return sum(_store_size(shard) for shard in store.shards().values())
+    else:
+        paths = []
+    return sum(path.stat().st_size for path in paths if path.exists())
+
+
+def _check_partitions(partitions: list[tuple[Path, Path]], workers: int, export: bool,
+                      max_problems: int) -> Iterator[_PartitionResult]:
+    """
+    Checks partitions on a pool of worker processes, yielding their results
+    in order. At most two partitions per worker are in flight, so results
+    don't pile up when the caller (e.g. an export) falls behind.
+    """
+    if workers == 1 or len(partitions) == 1:
+        for passwd_path, roles_path in partitions:
+            yield _check_partition(passwd_path, roles_path, export, max_problems)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending: deque[Future] = deque()
+        for passwd_path, roles_path in partitions:
+            if len(pending) == 2 * workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(
+                _check_partition, passwd_path, roles_path, export, max_problems))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _read_partition(path: Path) -> dict[str, str]:
+    records = {}
+    with open(path, 'r', encoding='utf-8') as partition_file:
+        for line in partition_file:
+            line = line[:-1]
+            uname, sep, value = line.partition(PARTITION_DELIMITER)
+            if sep:
+                records[uname] = value
+            else:
+                records.pop(line[len(TOMBSTONE_PREFIX):], None)
+    return records
+
+
+def _hash_parameters(hash_str: str, cache: dict) -> 'Parameters':
+    """
+    Same as argon2.extract_parameters, which only looks at the encoded
+    parameters and the lengths of the salt and hash, but also checks that
+    the salt and hash are base64, and caches the result by what it depends on
+    since most hashes share their parameters.
+
+    Raises:
+        InvalidHashError if the hash is malformed.
+    """
+    from argon2 import extract_parameters
+    from argon2.exceptions import InvalidHashError
+
+    rest, _, digest = hash_str.rpartition('$')
+    encoded_params, _, salt = rest.rpartition('$')
+    if not (BASE64.fullmatch(salt) and BASE64.fullmatch(digest)):
+        raise InvalidHashError
+    key = (encoded_params, len(salt), len(digest))
+    params = cache.get(key)
+    if params is None:
+        if len(cache) >= MAX_CACHED_PARAMETERS:
+            cache.clear()
+        params = cache[key] = extract_parameters(hash_str)
+    return params
+
+
+def _check_partition(passwd_path: Path, roles_path: Path, export: bool,
+                     max_problems: int) -> _PartitionResult:
+    # Imported here, only verifying needs argon2
+    from argon2 import Parameters, Type
+    from argon2.exceptions import InvalidHashError
+    from argon2.low_level import ARGON2_VERSION
+    from problem2c import get_password_hasher
+
+    ph = get_password_hasher()
+    current_params = Parameters(type=ph.type, version=ARGON2_VERSION, salt_len=ph.salt_len,
+                                hash_len=ph.hash_len, time_cost=ph.time_cost,
+                                memory_cost=ph.memory_cost, parallelism=ph.parallelism)
+    params_cache = {}
+    valid_roles = {role.value for role in Role}
+    passwd_records = _read_partition(passwd_path)
+    roles_records = _read_partition(roles_path)
+    unames = sorted(passwd_records.keys() | roles_records.keys())
+
+    problem_counts = Counter()
+    problems = []
+
+    def problem(kind: str, description: str) -> None:
+        problem_counts[kind] += 1
+        if len(problems) < max_problems:
+            problems.append(description)
+
+    records = [] if export else None
+    for uname in unames:
+        hash_str = passwd_records.get(uname)
+        roles_str = roles_records.get(uname)
+        roles = (roles_str.split(',') if roles_str else []) if roles_str is not None else None
+
+        if hash_str is None:
+            problem(NO_PASSWD_RECORD, f'{uname}: roles record without a password record')
+        else:
+            try:
+                params = _hash_parameters(hash_str, params_cache)
+            except InvalidHashError:
+                problem(MALFORMED_HASH, f'{uname}: malformed password hash')
+            else:
+                if params.type is not Type.ID:
+                    problem(NOT_ARGON2ID, f'{uname}: password hash is {params.type.name}, not Argon2id')
+                elif params != current_params:
+                    problem(OUTDATED_PARAMS, f'{uname}: password hash made with outdated parameters')
+
+        if roles is None:
+            problem(NO_ROLES_RECORD, f'{uname}: no roles record')
+        else:
+            invalid_roles = [role for role in roles if role not in valid_roles]
+            if invalid_roles:
+                problem(UNKNOWN_ROLE, f'{uname}: unknown role(s) {", ".join(invalid_roles)}')
+
+        if records is not None:
+            records.append(UserRecord(uname, hash_str, roles))
+    return _PartitionResult(len(unames), problem_counts, problems, records)
+
+
+class _JsonlExporter:
+    """
+    Writes one JSON object per user to a temporary file, renamed over
+    `path` once the export is complete.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + '.tmp')
+        self._file = open(self.tmp_path, 'w', encoding='utf-8')
+
+    def write(self, records: Iterable[UserRecord]) -> int:
+        num_records = 0
+        for record in records:
+            self._file.write(json.dumps(record._asdict()) + '\n')
+            num_records += 1
+        return num_records
+
+    def close(self) -> None:
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._file.close()
+        os.remove(self.tmp_path)
+
+
+class _SQLiteExporter:
+    """
+    Writes the users to a SQLite database in SQLiteUserStore's schema, so the
+    export can be opened as a user store.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + '.tmp')
+        for stale_path in self._tmp_paths():
+            stale_path.unlink(missing_ok=True)
+        self._store = SQLiteUserStore(self.tmp_path)
+
+    def write(self, records: Iterable[UserRecord]) -> int:
+        records = list(records)
+        for start in range(0, len(records), EXPORT_BATCH_SIZE):
+            batch = records[start:start + EXPORT_BATCH_SIZE]
+            self._store.add_roles_records((record.uname, record.roles) for record in batch
+                                          if record.roles is not None)
+            self._store.add_passwd_records((record.uname, record.hash_str) for record in batch
+                                           if record.hash_str is not None)
+        return len(records)
+
+    def close(self) -> None:
+        self._store.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._store.close()
+        for tmp_path in self._tmp_paths():
+            tmp_path.unlink(missing_ok=True)
+
+    def _tmp_paths(self) -> list[Path]:
+        return [self.tmp_path.with_name(self.tmp_path.name + suffix) for suffix in ('', '-wal', '-shm')]
+
+
+def _open_exporter(path: Path) -> _JsonlExporter | _SQLiteExporter:
+    if path.exists():
+        raise FileExistsError(f'{path} already exists')
+    if export_format(path) == JSONL_FORMAT:
+        return _JsonlExporter(path)
+    return _SQLiteExporter(path)
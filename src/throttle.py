@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+import metrics
+from hash_pool import HashServiceBusy, get_hash_service
+
+# Attempts per username: a burst, then a steady trickle
+UNAME_BURST = 5
+UNAME_RATE = 1 / 12  # Attempts per second (5 a minute)
+
+# Attempts per source (e.g. client IP), which may log in many users
+SOURCE_BURST = 20
+SOURCE_RATE = 1.0
+
+# Consecutive wrong passwords before a username is locked out. Each further
+# one doubles the lockout, up to the maximum.
+LOCKOUT_THRESHOLD = 3
+LOCKOUT_BASE = 1.0  # Seconds
+LOCKOUT_MAX = 15 * 60
+
+MAX_ENTRIES = 100_000  # Usernames and sources tracked, least recently seen go first
+
+THROTTLED = metrics.counter(
+    'auth_login_throttled_total',
+    'Login attempts rejected before hashing by reason (overloaded, locked_out, source_rate or uname_rate)')
+
+
+class LoginThrottled(Exception):
+    """
+    Raised when a login attempt is rejected before its password is checked.
+    `retry_after` is how many seconds until an attempt could get through.
+    """
+
+    def __init__(self, message: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.message = message
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Entry:
+    __slots__ = ('tokens', 'updated', 'failures', 'locked_until')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0
+        self.locked_until = 0.0
+
+    def refill(self, now: float, rate: float, burst: int) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class LoginThrottle:
+    """
+    Rejects login attempts before any Argon2 work is done for them: every
+    attempt is shed while the hash service's queue is full, usernames are
+    locked out for exponentially longer after repeated wrong passwords, and
+    both usernames and sources have token buckets limiting how fast they can
+    be tried. An attempt only takes a token once it gets past every check.
+
+    State is kept for at most `max_entries` usernames and sources, evicting
+    the least recently seen, so spraying many usernames can't exhaust memory.
+    """
+
+    def __init__(self, uname_burst: int = UNAME_BURST, uname_rate: float = UNAME_RATE,
+                 source_burst: int = SOURCE_BURST, source_rate: float = SOURCE_RATE,
+                 lockout_threshold: int = LOCKOUT_THRESHOLD, lockout_base: float = LOCKOUT_BASE,
+                 lockout_max: float = LOCKOUT_MAX, max_entries: int = MAX_ENTRIES,
+                 is_saturated: Callable[[], bool] | None = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.uname_burst = uname_burst
+        self.uname_rate = uname_rate
+        self.source_burst = source_burst
+        self.source_rate = source_rate
+        self.lockout_threshold = lockout_threshold
+        self.lockout_base = lockout_base
+        self.lockout_max = lockout_max
+        self.max_entries = max_entries
+        self.is_saturated = is_saturated
+        self.clock = clock
+
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, uname: str, source: str | None = None) -> None:
+        """
+        Lets a login attempt through, taking a token from its username's and
+        source's buckets.
+
+        Raises:
+            HashServiceBusy if the hash service is saturated.
+            LoginThrottled if the username is locked out or either bucket is
+            empty.
+        """
+        if self.is_saturated is not None and self.is_saturated():
+            if metrics.ENABLED:
+                THROTTLED.inc(reason='overloaded')
+            raise HashServiceBusy('Hash service is saturated')
+
+        with self._lock:
+            now = self.clock()
+            uname_entry = self._entry('uname', uname, self.uname_burst, now)
+            if uname_entry.locked_until > now:
+                self._reject('locked_out', 'Login failed! Too many failed attempts, try again later!',
+                             uname_entry.locked_until - now)
+
+            uname_entry.refill(now, self.uname_rate, self.uname_burst)
+            source_entry = None
+            if source is not None:
+                source_entry = self._entry('source', source, self.source_burst, now)
+                source_entry.refill(now, self.source_rate, self.source_burst)
+                if source_entry.tokens < 1:
+                    self._reject('source_rate', 'Login failed! Too many attempts, try again later!',
+                                 (1 - source_entry.tokens) / self.source_rate)
+            if uname_entry.tokens < 1:
+                self._reject('uname_rate', 'Login failed! Too many attempts, try again later!',
+                             (1 - uname_entry.tokens) / self.uname_rate)
+
+            uname_entry.tokens -= 1
+            if source_entry is not None:
+                source_entry.tokens -= 1
+
+    def record_failure(self, uname: str) -> None:
+        """
+        Counts a wrong password, locking the username out past the threshold.
+        """
+        with self._lock:
+            now = self.clock()
+            entry = self._entry('uname', uname, self.uname_burst, now)
+            entry.failures += 1
+            if entry.failures >= self.lockout_threshold:
+                lockout = min(self.lockout_max,
+                              self.lockout_base * 2 ** (entry.failures - self.lockout_threshold))
+                entry.locked_until = now + lockout
+
+    def record_success(self, uname: str) -> None:
+        """
+        Clears a username's failures after it logs in.
+        """
+        with self._lock:
+            entry = self._entries.get(('uname', uname))
+            if entry is not None:
+                entry.failures = 0
+                entry.locked_until = 0.0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries)}
+
+    def _entry(self, kind: str, key: str, burst: int, now: float) -> _Entry:
+        entry = self._entries.get((kind, key))
+        if entry is None:
+            entry = self._entries[(kind, key)] = _Entry(burst, now)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end((kind, key))
+        return entry
+
+    @staticmethod
+    def _reject(reason: str, message: str, retry_after: float) -> None:
+        if metrics.ENABLED:
+            THROTTLED.inc(reason=reason)
+        raise LoginThrottled(message, reason, retry_after)
+
+
+_login_throttle: LoginThrottle | None = None
+_login_throttle_lock = threading.Lock()
+
+
+def get_login_throttle() -> LoginThrottle:
+    """
+    Gets the process-wide login throttle, creating it on first use. It sheds
+    load while the process-wide hash service is saturated.
+    """
+    global _login_throttle
+    with _login_throttle_lock:
+        if _login_throttle is None:
+            _login_throttle = LoginThrottle(
+                is_saturated=lambda: get_hash_service().is_saturated())
+        return _login_throttle
+
+
+def set_login_throttle(throttle: LoginThrottle) -> None:
+    global _login_throttle
+    with _login_throttle_lock:
+        _login_throttle = throttle
@@ -0,0 +1,180 @@
+import math
+import os
+from pathlib import Path
+import metrics
+from bloom import BloomFilter
+from file_lock import locked
+from record_index import source_checksum
+
+DEFAULT_FP_RATE = 0.01
+MIN_CAPACITY = 100_000  # Usernames, so small user bases don't resize often
+
+CHECKS = metrics.counter(
+    'auth_uname_filter_checks_total', 'Username filter checks by result (absent or maybe_present)')
+
+
+class UsernameFilter:
+    """
+    Persistent Bloom filter of the keys (usernames) in a delimited data file,
+    answering most lookups for usernames that don't exist without touching
+    the file or its index. Like RecordIndex, it remembers how much of the data
+    file it has seen: records appended since are added on the next check, and
+    it's rebuilt when the data file is replaced (e.g. compacted) or outgrows
+    the filter's capacity.
+
+    Deleted usernames stay in the filter until the next rebuild, which only
+    costs a lookup, since "maybe present" is always double-checked.
+    """
+
+    def __init__(self, data_path: Path, filter_path: Path, delimiter: str = ':',
+                 fp_rate: float = DEFAULT_FP_RATE):
+        self.data_path = Path(data_path)
+        self.filter_path = Path(filter_path)
+        self.delimiter = delimiter.encode('utf-8')
+        self.fp_rate = fp_rate
+        self._bloom: BloomFilter | None = None
+        self._filter_inode = None
+        # Like RecordIndex, holds the data file open so its inode can't be
+        # reused by a replacement file while the filter refers to it
+        self._data_fd: int | None = None
+        self._data_inode = None
+
+    def __contains__(self, key: str) -> bool:
+        """
+        Checks if a key might be in the data file.
+
+        Returns:
+            False if the key definitely isn't there.
+            True if it might be.
+        """
+        if not self.sync():
+            return False  # No data file yet
+        maybe_present = key.encode('utf-8') in self._bloom
+        if metrics.ENABLED:
+            CHECKS.inc(result='maybe_present' if maybe_present else 'absent')
+        return maybe_present
+
+    def sync(self) -> bool:
+        """
+        Brings the filter up to date with the data file.
+
+        Returns:
+            True if the data file exists.
+            False otherwise.
+        """
+        try:
+            stat = os.stat(self.data_path)
+        except FileNotFoundError:
+            self._close_data()
+            return False
+
+        opened = False
+        if self._data_inode != stat.st_ino:
+            self._close_data()
+            self._data_fd = os.open(self.data_path, os.O_RDONLY)
+            self._data_inode = os.fstat(self._data_fd).st_ino
+            opened = True
+        if self._bloom is None:
+            self._open()
+        if opened and self._bloom is not None:
+            # Built from this file, or from an earlier one with its inode?
+            source_size, source_inode, checksum = self._bloom.source
+            if (source_inode == stat.st_ino and source_size <= stat.st_size
+                    and checksum != source_checksum(self._data_fd, source_size)):
+                with locked(self.filter_path, exclusive=True):
+                    self._rebuild()
+        if self._bloom is not None and self._bloom.source[:2] == (stat.st_size, stat.st_ino):
+            return True
+
+        # Bits are set with read-modify-writes, so only one process may add
+        # to the filter at a time
+        with locked(self.filter_path, exclusive=True):
+            self._open()
+            source_size, source_inode, _ = self._bloom.source if self._bloom else (0, 0, 0)
+            if (self._bloom is None or source_inode != stat.st_ino or source_size > stat.st_size
+                    or self._bloom.count > self.capacity()):
+                self._rebuild()
+            elif source_size < stat.st_size:
+                self._add_from(source_size, stat.st_ino)
+        return True
+
+    def rebuild(self) -> int:
+        """
+        Rebuilds the filter from the data file.
+
+        Returns:
+            The number of keys added.
+        """
+        with locked(self.filter_path, exclusive=True):
+            self._rebuild()
+            return self._bloom.count
+
+    def capacity(self) -> int:
+        """
+        Keys the filter holds before its false positive rate exceeds fp_rate.
+        """
+        return int(self._bloom.num_bits * math.log(2) ** 2 / -math.log(self.fp_rate))
+
+    def close(self) -> None:
+        self._close_filter()
+        self._close_data()
+
+    def _close_filter(self) -> None:
+        if self._bloom is not None:
+            self._bloom.close()
+            self._bloom = None
+        self._filter_inode = None
+
+    def _close_data(self) -> None:
+        if self._data_fd is not None:
+            os.close(self._data_fd)
+            self._data_fd = None
+            self._data_inode = None
+
+    def _open(self) -> None:
+        """
+        (Re)opens the filter file if it was replaced since it was opened.
+        """
+        try:
+            filter_inode = os.stat(self.filter_path).st_ino
+        except FileNotFoundError:
+            self._close_filter()
+            return
+        if filter_inode == self._filter_inode:
+            return
+        self._close_filter()
+        try:
+            self._bloom = BloomFilter(self.filter_path, writable=True)
+        except ValueError:
+            return  # Written by an older version, rebuilt on the next sync
+        self._filter_inode = filter_inode
+
+    def _rebuild(self) -> None:
+        with locked(self.data_path), open(self.data_path, 'rb') as data_file:
+            num_lines = sum(chunk.count(b'\n')
+                            for chunk in iter(lambda: data_file.read(1 << 20), b''))
+        self._close_filter()
+        # Room to grow before the next rebuild
+        BloomFilter.create(self.filter_path, max(MIN_CAPACITY, 2 * num_lines),
+                           self.fp_rate).close()
+        self._open()
+        self._add_from(0, os.stat(self.data_path).st_ino)
+
+    def _add_from(self, start: int, inode: int) -> None:
+        offset = start
+        with locked(self.data_path), open(self.data_path, 'rb') as data_file:
+            if os.fstat(data_file.fileno()).st_ino != inode:
+                # Replaced since it was stat'ed, the next sync rebuilds
+                return
+            data_file.seek(start)
+            for line in data_file:
+                if not line.endswith(b'\n'):
+                    break  # Partially written record, pick it up next sync
+                key, sep, _ = line.partition(self.delimiter)
+                if sep:
+                    self._bloom.add(key)
+                offset += len(line)
+            checksum = source_checksum(data_file.fileno(), offset)
+        # Bits must be in place before the source says they are
+        self._bloom.flush()
+        self._bloom.set_source(offset, inode, checksum)
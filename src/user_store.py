@@ -0,0 +1,732 @@
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+from file_lock import locked
+from group_commit import GROUP_COMMIT_MAX_DELAY, GroupCommitWriter
+from problem1c import Role
+from record_cache import RecordCache
+from record_index import TOMBSTONE_PREFIX, RecordIndex
+from role_index import RoleIndex
+from uname_filter import UsernameFilter
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the user records and settings files, the project root
+# unless AUTH_DATA_DIR is set
+DATA_DIR = Path(os.environ.get('AUTH_DATA_DIR', Path(__file__).parent.parent))
+
+PASSWD_FILE = DATA_DIR / 'passwd.txt'
+PASSWD_INDEX_FILE = DATA_DIR / 'passwd.idx'
+PASSWD_FILE_RECORD_DELIMITER = ':'
+
+ROLES_FILE = DATA_DIR / 'roles.txt'
+ROLES_FILE_RECORD_DELIMITER = ':'
+
+USER_DB_FILE = DATA_DIR / 'users.db'
+
+# Most recently used password records kept in memory, the rest are read
+# through the password file index
+PASSWD_CACHE_MAX_ENTRIES = 100_000
+
+# False positive rate of the username Bloom filter, which answers lookups for
+# most usernames that don't exist without going to the password file
+UNAME_FILTER_FP_RATE = float(os.environ.get('UNAME_FILTER_FP_RATE', 0.01))
+
+# None keeps every roles record in memory, a limit switches to an LRU cache
+# that scans the roles file on misses
+ROLES_CACHE_MAX_ENTRIES = None
+
+FLAT_FILE_BACKEND = 'flat'
+SQLITE_BACKEND = 'sqlite'
+SHARDED_BACKEND = 'sharded'
+BACKENDS = [FLAT_FILE_BACKEND, SQLITE_BACKEND, SHARDED_BACKEND]
+
+# Backend used by the module-level store, 'flat' (passwd.txt and roles.txt),
+# 'sqlite' (users.db) or 'sharded' (flat files split across shards/)
+USER_STORE_BACKEND = os.environ.get('USER_STORE_BACKEND', FLAT_FILE_BACKEND)
+
+MIGRATION_BATCH_SIZE = 10_000
+
+# Background compaction rewrites the flat files once at least this share of
+# their records has been updated or deleted, and they hold at least
+# COMPACTION_MIN_RECORDS records
+COMPACTION_GARBAGE_RATIO = 0.5
+COMPACTION_MIN_RECORDS = 1000
+COMPACTION_INTERVAL = 60  # Seconds between checks
+
+
+class LoginRecord(NamedTuple):
+    hash_str: str
+    roles: set[Role] | None  # None if the user has no roles record
+
+
+class NewUser(NamedTuple):
+    uname: str
+    hash_str: str
+    roles: list[str] | None  # None adds no roles record
+
+
+def parse_roles(roles_str: str) -> set[Role]:
+    if roles_str:
+        # Convert comma-separated string into set of roles
+        return {Role(role) for role in roles_str.split(',')}
+    return set()  # Handle a user having no roles
+
+
+class UserStore(ABC):
+    """
+    Storage backend for password and roles records. Adding a record for a
+    username that already has one replaces it, but add_users() only adds
+    users whose username isn't taken. Backends implement every abstract
+    method, and may override the others where they can do better.
+    """
+
+    @abstractmethod
+    def add_passwd_record(self, uname: str, hash_str: str) -> None:
+        ...
+
+    @abstractmethod
+    def get_passwd_hash(self, uname: str) -> str | None:
+        ...
+
+    @abstractmethod
+    def update_passwd_hash(self, uname: str, hash_str: str, old_hash_str: str | None = None) -> bool:
+        """
+        Replaces the password hash in a user's password record, if the user
+        (still) has one and, when `old_hash_str` is given, it is still their
+        hash, so a concurrent password change isn't undone.
+
+        Returns:
+            True if the hash was replaced.
+            False otherwise.
+        """
+
+    @abstractmethod
+    def add_roles_record(self, uname: str, roles: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    def get_roles(self, uname: str) -> set[Role] | None:
+        ...
+
+    @abstractmethod
+    def set_roles(self, uname: str, roles: list[str]) -> bool:
+        """
+        Replaces the roles of an existing user.
+
+        Returns:
+            True if the user has a password record.
+            False otherwise.
+        """
+
+    @abstractmethod
+    def delete_user(self, uname: str) -> bool:
+        """
+        Deletes a user's password and roles records.
+
+        Returns:
+            True if the user had either record.
+            False otherwise.
+        """
+
+    def get_login_record(self, uname: str) -> LoginRecord | None:
+        """
+        Retrieves everything needed to log a user in.
+
+        Returns:
+            The user's password hash and roles if they have a password record.
+            None otherwise.
+        """
+        hash_str = self.get_passwd_hash(uname)
+        if hash_str is None:
+            return None
+        return LoginRecord(hash_str, self.get_roles(uname))
+
+    def add_passwd_records(self, records: Iterable[tuple[str, str]]) -> None:
+        for uname, hash_str in records:
+            self.add_passwd_record(uname, hash_str)
+
+    def add_roles_records(self, records: Iterable[tuple[str, list[str]]]) -> None:
+        for uname, roles in records:
+            self.add_roles_record(uname, roles)
+
+    def add_users(self, users: Iterable[NewUser]) -> list[str]:
+        """
+        Adds the password and roles records of many new users at once. Users
+        whose username is taken (has a password record, or comes up earlier
+        in `users`) are left out rather than replaced. The backends check and
+        add in one step, so an enrolment can never take over an account
+        enrolled meanwhile.
+
+        Returns:
+            The usernames that were taken.
+        """
+        taken, new_users = [], {}
+        for user in users:
+            if user.uname in new_users or self.get_passwd_hash(user.uname) is not None:
+                taken.append(user.uname)
+            else:
+                new_users[user.uname] = user
+        new_users = list(new_users.values())
+        # Roles first, so anyone who can log in already has their roles record
+        self.add_roles_records((user.uname, user.roles) for user in new_users
+                               if user.roles is not None)
+        self.add_passwd_records((user.uname, user.hash_str)
+                                for user in new_users)
+        return taken
+
+    @abstractmethod
+    def iter_passwd_records(self) -> Iterator[tuple[str, str]]:
+        ...
+
+    @abstractmethod
+    def iter_roles_records(self) -> Iterator[tuple[str, list[str]]]:
+        ...
+
+    def iter_passwd_log(self) -> Iterator[tuple[str, str | None]]:
+        """
+        Streams the password records as stored, without holding them all in
+        memory: a username may come up more than once, in which case the
+        last record wins, and None marks a deleted user.
+        """
+        yield from self.iter_passwd_records()
+
+    def iter_roles_log(self) -> Iterator[tuple[str, list[str] | None]]:
+        """
+        Same as iter_passwd_log, for the roles records.
+        """
+        yield from self.iter_roles_records()
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def compact(self) -> None:
+        """
+        Reclaims the space taken by updated and deleted records.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class FlatFileUserStore(UserStore):
+    """
+    Stores records in the append-only passwd.txt and roles.txt text files,
+    with an on-disk index over the password file and in-memory caches over
+    both. New records go through a group commit writer, so concurrent
+    enrolments (from any process) share fsyncs and never interleave.
+
+    The files are logs: updates append a newer record, deletes append a
+    tombstone line (TOMBSTONE_PREFIX and the username), and lookups resolve
+    to the latest record. compact() rewrites both files with just the live
+    records.
+    """
+
+    def __init__(self, passwd_file: Path = PASSWD_FILE, roles_file: Path = ROLES_FILE,
+                 passwd_index_file: Path = PASSWD_INDEX_FILE,
+                 passwd_filter_file: Path | None = None, roles_index_file: Path | None = None,
+                 uname_filter_fp_rate: float = UNAME_FILTER_FP_RATE,
+                 passwd_cache_max_entries: int | None = PASSWD_CACHE_MAX_ENTRIES,
+                 roles_cache_max_entries: int | None = ROLES_CACHE_MAX_ENTRIES,
+                 group_commit_max_delay: float = GROUP_COMMIT_MAX_DELAY, fsync: bool = True):
+        self.passwd_file = Path(passwd_file)
+        self.roles_file = Path(roles_file)
+        # Roles before passwords, so anyone who can log in has their roles
+        self.writer = GroupCommitWriter([self.roles_file, self.passwd_file],
+                                        max_delay=group_commit_max_delay, fsync=fsync)
+        self.passwd_index = RecordIndex(
+            passwd_file, passwd_index_file, PASSWD_FILE_RECORD_DELIMITER)
+        # Conditional writes check for records on the group commit writer's
+        # thread, which can't take self._lock (guarding the index above)
+        # while it holds the file locks, so it gets its own view of the index
+        self._writer_index = RecordIndex(
+            passwd_file, passwd_index_file, PASSWD_FILE_RECORD_DELIMITER)
+        if passwd_filter_file is None:
+            # Bloom filter of usernames beside the password file (passwd.bloom)
+            passwd_filter_file = self.passwd_file.with_suffix('.bloom')
+        self.uname_filter = UsernameFilter(
+            passwd_file, passwd_filter_file, PASSWD_FILE_RECORD_DELIMITER, uname_filter_fp_rate)
+        if roles_index_file is None:
+            # Role membership bitmaps beside the roles file (roles.ridx)
+            roles_index_file = self.roles_file.with_suffix('.ridx')
+        self.role_index = RoleIndex(roles_file, roles_index_file, ROLES_FILE_RECORD_DELIMITER)
+        self.passwd_cache = RecordCache(passwd_file, str,
+                                        PASSWD_FILE_RECORD_DELIMITER,
+                                        max_entries=passwd_cache_max_entries, loader=self.passwd_index.get)
+        self.roles_cache = RecordCache(roles_file, parse_roles, ROLES_FILE_RECORD_DELIMITER,
+                                       max_entries=roles_cache_max_entries, loader=self.scan_roles)
+        self._lock = threading.Lock()
+
+    def add_passwd_record(self, uname: str, hash_str: str) -> None:
+        self.add_passwd_records([(uname, hash_str)])
+
+    def get_passwd_hash(self, uname: str) -> str | None:
+        with self._lock:
+            if uname not in self.uname_filter:
+                return None  # Definitely never enrolled
+            return self.passwd_cache.get(uname)
+
+    def update_passwd_hash(self, uname: str, hash_str: str, old_hash_str: str | None = None) -> bool:
+        if self.get_passwd_hash(uname) is None:
+            return False  # Skip the write for users that definitely don't exist
+        updated = False
+
+        def prepare() -> dict[Path, bytes]:
+            nonlocal updated
+            current_hash_str = self._writer_index.get(uname)
+            updated = current_hash_str is not None and (
+                old_hash_str is None or current_hash_str == old_hash_str)
+            if not updated:
+                return {}
+            return {self.passwd_file: self._format_passwd_records([(uname, hash_str)])}
+
+        self.writer.write_if(prepare, [uname])
+        return updated
+
+    def add_roles_record(self, uname: str, roles: list[str]) -> None:
+        self.add_roles_records([(uname, roles)])
+
+    def get_roles(self, uname: str) -> set[Role] | None:
+        with self._lock:
+            return self.roles_cache.get(uname)
+
+    def set_roles(self, uname: str, roles: list[str]) -> bool:
+        if self.get_passwd_hash(uname) is None:
+            return False
+        updated = False
+
+        def prepare() -> dict[Path, bytes]:
+            nonlocal updated
+            updated = self._writer_index.get(uname) is not None
+            if not updated:
+                return {}  # Deleted meanwhile
+            return {self.roles_file: self._format_roles_records([(uname, roles)])}
+
+        self.writer.write_if(prepare, [uname])
+        return updated
+
+    def delete_user(self, uname: str) -> bool:
+        if self.get_passwd_hash(uname) is None and self.get_roles(uname) is None:
+            return False
+        tombstone = (TOMBSTONE_PREFIX + uname + '\n').encode('utf-8')
+        self.writer.write({self.roles_file: tombstone,
+                          self.passwd_file: tombstone})
+        return True
+
+    def add_passwd_records(self, records: Iterable[tuple[str, str]]) -> None:
+        self.writer.write({self.passwd_file: self._format_passwd_records(records)})
+
+    def add_roles_records(self, records: Iterable[tuple[str, list[str]]]) -> None:
+        self.writer.write({self.roles_file: self._format_roles_records(records)})
+
+    def add_users(self, users: Iterable[NewUser]) -> list[str]:
+        users = list(users)
+        taken = []
+
+        def prepare() -> dict[Path, bytes]:
+            taken.clear()
+            new_users = {}
+            for user in users:
+                if user.uname in new_users or self._writer_index.get(user.uname) is not None:
+                    taken.append(user.uname)
+                else:
+                    new_users[user.uname] = user
+            # One group commit for both files
+            return {
+                self.roles_file: self._format_roles_records(
+                    (user.uname, user.roles) for user in new_users.values() if user.roles is not None),
+                self.passwd_file: self._format_passwd_records(
+                    (user.uname, user.hash_str) for user in new_users.values()),
+            }
+
+        self.writer.write_if(prepare, [user.uname for user in users])
+        return taken
+
+    def scan_roles(self, uname: str) -> set[Role] | None:
+        """
+        Retrieves a user's roles by scanning the user roles file.
+        """
+        roles_str = None
+        for record_uname, value in self._iter_log(self.roles_file, ROLES_FILE_RECORD_DELIMITER):
+            if record_uname == uname:
+                roles_str = value  # Keep going, a later record wins
+        return parse_roles(roles_str) if roles_str is not None else None
+
+    def iter_passwd_records(self) -> Iterator[tuple[str, str]]:
+        yield from self._iter_records(self.passwd_file, PASSWD_FILE_RECORD_DELIMITER)
+
+    def iter_roles_records(self) -> Iterator[tuple[str, list[str]]]:
+        for uname, roles_str in self._iter_records(self.roles_file, ROLES_FILE_RECORD_DELIMITER):
+            yield uname, roles_str.split(',') if roles_str else []
+
+    def iter_passwd_log(self) -> Iterator[tuple[str, str | None]]:
+        yield from self._iter_log(self.passwd_file, PASSWD_FILE_RECORD_DELIMITER)
+
+    def iter_roles_log(self) -> Iterator[tuple[str, list[str] | None]]:
+        for uname, roles_str in self._iter_log(self.roles_file, ROLES_FILE_RECORD_DELIMITER):
+            yield uname, (roles_str.split(',') if roles_str else []) if roles_str is not None else None
+
+    def garbage_ratio(self) -> float:
+        """
+        Share of the password (and, when it's fully cached, roles) records
+        that were since updated or deleted.
+        """
+        with self._lock:
+            num_records = self.passwd_index.num_records()
+            num_live = len(self.passwd_index)
+            roles_ratio = self.roles_cache.garbage_ratio()
+        passwd_ratio = 1 - num_live / num_records if num_records else 0.0
+        return max(passwd_ratio, roles_ratio or 0.0)
+
+    def needs_compaction(self) -> bool:
+        with self._lock:
+            num_records = self.passwd_index.num_records()
+        return num_records >= COMPACTION_MIN_RECORDS and self.garbage_ratio() >= COMPACTION_GARBAGE_RATIO
+
+    def compact(self) -> None:
+        """
+        Rewrites both files with only the latest record of each live user,
+        and atomically swaps them in. Writers (in any process) wait on the
+        file locks meanwhile, and readers pick up the new files by their
+        inode.
+        """
+        # Same lock order as the group commit writer
+        with self._lock, locked(self.roles_file, exclusive=True), \
+                locked(self.passwd_file, exclusive=True):
+            for path, delimiter in [(self.roles_file, ROLES_FILE_RECORD_DELIMITER),
+                                    (self.passwd_file, PASSWD_FILE_RECORD_DELIMITER)]:
+                if path.exists():
+                    self._rewrite(path, delimiter)
+            self.passwd_cache.clear()
+            self.roles_cache.clear()
+
+    def rebuild_passwd_index(self) -> int:
+        """
+        Rebuilds the password file index from the password file.
+
+        Returns:
+            The number of indexed usernames.
+        """
+        if not self.passwd_file.exists():
+            self.passwd_file.touch()
+        with self._lock:
+            self.passwd_index.rebuild()
+            self.passwd_cache.clear()
+            return len(self.passwd_index)
+
+    def rebuild_uname_filter(self) -> int:
+        """
+        Rebuilds the username Bloom filter from the password file.
+
+        Returns:
+            The number of usernames added.
+        """
+        if not self.passwd_file.exists():
+            self.passwd_file.touch()
+        with self._lock:
+            return self.uname_filter.rebuild()
+
+    def rebuild_role_index(self) -> int:
+        """
+        Rebuilds the role membership index from the roles file.
+
+        Returns:
+            The number of users indexed.
+        """
+        if not self.roles_file.exists():
+            self.roles_file.touch()
+        with self._lock:
+            return self.role_index.rebuild()
+
+    def close(self) -> None:
+        self.passwd_index.close()
+        self._writer_index.close()
+        self.uname_filter.close()
+        self.role_index.close()
+
+    def _format_passwd_records(self, records: Iterable[tuple[str, str]]) -> bytes:
+        return ''.join(PASSWD_FILE_RECORD_DELIMITER.join([uname, hash_str]) + '\n'
+                       for uname, hash_str in records).encode('utf-8')
+
+    def _format_roles_records(self, records: Iterable[tuple[str, list[str]]]) -> bytes:
+        return ''.join(ROLES_FILE_RECORD_DELIMITER.join([uname, ','.join(roles)]) + '\n'
+                       for uname, roles in records).encode('utf-8')
+
+    def _rewrite(self, path: Path, delimiter: str) -> None:
+        """
+        Writes the live records of a file to a copy beside it and renames the
+        copy over the original.
+        """
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+            for uname, value in self._iter_records(path, delimiter):
+                tmp_file.write(delimiter.join([uname, value]) + '\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+
+    def _iter_records(self, path: Path, delimiter: str) -> Iterator[tuple[str, str]]:
+        """
+        Yields the latest record of every live username in a file.
+        """
+        records = {}
+        for uname, value in self._iter_log(path, delimiter):
+            if value is None:
+                records.pop(uname, None)
+            else:
+                records[uname] = value
+        yield from records.items()
+
+    def _iter_log(self, path: Path, delimiter: str) -> Iterator[tuple[str, str | None]]:
+        """
+        Yields every record in a file in order, with None as the value of
+        tombstones.
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    if not line.endswith('\n'):
+                        break  # Partially written record
+                    line = line[:-1]
+                    uname, sep, value = line.partition(delimiter)
+                    if sep:
+                        yield uname, value
+                    elif line.startswith(TOMBSTONE_PREFIX):
+                        yield line[len(TOMBSTONE_PREFIX):], None
+        except FileNotFoundError:
+            return  # Files get created when we add the first record
+
+
+class SQLiteUserStore(UserStore):
+    """
+    Stores records in a SQLite database in WAL mode, so readers never block on
+    a writer. Each thread reuses its own connection, and sqlite3 keeps the
+    compiled statements cached per connection.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS passwd (
+            uname TEXT PRIMARY KEY,
+            hash_str TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS roles (
+            uname TEXT PRIMARY KEY,
+            roles TEXT NOT NULL
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, db_file: Path = USER_DB_FILE):
+        self.db_file = Path(db_file)
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._connect().executescript(self.SCHEMA)
+
+    def add_passwd_record(self, uname: str, hash_str: str) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO passwd (uname, hash_str) VALUES (?, ?)', (uname, hash_str))
+
+    def get_passwd_hash(self, uname: str) -> str | None:
+        row = self._connect().execute(
+            'SELECT hash_str FROM passwd WHERE uname = ?', (uname,)).fetchone()
+        return row[0] if row else None
+
+    def update_passwd_hash(self, uname: str, hash_str: str, old_hash_str: str | None = None) -> bool:
+        with self._connect() as connection:
+            if old_hash_str is None:
+                cursor = connection.execute(
+                    'UPDATE passwd SET hash_str = ? WHERE uname = ?', (hash_str, uname))
+            else:
+                cursor = connection.execute(
+                    'UPDATE passwd SET hash_str = ? WHERE uname = ? AND hash_str = ?',
+                    (hash_str, uname, old_hash_str))
+        return cursor.rowcount > 0
+
+    def add_roles_record(self, uname: str, roles: list[str]) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO roles (uname, roles) VALUES (?, ?)', (uname, ','.join(roles)))
+
+    def get_roles(self, uname: str) -> set[Role] | None:
+        row = self._connect().execute(
+            'SELECT roles FROM roles WHERE uname = ?', (uname,)).fetchone()
+        return parse_roles(row[0]) if row else None
+
+    def set_roles(self, uname: str, roles: list[str]) -> bool:
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT OR REPLACE INTO roles (uname, roles) '
+                'SELECT uname, ? FROM passwd WHERE uname = ?', (','.join(roles), uname))
+        return cursor.rowcount > 0
+
+    def delete_user(self, uname: str) -> bool:
+        with self._connect() as connection:  # One transaction for both tables
+            num_deleted = connection.execute(
+                'DELETE FROM roles WHERE uname = ?', (uname,)).rowcount
+            num_deleted += connection.execute(
+                'DELETE FROM passwd WHERE uname = ?', (uname,)).rowcount
+        return num_deleted > 0
+
+    def get_login_record(self, uname: str) -> LoginRecord | None:
+        row = self._connect().execute(
+            'SELECT passwd.hash_str, roles.roles FROM passwd LEFT JOIN roles USING (uname) '
+            'WHERE passwd.uname = ?', (uname,)).fetchone()
+        if row is None:
+            return None
+        hash_str, roles_str = row
+        roles = parse_roles(roles_str) if roles_str is not None else None
+        return LoginRecord(hash_str, roles)
+
+    def add_passwd_records(self, records: Iterable[tuple[str, str]]) -> None:
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO passwd (uname, hash_str) VALUES (?, ?)', records)
+
+    def add_roles_records(self, records: Iterable[tuple[str, list[str]]]) -> None:
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO roles (uname, roles) VALUES (?, ?)',
+                                   ((uname, ','.join(roles)) for uname, roles in records))
+
+    def add_users(self, users: Iterable[NewUser]) -> list[str]:
+        taken = []
+        with self._connect() as connection:  # One transaction for both tables
+            for user in users:
+                cursor = connection.execute('INSERT OR IGNORE INTO passwd (uname, hash_str) VALUES (?, ?)',
+                                            (user.uname, user.hash_str))
+                if cursor.rowcount == 0:
+                    taken.append(user.uname)
+                elif user.roles is not None:
+                    connection.execute('INSERT OR REPLACE INTO roles (uname, roles) VALUES (?, ?)',
+                                       (user.uname, ','.join(user.roles)))
+        return taken
+
+    def iter_passwd_records(self) -> Iterator[tuple[str, str]]:
+        yield from self._connect().execute('SELECT uname, hash_str FROM passwd')
+
+    def iter_roles_records(self) -> Iterator[tuple[str, list[str]]]:
+        for uname, roles_str in self._connect().execute('SELECT uname, roles FROM roles'):
+            yield uname, roles_str.split(',') if roles_str else []
+
+    def needs_compaction(self) -> bool:
+        # SQLite reuses freed pages by itself, only a mostly empty file is
+        # worth rebuilding
+        connection = self._connect()
+        num_pages = connection.execute('PRAGMA page_count').fetchone()[0]
+        num_free_pages = connection.execute(
+            'PRAGMA freelist_count').fetchone()[0]
+        return num_pages > 0 and num_free_pages / num_pages >= COMPACTION_GARBAGE_RATIO
+
+    def compact(self) -> None:
+        self._connect().execute('VACUUM')
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.db_file, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+
+def open_user_store(backend: str) -> UserStore:
+    if backend == FLAT_FILE_BACKEND:
+        return FlatFileUserStore()
+    if backend == SQLITE_BACKEND:
+        return SQLiteUserStore()
+    if backend == SHARDED_BACKEND:
+        from sharded_store import ShardedUserStore  # Imports user_store
+        return ShardedUserStore()
+    raise ValueError(f'Unknown user store backend: {backend}')
+
+
+def migrate_user_store(src: UserStore, dest: UserStore) -> tuple[int, int]:
+    """
+    Copies every password and roles record from one store to another, in
+    batches of MIGRATION_BATCH_SIZE records.
+
+    Returns:
+        The number of password records and roles records copied.
+    """
+    # Roles first, so anyone who can log in already has their roles record
+    num_roles_records = 0
+    for batch in _batched(src.iter_roles_records(), MIGRATION_BATCH_SIZE):
+        dest.add_roles_records(batch)
+        num_roles_records += len(batch)
+
+    num_passwd_records = 0
+    for batch in _batched(src.iter_passwd_records(), MIGRATION_BATCH_SIZE):
+        dest.add_passwd_records(batch)
+        num_passwd_records += len(batch)
+    return num_passwd_records, num_roles_records
+
+
+def start_background_compaction(store: UserStore, interval: float = COMPACTION_INTERVAL) -> threading.Event:
+    """
+    Compacts a store from a background thread whenever it needs it, checking
+    every `interval` seconds.
+
+    Returns:
+        An event that stops the thread once set.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                if store.needs_compaction():
+                    store.compact()
+            except Exception:
+                logger.exception('Compacting the user store failed')
+
+    threading.Thread(target=run, name='user-store-compaction',
+                     daemon=True).start()
+    return stop
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_user_store: UserStore | None = None
+_user_store_lock = threading.Lock()
+
+
+def get_user_store() -> UserStore:
+    """
+    Gets the process-wide user store, opening the USER_STORE_BACKEND one on
+    first use.
+    """
+    global _user_store
+    with _user_store_lock:
+        if _user_store is None:
+            _user_store = open_user_store(USER_STORE_BACKEND)
+        return _user_store
+
+
+def set_user_store(store: UserStore) -> None:
+    global _user_store
+    with _user_store_lock:
+        _user_store = store
@@ -0,0 +1,185 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+from bloom import BloomFilter
+
+WEAK_PASSWD_DB_MAGIC = b'WEAKDB01'
+
+# Header: magic, number of digests, source file size, source file mtime
+WEAK_PASSWD_DB_HEADER = struct.Struct('<8sQQQ')
+
+DIGEST_LENGTH = 20  # SHA-1
+PREFIX_BITS = 16  # Digests are bucketed by their first two bytes
+NUM_PREFIXES = 1 << PREFIX_BITS
+
+# Bucket table: index of the first digest of every prefix, plus one past the end
+PREFIX_TABLE = struct.Struct(f'<{NUM_PREFIXES + 1}Q')
+
+NUM_BUILD_BUCKETS = 256  # Temporary files the digests are spread over
+
+DEFAULT_FP_RATE = 0.001
+
+
+def passwd_digest(passwd: str) -> bytes:
+    return hashlib.sha1(passwd.encode('utf-8')).digest()
+
+
+def build_weak_passwd_db(src_path: Path, db_path: Path, bloom_path: Path,
+                         fp_rate: float = DEFAULT_FP_RATE) -> int:
+    """
+    Compiles a plain text weak password list (one password per line) into a
+    sorted file of SHA-1 digests bucketed by prefix, plus a Bloom filter in
+    front of it. Digests are first spread over temporary bucket files by their
+    first byte, so only one bucket needs to be sorted in memory at a time.
+
+    Returns:
+        The number of distinct passwords compiled.
+    """
+    src_stat = os.stat(src_path)
+
+    with tempfile.TemporaryDirectory(dir=Path(db_path).parent) as tmp_dir:
+        bucket_paths = [Path(tmp_dir) / f'{i:02x}' for i in range(
+            NUM_BUILD_BUCKETS)]
+        bucket_files = [open(path, 'wb') for path in bucket_paths]
+        num_passwds = 0
+        try:
+            with open(src_path, 'r', encoding='utf-8') as src_file:
+                for line in src_file:
+                    digest = passwd_digest(line.rstrip('\n'))
+                    bucket_files[digest[0]].write(digest)
+                    num_passwds += 1
+        finally:
+            for bucket_file in bucket_files:
+                bucket_file.close()
+
+        bloom = BloomFilter.create(bloom_path.with_name(
+            bloom_path.name + '.new'), num_passwds, fp_rate)
+        prefix_table = [0] * (NUM_PREFIXES + 1)
+        num_digests = 0
+        tmp_db_path = Path(tmp_dir) / Path(db_path).name
+        with open(tmp_db_path, 'wb') as db_file:
+            db_file.write(WEAK_PASSWD_DB_HEADER.pack(
+                WEAK_PASSWD_DB_MAGIC, 0, 0, 0))
+            db_file.write(PREFIX_TABLE.pack(*prefix_table))  # Placeholder
+
+            for bucket_path in bucket_paths:
+                data = bucket_path.read_bytes()
+                digests = sorted({data[i:i + DIGEST_LENGTH]
+                                  for i in range(0, len(data), DIGEST_LENGTH)})
+                for digest in digests:
+                    prefix_table[int.from_bytes(
+                        digest[:2], 'big') + 1] += 1
+                    bloom.add(digest)
+                db_file.write(b''.join(digests))
+                num_digests += len(digests)
+                bucket_path.unlink()
+
+            # Turn per-prefix counts into start indexes
+            for prefix in range(NUM_PREFIXES):
+                prefix_table[prefix + 1] += prefix_table[prefix]
+
+            db_file.seek(0)
+            db_file.write(WEAK_PASSWD_DB_HEADER.pack(
+                WEAK_PASSWD_DB_MAGIC, num_digests, src_stat.st_size, src_stat.st_mtime_ns))
+            db_file.write(PREFIX_TABLE.pack(*prefix_table))
+            db_file.flush()
+            os.fsync(db_file.fileno())
+
+        bloom.close()
+        os.replace(bloom.path, bloom_path)
+        os.replace(tmp_db_path, db_path)
+
+    return num_digests
+
+
+class WeakPasswdDB:
+    """
+    Read-only view of a compiled weak password list. Lookups hash the password,
+    ask the Bloom filter, and only binary search the digests (within the
+    password's prefix bucket) when the filter says it might be there. Both
+    files are memory-mapped, so the list is never loaded into memory.
+
+    The compiled files are (re)opened lazily, and are only used while they
+    were compiled from the current version of the source list.
+    """
+
+    def __init__(self, src_path: Path, db_path: Path, bloom_path: Path):
+        self.src_path = Path(src_path)
+        self.db_path = Path(db_path)
+        self.bloom_path = Path(bloom_path)
+        self._db_file = None
+        self._db_map = None
+        self._db_inode = None
+        self._bloom = None
+        self._num_digests = 0
+        self._src_id = None  # (size, mtime) of the source list it was built from
+
+    def is_current(self) -> bool:
+        """
+        Checks if the compiled list exists and matches the source list.
+        """
+        try:
+            db_stat = os.stat(self.db_path)
+            src_stat = os.stat(self.src_path)
+        except FileNotFoundError:
+            return False
+
+        if db_stat.st_ino != self._db_inode:
+            try:
+                self._open(db_stat.st_ino)
+            except (FileNotFoundError, ValueError):
+                self.close()
+                return False
+        return self._src_id == (src_stat.st_size, src_stat.st_mtime_ns)
+
+    def __contains__(self, passwd: str) -> bool:
+        digest = passwd_digest(passwd)
+        if digest not in self._bloom:
+            return False
+
+        prefix = int.from_bytes(digest[:2], 'big')
+        lo, hi = struct.unpack_from(
+            '<QQ', self._db_map, WEAK_PASSWD_DB_HEADER.size + prefix * 8)
+        base = WEAK_PASSWD_DB_HEADER.size + PREFIX_TABLE.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * DIGEST_LENGTH
+            mid_digest = self._db_map[start:start + DIGEST_LENGTH]
+            if mid_digest == digest:
+                return True
+            if mid_digest < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def close(self) -> None:
+        if self._bloom is not None:
+            self._bloom.close()
+            self._bloom = None
+        if self._db_map is not None:
+            self._db_map.close()
+            self._db_map = None
+        if self._db_file is not None:
+            self._db_file.close()
+            self._db_file = None
+        self._db_inode = None
+        self._src_id = None
+
+    def _open(self, db_inode: int) -> None:
+        self.close()
+        self._db_file = open(self.db_path, 'rb')
+        self._db_map = mmap.mmap(
+            self._db_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._num_digests, src_size, src_mtime_ns = WEAK_PASSWD_DB_HEADER.unpack_from(
+            self._db_map, 0)
+        expected_size = WEAK_PASSWD_DB_HEADER.size + \
+            PREFIX_TABLE.size + self._num_digests * DIGEST_LENGTH
+        if magic != WEAK_PASSWD_DB_MAGIC or len(self._db_map) != expected_size:
+            raise ValueError(f'{self.db_path} is not a weak password file')
+        self._bloom = BloomFilter(self.bloom_path)
+        self._db_inode = db_inode
+        self._src_id = (src_size, src_mtime_ns)